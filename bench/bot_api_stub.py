@@ -0,0 +1,194 @@
+"""Локальная заглушка Telegram Bot API для бенчмарков.
+
+Бот подключается к ней через TELEGRAM_API_URL. Заглушка отвечает на методы,
+которые вызывает бот, отдаёт подготовленные апдейты через getUpdates, считает
+вызовы и соединения и умеет имитировать задержку сети и ответы 429.
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+
+
+def make_message_update(update_id: int, user_id: int, text: str) -> dict:
+    """Апдейт с текстовым сообщением (команды размечаются как bot_command)"""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": text,
+    }
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+class BotApiStub:
+    """HTTP/1.1 сервер с keep-alive, по потоку на соединение"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, flood_every: int = 0, retry_after: int = 1):
+        self.latency = latency  # Задержка ответа на send*-методы (сек)
+        self.flood_every = flood_every  # Каждый N-й send* получает 429, 0 - никогда
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.connections = 0
+        self.first_call = {}  # Метод -> time.perf_counter() первого вызова
+        self.sent = []  # (chat_id, text) принятых сообщений
+        self._updates = []
+        self._cond = threading.Condition()
+        self._sends = 0
+        self._stopped = False
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update: dict):
+        with self._cond:
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def wait_for(self, method: str, count: int = 1, timeout: float = 30.0) -> bool:
+        """Ждёт, пока метод будет вызван count раз"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.calls[method] >= count, timeout=timeout)
+
+    def get_stats(self) -> dict:
+        """Счётчики для бенчмарка, запустившего заглушку отдельным процессом (GET /stats)"""
+        with self._cond:
+            recipients = Counter(chat_id for chat_id, _ in self.sent)
+            return {
+                "calls": dict(self.calls),
+                "connections": self.connections,
+                "sent": len(self.sent),
+                "duplicates": sum(count - 1 for count in recipients.values() if count > 1),
+            }
+
+    def reset(self):
+        with self._cond:
+            self.calls.clear()
+            self.first_call.clear()
+            self.sent.clear()
+            self.connections = 0
+            self._sends = 0
+
+    # Обработка методов
+    def _handle(self, method: str, params: dict):
+        with self._cond:
+            self.calls[method] += 1
+            self.first_call.setdefault(method, time.perf_counter())
+            self._cond.notify_all()
+
+        if method == 'getUpdates':
+            timeout = float(params.get('timeout') or 0)
+            with self._cond:
+                self._cond.wait_for(lambda: self._updates or self._stopped, timeout=timeout)
+                updates, self._updates = self._updates, []
+            return 200, {"ok": True, "result": updates}
+
+        if method.startswith('send') or method.startswith('edit'):
+            if self.latency:
+                time.sleep(self.latency)
+            with self._cond:
+                self._sends += 1
+                flooded = self.flood_every and self._sends % self.flood_every == 0
+            if flooded:
+                return 429, {
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}
+                }
+            chat_id = int(params.get('chat_id') or 0)
+            with self._cond:
+                self.sent.append((chat_id, params.get('text', '')))
+            return 200, {"ok": True, "result": {
+                "message_id": int(params.get('message_id') or self._sends),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get('text', ''),
+            }}
+
+        if method == 'getMe':
+            return 200, {"ok": True, "result": BOT_USER}
+        return 200, {"ok": True, "result": True}
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub._cond:
+                    stub.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                if self.path == '/stats':
+                    status, payload = 200, stub.get_stats()
+                else:
+                    status, payload = stub._handle(self.path.rsplit('/', 1)[-1], params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Бот завершён, пока висел long polling
+                    pass
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--flood-every', type=int, default=0)
+    args = parser.parse_args()
+
+    stub = BotApiStub(port=args.port, latency=args.latency, flood_every=args.flood_every).start()
+    print(f"TELEGRAM_API_URL={stub.url}", flush=True)
+    try:
+        while True:
+            time.sleep(10)
+            print(dict(stub.calls), f"соединений: {stub.connections}", flush=True)
+    except KeyboardInterrupt:
+        stub.stop()
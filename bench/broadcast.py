@@ -0,0 +1,149 @@
+"""Нагрузочный прогон рассылки против локальной заглушки Bot API.
+
+Создаёт временную базу с N синтетическими пользователями (записываются теми же
+пачками, что и реестр пользователей), запускает рассылку и замеряет скорость.
+С --interrupt-at рассылка прерывается на заданной доле (имитация перезапуска)
+и возобновляется с сохранённого курсора - в отчёте видно, сколько сообщений
+ушло повторно.
+
+Запуск: python bench/broadcast.py --users 100000 --rate 1000 --interrupt-at 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+class StubProcess:
+    """Заглушка Bot API в отдельном процессе - не делит GIL с ботом"""
+
+    def __init__(self, latency: float, flood_every: int):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}/bot"
+        self._proc = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'bot_api_stub.py'), '--port', str(self.port),
+             '--latency', str(latency), '--flood-every', str(flood_every)],
+            stdout=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                self.stats()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/stats", timeout=5) as response:
+            return json.loads(response.read())
+
+    def stop(self):
+        self._proc.terminate()
+        self._proc.wait(timeout=10)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help="сообщений в секунду (в боте NOTIFY_RATE=25 - лимит Telegram)")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help="задержка ответа заглушки на sendMessage (сек)")
+    parser.add_argument('--flood-every', type=int, default=0, help="каждый N-й sendMessage получает 429")
+    parser.add_argument('--interrupt-at', type=float, default=0.0, help="прервать на этой доле (0..1) и возобновить")
+    return parser.parse_args()
+
+
+async def wait_progress(db, broadcast_id, share, total):
+    while True:
+        broadcast = db.get_broadcast(broadcast_id)
+        if broadcast[5] + broadcast[6] + broadcast[7] >= share * total or broadcast[2] != 'running':
+            return
+        await asyncio.sleep(0.05)
+
+
+async def run(args, main, stub):
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    db = main.init_database()
+
+    started = time.perf_counter()
+    batch, now = [], int(time.time())
+    for user_id in range(1, args.users + 1):
+        batch.append((user_id, f"user{user_id}", "Bench", now))
+        if len(batch) == main.Config.USER_BATCH_SIZE:
+            db.upsert_users(batch)
+            batch = []
+    if batch:
+        db.upsert_users(batch)
+    elapsed = time.perf_counter() - started
+    print(f"Пользователи: {db.count_users()} записано за {elapsed:.2f} с ({args.users / elapsed:,.0f} строк/с)")
+
+    broadcast_id = db.create_broadcast("Бенчмарк рассылки", created_by=1)
+    bot = Bot('123456:bench', base_url=stub.url, request=HTTPXRequest(connection_pool_size=args.concurrency))
+    async with bot:
+        started = time.perf_counter()
+        main.broadcaster.start(bot, broadcast_id)
+        if args.interrupt_at:
+            await wait_progress(db, broadcast_id, args.interrupt_at, args.users)
+            task = main.broadcaster._tasks[broadcast_id]
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            cursor = db.get_broadcast(broadcast_id)[8]
+            print(f"Прервано: отправлено {stub.stats()['sent']}, сохранённый курсор user_id={cursor}")
+            main.broadcaster.start(bot, broadcast_id)
+        await main.broadcaster._tasks[broadcast_id]
+        elapsed = time.perf_counter() - started
+
+    broadcast = db.get_broadcast(broadcast_id)
+    deliveries = db._query_one("SELECT COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ?", (broadcast_id,))[0]
+    interrupted = db._query_one("SELECT COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? AND status = 'interrupted'",
+                                (broadcast_id,))[0]
+    stats = stub.stats()
+    print(f"Рассылка #{broadcast_id}: {broadcast[2]}, доставлено {broadcast[5]} из {broadcast[4]}, ошибок {broadcast[6]}")
+    print(f"Время: {elapsed:.1f} с, {broadcast[5] / elapsed:,.0f} сообщ./с (лимит {args.rate:g})")
+    print(f"Статусов доставки: {deliveries}, повторных сообщений: {stats['duplicates']}, "
+          f"прервано на середине запроса: {interrupted}, ответов 429: {main.notification_queue.retried}, "
+          f"HTTP-соединений: {stats['connections']}")
+    print(f"При NOTIFY_RATE=25 эта рассылка заняла бы ~{args.users / 25 / 60:.0f} мин")
+
+
+def main():
+    args = parse_args()
+    stub = StubProcess(args.latency, args.flood_every)
+    workdir = tempfile.mkdtemp(prefix='broadcast-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    import logging
+    import main as bot_main
+    logging.getLogger().setLevel(logging.WARNING)
+    bot_main.Config.BROADCAST_BATCH = args.batch
+    bot_main.Config.BROADCAST_CONCURRENCY = args.concurrency
+    bot_main.notification_queue.rate = args.rate
+    bot_main.notification_queue.burst = max(args.concurrency, 1)
+
+    try:
+        asyncio.run(run(args, bot_main, stub))
+    finally:
+        stub.stop()
+        print(f"База: {os.path.join(workdir, bot_main.Config.DB_NAME)}")
+
+
+if __name__ == '__main__':
+    main()
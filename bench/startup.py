@@ -0,0 +1,128 @@
+"""Профиль запуска бота.
+
+1. Разбор `python -X importtime -c "import main"`: суммарное время импорта
+   и самые дорогие пакеты.
+2. Время до первого апдейта: main.py запускается против локальной заглушки
+   Bot API, замеряется время от старта процесса до ответа на /start.
+   Первый запуск - на пустой базе (создание схемы), второй - на той же
+   базе (схема актуальна, миграции пропускаются).
+
+Запуск: python bench/startup.py [--runs 3]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bot_api_stub import BotApiStub, make_message_update  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = 424242
+
+
+def bench_env(workdir: str, **extra) -> dict:
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'TELEGRAM_TOKEN': '123456:bench',
+        'ADMIN_USER_ID': '1',
+        'MANAGER_USER_IDS': '2',
+        'BACKUP_DIR': os.path.join(workdir, 'backups'),
+        'ARCHIVE_DB_NAME': os.path.join(workdir, 'leads_archive.db'),
+    })
+    env.update(extra)
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def import_profile(workdir: str, top: int):
+    """Время импорта по корневым пакетам (сумма self-времени модулей пакета)"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=workdir, env=bench_env(workdir), capture_output=True, text=True
+    )
+    by_package = defaultdict(int)
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|', 2)
+        by_package[name.strip().split('.')[0]] += int(self_us)
+        total += int(self_us)
+
+    print(f"Импорт main: {total / 1000:.1f} мс (сумма self-времени всех модулей)")
+    for package, us in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {package:<24} {us / 1000:8.1f} мс  {us / total:6.1%}")
+
+
+def import_wall_time(workdir: str, runs: int):
+    """Медиана полного времени `import main` без учёта старта интерпретатора"""
+    def measure(code):
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=workdir, env=bench_env(workdir), check=True)
+            samples.append(time.perf_counter() - started)
+        return statistics.median(samples)
+
+    bare = measure('pass')
+    full = measure('import main')
+    print(f"Интерпретатор: {bare * 1000:.0f} мс, import main: +{(full - bare) * 1000:.0f} мс")
+
+
+def first_update(workdir: str, label: str):
+    """Секунды от запуска процесса до getUpdates и до ответа на /start"""
+    stub = BotApiStub().start()
+    stub.push_update(make_message_update(1, USER_ID, '/start'))
+    env = bench_env(workdir, TELEGRAM_API_URL=stub.url, PORT=str(free_port()))
+
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'main.py')],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        if not stub.wait_for('sendMessage', timeout=60):
+            print(f"  {label}: бот не ответил за 60 с (вызовы: {dict(stub.calls)})")
+            return
+        polling = stub.first_call['getUpdates'] - started
+        answered = stub.first_call['sendMessage'] - started
+        print(f"  {label:<28} getUpdates {polling * 1000:7.0f} мс   ответ на /start {answered * 1000:7.0f} мс")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help="повторов для медианы времени импорта")
+    parser.add_argument('--top', type=int, default=12, help="сколько пакетов показать")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print("== Импорт ==")
+        import_profile(workdir, args.top)
+        import_wall_time(workdir, args.runs)
+
+        print("\n== Время до первого апдейта ==")
+        first_update(workdir, "новая база (создание схемы)")
+        first_update(workdir, "существующая база")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Пропускная способность отправки через транспорт бота против заглушки Bot API.
+
+Для каждого размера пула отправляет --messages сообщений с --concurrency
+одновременных запросов (как всплеск уведомлений или рассылка) и печатает
+скорость, задержки sendMessage, ошибки (в т.ч. таймауты ожидания пула) и
+сколько TCP-соединений открыла заглушка. Отдельный прогон показывает, что
+long polling getUpdates не отнимает соединения у отправки, если у него свой пул.
+
+Запуск: python bench/transport.py --messages 2000 --concurrency 64 --pools 4,16,32,64,256
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from broadcast import StubProcess  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64, help="одновременных send_message")
+    parser.add_argument('--pools', default='4,16,32,64,256', help="размеры пула через запятую")
+    parser.add_argument('--latency', type=float, default=0.02, help="задержка ответа заглушки на sendMessage (сек)")
+    return parser.parse_args()
+
+
+async def send_burst(bot, messages: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def send(chat_id):
+        nonlocal failed
+        async with semaphore:
+            try:
+                await bot.send_message(chat_id, "Бенчмарк транспорта")
+            except Exception:
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(chat_id) for chat_id in range(1, messages + 1)))
+    return time.perf_counter() - started, failed
+
+
+async def run_pool(main, stub, args, pool_size: int, with_polling: bool = False):
+    from telegram import Bot
+
+    request = main.create_bot_request('send', pool_size)
+    updates_request = main.create_bot_request('updates', main.Config.TELEGRAM_UPDATES_POOL_SIZE)
+    bot = Bot('123456:bench', base_url=stub.url, request=request, get_updates_request=updates_request)
+    connections = stub.stats()['connections']
+    async with bot:
+        polling = None
+        if with_polling:
+            # Долгий getUpdates висит всё время всплеска, как в работающем боте
+            polling = asyncio.create_task(bot.get_updates(timeout=30))
+            await asyncio.sleep(0.1)
+        elapsed, failed = await send_burst(bot, args.messages, args.concurrency)
+        if polling:
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+
+    stats = request.get_stats()['endpoints'].get('sendMessage', {})
+    errors = ', '.join(f"{kind}: {count}" for kind, count in stats.get('errors', {}).items()) or '-'
+    label = f"{pool_size}" + (" +poll" if with_polling else "")
+    print(f"  {label:<10} {args.messages / elapsed:9,.0f} {stats.get('p50_ms', 0):8.1f} {stats.get('p95_ms', 0):8.1f} "
+          f"{request.max_in_flight:9} {stub.stats()['connections'] - connections:7}  {failed:6}  {errors}")
+
+
+async def run(main, stub, args):
+    print(f"{args.messages} сообщений, {args.concurrency} одновременно, задержка заглушки {args.latency * 1000:.0f} мс")
+    print(f"  {'пул':<10} {'сообщ./с':>9} {'p50 мс':>8} {'p95 мс':>8} {'в полёте':>9} {'соедин.':>7}  {'ошибок':>6}  причины")
+    for pool_size in [int(size) for size in args.pools.split(',')]:
+        await run_pool(main, stub, args, pool_size)
+    await run_pool(main, stub, args, main.Config.TELEGRAM_POOL_SIZE, with_polling=True)
+
+
+def main():
+    args = parse_args()
+    stub = StubProcess(args.latency, 0)
+
+    import logging
+    import main as bot_main
+    logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        asyncio.run(run(bot_main, stub, args))
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
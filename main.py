@@ -1,23 +1,47 @@
 import os
+import sys
+import glob
+import gzip
+import shutil
+import json
+import fnmatch
+import signal
+import re
+import zlib
+import socket
+import io
+import hmac
+import queue
+import random
+import atexit
 import logging
+import logging.handlers
+import contextvars
 import sqlite3
 import datetime
-import requests
 import time
+import math
 import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
     ContextTypes,
     CallbackContext
 )
 from telegram.constants import ParseMode
-from flask import Flask, request, jsonify, render_template_string
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 import threading
+from collections import OrderedDict, Counter, defaultdict, deque
+from contextlib import contextmanager
 from urllib.parse import urlparse
 
 # ===== КОНФИГУРАЦИЯ =====
@@ -26,6 +50,7 @@ class Config:
     TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', '8162445495:AAE5E9FxE5GXL7h-2rLOGXObw6hz5U4D84c')
     ADMIN_USER_ID = int(os.getenv('ADMIN_USER_ID', 8042351960))
     MANAGER_USER_IDS = [int(uid) for uid in os.getenv('MANAGER_USER_IDS', '8042351960').split(',') if uid]
+    TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')  # Свой Bot API сервер; пусто - https://api.telegram.org/bot
 
     # Настройки бизнеса
     BUSINESS_NAME = "Create AI Bot"
@@ -34,7 +59,54 @@ class Config:
     SUPPORT_PHONE = "@arufak"
 
     # Настройки базы данных
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')  # sqlite или postgres
+    DATABASE_URL = os.getenv('DATABASE_URL', '')  # postgresql://... для STORAGE_BACKEND=postgres
+    PG_POOL_MIN_SIZE = int(os.getenv('PG_POOL_MIN_SIZE', 1))
+    PG_POOL_MAX_SIZE = int(os.getenv('PG_POOL_MAX_SIZE', 10))  # Верхняя граница соединений
+    PG_POOL_TIMEOUT = 10  # Секунд ожидания свободного соединения
     DB_NAME = "leads.db"
+    ARCHIVE_DB_NAME = os.getenv('ARCHIVE_DB_NAME', 'leads_archive.db')
+
+    # Архивация и обслуживание базы
+    RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 90))  # Закрытые записи старше - в архив
+    RETENTION_BATCH = 500  # Записей в одной транзакции переноса
+    RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', 86400))  # Раз в сутки
+    ANALYZE_ROWS_LIMIT = 1000  # Строк на индекс для выборки ANALYZE (SQLite analysis_limit)
+    VACUUM_PAGES_PER_STEP = 256  # Страниц за шаг incremental_vacuum
+
+    # Резервные копии
+    BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+    BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', 21600))  # Раз в 6 часов
+    BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))  # Сколько снимков хранить
+    BACKUP_PAGES_PER_STEP = 64  # Страниц за один шаг backup API
+    BACKUP_STEP_PAUSE = 0.005  # Пауза между шагами, чтобы не задерживать запись
+
+    # Многопроцессный режим (несколько воркеров с общим состоянием)
+    INSTANCE_COUNT = int(os.getenv('INSTANCE_COUNT', 1))  # Количество воркеров
+    INSTANCE_INDEX = int(os.getenv('INSTANCE_INDEX', 0))  # Номер этого воркера (0..INSTANCE_COUNT-1)
+    INSTANCE_ID = os.getenv('INSTANCE_ID', f"{socket.gethostname()}-{os.getpid()}")
+    SHARED_STATE_URL = os.getenv('SHARED_STATE_URL', '')  # redis://...; пусто - хранилище в памяти процесса
+    LEADER_LOCK_TTL = 30  # Секунд, через которые лидерство истекает без продления
+    LEADER_RENEW_INTERVAL = 10  # Как часто продлевать/захватывать лидерство
+    PERSISTENCE_UPDATE_INTERVAL = 2  # Как часто сохранять user_data в общее хранилище
+    MANAGER_CACHE_TTL = 60  # Секунд жизни кэша списка менеджеров
+
+    # Живой дашборд
+    DASHBOARD_MIN_INTERVAL = 1  # Не пересчитывать статистику чаще (сек)
+    DASHBOARD_MAX_STALENESS = 30  # Пересчитывать хотя бы так часто, даже без изменений
+    DASHBOARD_KEEPALIVE = 15  # Комментарий в SSE-потоке, чтобы прокси не рвали соединение
+
+    # Аналитика воронки заявки
+    FUNNEL_FLUSH_INTERVAL = 5  # Как часто записывать накопленные события (сек)
+    FUNNEL_BATCH_SIZE = 500  # Записывать раньше, если накопилось столько событий
+    FUNNEL_RAW_RETENTION_DAYS = int(os.getenv('FUNNEL_RAW_RETENTION_DAYS', 30))  # Сырые события, агрегаты хранятся всегда
+
+    # База знаний: поиск дублей по символьным n-граммам
+    KB_NGRAM = 3  # Длина n-граммы
+    KB_VECTOR_DIM = 2048  # Размер хэшированного вектора n-грамм
+    KB_DUPLICATE_THRESHOLD = float(os.getenv('KB_DUPLICATE_THRESHOLD', 0.85))  # Косинусная близость дубля
+    KB_COMPACT_BATCH = 256  # Строк матрицы сходства за один шаг
+    KB_COMPACT_INTERVAL = int(os.getenv('KB_COMPACT_INTERVAL', 86400))  # Раз в сутки
 
     # Настройки сервера
     PORT = int(os.getenv('PORT', 10000))  # Render использует PORT из env
@@ -45,6 +117,66 @@ class Config:
     PING_URL = os.getenv('RENDER_EXTERNAL_URL', 'https://your-app.onrender.com')
     ENABLE_PING = True  # Включить автопинг
 
+    # Защита от флуда (token bucket на пользователя)
+    RATE_LIMIT_CAPACITY = int(os.getenv('RATE_LIMIT_CAPACITY', 5))  # Сообщений подряд без ожидания
+    RATE_LIMIT_REFILL_RATE = float(os.getenv('RATE_LIMIT_REFILL_RATE', 0.2))  # Токенов в секунду
+    RATE_LIMIT_MAX_USERS = int(os.getenv('RATE_LIMIT_MAX_USERS', 10000))  # Размер LRU-кэша корзин
+    RATE_LIMIT_COOLDOWN = int(os.getenv('RATE_LIMIT_COOLDOWN', 30))  # Первый кулдаун в секундах
+    RATE_LIMIT_MAX_COOLDOWN = int(os.getenv('RATE_LIMIT_MAX_COOLDOWN', 3600))  # Потолок кулдауна
+    RATE_LIMIT_STRIKE_RESET = int(os.getenv('RATE_LIMIT_STRIKE_RESET', 3600))  # Через сколько забываем нарушения
+
+    # Дайджест уведомлений менеджерам
+    DIGEST_INTERVAL_OPTIONS = [0, 5, 15, 60]  # Минуты, 0 - мгновенные уведомления
+    DIGEST_CHECK_INTERVAL = 60  # Как часто проверять, не пора ли отправить дайджест (сек)
+    DIGEST_URGENT_EVENTS = [e for e in os.getenv('DIGEST_URGENT_EVENTS', 'contact').split(',') if e]  # request, question, contact
+    DIGEST_MAX_BUTTONS = 5  # Кнопок "Ответить" в одном дайджесте
+
+    # Распределение заявок и вопросов между менеджерами
+    ASSIGNMENT_MODE = os.getenv('ASSIGNMENT_MODE', 'round_robin')  # round_robin, least_loaded, sticky
+    ASSIGNMENT_TIMEOUT = int(os.getenv('ASSIGNMENT_TIMEOUT', 3600))  # Через сколько секунд переназначать
+    ASSIGNMENT_CHECK_INTERVAL = 300  # Как часто искать просроченные назначения (сек)
+    ASSIGNMENT_BATCH = 50  # Максимум переназначений за один проход
+
+    # Массовые действия в админ-панели
+    ADMIN_PAGE_SIZE = 10  # Заявок или вопросов на одной странице
+    NOTIFY_RATE = float(os.getenv('NOTIFY_RATE', 25))  # Сообщений в секунду (лимит Telegram - около 30)
+    NOTIFY_BURST = 5  # Сколько сообщений можно отправить подряд без ожидания
+    NOTIFY_WORKERS = 4  # Одновременных запросов к Telegram
+    NOTIFY_MAX_RETRIES = 3  # Повторов после ответа 429
+    BULK_PROGRESS_INTERVAL = 3  # Не обновлять сообщение о прогрессе чаще (сек)
+
+    # Пользователи и рассылки
+    USER_FLUSH_INTERVAL = 5  # Как часто записывать накопленных пользователей (сек)
+    USER_BATCH_SIZE = 500  # Записывать раньше, если накопилось столько пользователей
+    BROADCAST_BATCH = int(os.getenv('BROADCAST_BATCH', 200))  # Получателей в пачке: курсор и статусы пишутся раз в пачку
+    BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))  # Одновременных отправок, скорость ограничена NOTIFY_RATE
+    BROADCAST_PROGRESS_INTERVAL = 5  # Не обновлять сообщение о прогрессе чаще (сек)
+    BROADCAST_CHECK_INTERVAL = 30  # Как часто лидер подхватывает новые и прерванные рассылки
+
+    # Логирование (запись в фоновом потоке)
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json или text
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_QUEUE_SIZE = 10000  # Записей в очереди; при переполнении лишние отбрасываются
+    LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'httpx=0.1,updates=0.1')  # Доля записей INFO от логгера
+    LOG_SLOW_UPDATE_MS = int(os.getenv('LOG_SLOW_UPDATE_MS', 1000))  # Медленные апдейты пишутся всегда и видны в /profile
+
+    # Профилирование по запросу (/profile и /debug/profile)
+    PROFILE_INTERVAL = 0.01  # Секунд между снимками стеков
+    PROFILE_MAX_SECONDS = 120  # Максимальное окно профилирования
+    PROFILE_TOP = 15  # Функций в отчёте
+    PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')  # Токен для /debug/profile; пусто - эндпоинт выключен
+    SLOW_UPDATE_LOG_SIZE = 50  # Сколько последних медленных апдейтов хранить
+
+    # Транспорт Bot API: отдельные пулы соединений для getUpdates и исходящих запросов
+    TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', 32))  # Соединений для ответов, уведомлений и рассылок
+    TELEGRAM_UPDATES_POOL_SIZE = 1  # getUpdates - один долгий запрос за раз
+    TELEGRAM_HTTP_VERSION = os.getenv('TELEGRAM_HTTP_VERSION', '1.1')  # 1.1 или 2 (нужен python-telegram-bot[http2])
+    TELEGRAM_CONNECT_TIMEOUT = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', 5))
+    TELEGRAM_READ_TIMEOUT = float(os.getenv('TELEGRAM_READ_TIMEOUT', 5))
+    TELEGRAM_WRITE_TIMEOUT = float(os.getenv('TELEGRAM_WRITE_TIMEOUT', 5))
+    TELEGRAM_POOL_TIMEOUT = float(os.getenv('TELEGRAM_POOL_TIMEOUT', 3))  # Ожидание свободного соединения при всплеске
+    TRANSPORT_LATENCY_WINDOW = 1000  # Последних запросов на метод для перцентилей задержки
+
     @staticmethod
     def get_webhook_url():
         """Получение URL для вебхука"""
@@ -64,66 +196,493 @@ class Config:
             return "https://your-domain.com"
 
 # ===== НАСТРОЙКА ЛОГГИРОВАНИЯ =====
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Поля текущего апдейта - попадают в каждую запись, сделанную во время его обработки
+log_user_id = contextvars.ContextVar('log_user_id', default=None)
+log_update_id = contextvars.ContextVar('log_update_id', default=None)
+log_handler = contextvars.ContextVar('log_handler', default=None)
+
+def parse_log_sampling(value: str) -> dict:
+    """'httpx=0.1,updates=0.05' -> {'httpx': 0.1, 'updates': 0.05}"""
+    rates = {}
+    for item in value.split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+class ContextFilter(logging.Filter):
+    """Копирует поля апдейта в запись - в потоке, который пишет лог, пока контекст ещё доступен"""
+
+    def filter(self, record):
+        record.user_id = log_user_id.get()
+        record.update_id = log_update_id.get()
+        record.handler = log_handler.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю записей INFO и ниже от шумных логгеров; WARNING и выше - всегда.
+
+    Правило задаётся именем логгера или его последним компонентом: 'updates'
+    подходит и для 'main.updates', и для '__main__.updates'.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self._cache = {}  # Имя логгера -> доля
+
+    def _rate(self, name: str) -> float:
+        rate = self._cache.get(name)
+        if rate is None:
+            rate, best = 1.0, -1
+            parts = name.split('.')
+            for key, value in self.rates.items():
+                key_parts = key.split('.')
+                # Совпадение с началом имени или с его хвостом
+                if parts[:len(key_parts)] == key_parts or parts[-len(key_parts):] == key_parts:
+                    if len(key_parts) > best:
+                        rate, best = value, len(key_parts)
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1:
+            return True
+        record.sample_rate = rate
+        return random.random() < rate
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+    FIELDS = ('user_id', 'update_id', 'handler', 'duration_ms', 'sample_rate')
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь без форматирования и без ожидания.
+
+    Сообщение собирается из аргументов уже в потоке слушателя, поэтому в лог
+    передаются значения, которые после вызова не меняются. Если очередь
+    переполнена (поток вывода не успевает), запись отбрасывается и считается.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogQueueListener(logging.handlers.QueueListener):
+    """При остановке ждёт места в очереди: стандартный слушатель падает, если она заполнена"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+log_listener = None
+log_queue_handler = None
+
+def setup_logging():
+    """Логи пишет фоновый поток: на цикле событий вызов logger.* только кладёт запись в очередь.
+
+    Вызывается из main() и run_cli(): импорт модуля не трогает корневой логгер и не запускает поток.
+    """
+    global log_listener, log_queue_handler
+    if log_listener is not None:
+        return
+    stream = logging.StreamHandler()
+    if Config.LOG_FORMAT == 'json':
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue_handler = LogQueueHandler(queue.Queue(Config.LOG_QUEUE_SIZE))
+    log_queue_handler.addFilter(SamplingFilter(parse_log_sampling(Config.LOG_SAMPLING)))
+    log_queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [log_queue_handler]
+    root.setLevel(Config.LOG_LEVEL)
+
+    log_listener = LogQueueListener(log_queue_handler.queue, stream, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток вывода"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+def get_logging_stats() -> dict:
+    if log_queue_handler is None:
+        return {}
+    return {
+        'queued': log_queue_handler.queue.qsize(),
+        'dropped': log_queue_handler.dropped,
+    }
+
 logger = logging.getLogger(__name__)
+# Шумные события - в отдельных логгерах, чтобы их можно было сэмплировать (LOG_SAMPLING)
+update_logger = logger.getChild('updates')
+notify_logger = logger.getChild('notify')
+ping_logger = logger.getChild('ping')
+
+# Время текущего апдейта в БД и в запросах к Telegram: {'db': сек, 'db_calls': n, ...}.
+# Словарь общий для задач и потоков asyncio.to_thread, запущенных из обработчика
+update_timings = contextvars.ContextVar('update_timings', default=None)
+timing_kind = contextvars.ContextVar('timing_kind', default=None)
+
+@contextmanager
+def track_time(kind: str):
+    """Добавляет время блока к текущему апдейту ('db' или 'telegram'); вложенные блоки не считаются дважды"""
+    timings = update_timings.get()
+    if timings is None or timing_kind.get() is not None:
+        yield
+        return
+    token = timing_kind.set(kind)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[kind] += time.perf_counter() - started
+        timings[kind + '_calls'] += 1
+        timing_kind.reset(token)
+
+def clear_log_context():
+    """Для долгоживущих задач: они наследуют контекст апдейта, в котором были созданы"""
+    log_user_id.set(None)
+    log_update_id.set(None)
+    log_handler.set(None)
+    update_timings.set(None)
+
+def log_context(callback):
+    """Обработчик апдейта с полями user_id/update_id/handler в логах и записью длительности.
+
+    Медленные апдейты попадают в slow_update_log с разбивкой на БД, Telegram и код.
+    """
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user if isinstance(update, Update) else None
+        timings = {'db': 0.0, 'db_calls': 0, 'telegram': 0.0, 'telegram_calls': 0}
+        tokens = (
+            log_user_id.set(user.id if user else None),
+            log_update_id.set(getattr(update, 'update_id', None)),
+            log_handler.set(callback.__name__),
+            update_timings.set(timings),
+        )
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            duration = time.perf_counter() - started
+            duration_ms = round(duration * 1000, 1)
+            if duration_ms >= Config.LOG_SLOW_UPDATE_MS:
+                entry = slow_update_log.record(callback.__name__, update, duration, timings)
+                update_logger.warning(
+                    "Медленная обработка апдейта: %s мс (БД %s мс, Telegram %s мс, код %s мс)",
+                    duration_ms, entry['db_ms'], entry['telegram_ms'], entry['compute_ms'],
+                    extra={'duration_ms': duration_ms}
+                )
+            else:
+                update_logger.info("Апдейт обработан за %s мс", duration_ms, extra={'duration_ms': duration_ms})
+            for var, token in zip((log_user_id, log_update_id, log_handler, update_timings), tokens):
+                var.reset(token)
+    wrapper.__name__ = callback.__name__
+    return wrapper
+
+# ===== ОБЩЕЕ ХРАНИЛИЩЕ =====
+class LocalStore:
+    """In-process замена Redis с тем же набором операций (один процесс и тесты)"""
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Condition()
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, ttl=None, nx=False):
+        with self._lock:
+            if nx and self._alive(key):
+                return False
+            self._data[key] = value
+            if ttl:
+                self._expires[key] = time.time() + ttl
+            else:
+                self._expires.pop(key, None)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._data.get(key, 0) if self._alive(key) else 0) + 1
+            self._data[key] = value
+            return value
+
+    def keys(self, pattern):
+        with self._lock:
+            return [key for key in list(self._data) if fnmatch.fnmatchcase(key, pattern) and self._alive(key)]
+
+    def push(self, key, value):
+        with self._lock:
+            self._data.setdefault(key, []).append(value)
+            self._lock.notify_all()
+
+    def pop(self, key, timeout):
+        """Блокирующее извлечение из начала списка, None по таймауту"""
+        deadline = time.time() + timeout
+        with self._lock:
+            while not self._data.get(key):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+            return self._data[key].pop(0)
+
+    def pop_all(self, key):
+        with self._lock:
+            return self._data.pop(key, None) or []
+
+    def acquire_lock(self, key, owner, ttl):
+        """Захват или продление блокировки владельцем"""
+        with self._lock:
+            if self._alive(key) and self._data[key] != owner:
+                return False
+            self._data[key] = owner
+            self._expires[key] = time.time() + ttl
+            return True
+
+    def release_lock(self, key, owner):
+        with self._lock:
+            if self._alive(key) and self._data[key] == owner:
+                self.delete(key)
+
+class RedisStore:
+    """Общее хранилище на Redis для нескольких воркеров"""
+
+    # Захват или продление блокировки только её владельцем
+    ACQUIRE_SCRIPT = """
+    local current = redis.call('GET', KEYS[1])
+    if current == false or current == ARGV[1] then
+        redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+        return 1
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("Для SHARED_STATE_URL нужен пакет redis: pip install redis")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._acquire = self.client.register_script(self.ACQUIRE_SCRIPT)
+        self._release = self.client.register_script(self.RELEASE_SCRIPT)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None, nx=False):
+        return bool(self.client.set(key, value, ex=ttl, nx=nx))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def keys(self, pattern):
+        return list(self.client.scan_iter(match=pattern, count=500))
+
+    def push(self, key, value):
+        self.client.rpush(key, value)
+
+    def pop(self, key, timeout):
+        item = self.client.blpop([key], timeout=timeout)
+        return item[1] if item else None
+
+    def pop_all(self, key):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        return pipe.execute()[0]
+
+    def acquire_lock(self, key, owner, ttl):
+        return bool(self._acquire(keys=[key], args=[owner, ttl]))
+
+    def release_lock(self, key, owner):
+        self._release(keys=[key], args=[owner])
+
+def create_shared_store():
+    if Config.SHARED_STATE_URL:
+        return RedisStore(Config.SHARED_STATE_URL)
+    if Config.INSTANCE_COUNT > 1:
+        # Каждый воркер стал бы лидером сам для себя: несколько getUpdates и задачи по разу в каждом процессе
+        raise RuntimeError("INSTANCE_COUNT > 1 требует SHARED_STATE_URL (Redis)")
+    return LocalStore()
+
+shared_store = create_shared_store()
 
 # ===== БАЗА ДАННЫХ =====
+class Transaction:
+    """Курсор одной транзакции с общим интерфейсом для всех бэкендов.
+
+    SQL во всех методах Database пишется с плейсхолдерами "?".
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def _sql(self, sql: str):
+        return sql
+
+    def execute(self, sql: str, params=()):
+        self.cursor.execute(self._sql(sql), params)
+        return self.cursor.rowcount
+
+    def executemany(self, sql: str, seq_of_params):
+        self.cursor.executemany(self._sql(sql), seq_of_params)
+
+    def query(self, sql: str, params=()):
+        self.cursor.execute(self._sql(sql), params)
+        return self.cursor.fetchall()
+
+    def query_one(self, sql: str, params=()):
+        self.cursor.execute(self._sql(sql), params)
+        return self.cursor.fetchone()
+
+    def insert(self, sql: str, params=()):
+        """INSERT одной строки, возвращает id"""
+        self.cursor.execute(self._sql(sql), params)
+        return self.cursor.lastrowid
+
 class Database:
+    """Общая логика хранилища. Подключение, схема и диалект - в наследниках"""
+
+    # Диалект SQL (переопределяется бэкендом)
+    MAIN_SCHEMA = 'main'
+    SQL_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"  # С миллисекундами, как NOW() в PostgreSQL
+    SQL_NOW_MINUS = "datetime('now', ?)"  # Параметр вида '-N seconds' / '-N days'
+    SQL_TODAY_MINUS = "date('now', ?)"  # Начало дня N дней назад
+    # LIKE и lower() в SQLite не учитывают регистр только для латиницы - сравниваем через unicode_lower
+    SQL_ILIKE = "unicode_lower({column}) LIKE unicode_lower(?)"
+    supports_file_backup = False
+
+    # Версия схемы: увеличивать при каждом изменении create_tables
+    SCHEMA_VERSION = 3
+
+    # Явные списки колонок - одинаковые для рабочих и архивных таблиц
+    REQUEST_COLUMNS = "id, user_id, username, contact, business_type, bot_tasks, status, created_at, assigned_to, assigned_at"
+    QUESTION_COLUMNS = "id, user_id, username, question, answer, status, created_at, assigned_to, assigned_at"
+
+    # Тип элемента -> (таблица, колонки, условие "закрыт")
+    ARCHIVABLE = {
+        'request': ('requests', REQUEST_COLUMNS, "status IN ('accepted', 'rejected')"),
+        'question': ('questions', QUESTION_COLUMNS, "answer IS NOT NULL")
+    }
+
+    # Тип элемента -> (условие "открыт", колонки для поиска в массовых действиях)
+    BULK_FILTERABLE = {
+        'request': ("status = 'new'", ('username', 'contact', 'business_type', 'bot_tasks')),
+        'question': ("answer IS NULL", ('username', 'question'))
+    }
+
     def __init__(self):
-        self.conn = sqlite3.connect(Config.DB_NAME, check_same_thread=False)
-        self.create_tables()
+        self.archive_attached = False
+        self._change_listeners = []
+        # Актуальная база открывается без CREATE/ALTER и чтения её структуры
+        version = self.get_schema_version()
+        if version < self.SCHEMA_VERSION:
+            self.create_tables()
+            self.set_schema_version(self.SCHEMA_VERSION)
+            logger.info("Схема базы обновлена: %s -> %s", version, self.SCHEMA_VERSION)
+
+    def add_change_listener(self, callback):
+        """callback() вызывается после изменений заявок, вопросов и менеджеров"""
+        self._change_listeners.append(callback)
+
+    def _changed(self):
+        for callback in self._change_listeners:
+            callback()
+
+    # Примитивы поверх transaction()
+    def transaction(self):
+        raise NotImplementedError
+
+    def _query(self, sql: str, params=()):
+        with self.transaction() as tx:
+            return tx.query(sql, params)
+
+    def _query_one(self, sql: str, params=()):
+        with self.transaction() as tx:
+            return tx.query_one(sql, params)
+
+    def _execute(self, sql: str, params=()):
+        with self.transaction() as tx:
+            return tx.execute(sql, params)
+
+    def _insert(self, sql: str, params=()):
+        with self.transaction() as tx:
+            return tx.insert(sql, params)
 
     def create_tables(self):
-        c = self.conn.cursor()
-
-        # Таблица заявок
-        c.execute('''CREATE TABLE IF NOT EXISTS requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            username TEXT,
-            contact TEXT NOT NULL,
-            business_type TEXT,
-            bot_tasks TEXT,
-            status TEXT DEFAULT 'new',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-
-        # Таблица вопросов
-        c.execute('''CREATE TABLE IF NOT EXISTS questions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            username TEXT,
-            question TEXT NOT NULL,
-            answer TEXT,
-            status TEXT DEFAULT 'new',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-
-        # Таблица знаний
-        c.execute('''CREATE TABLE IF NOT EXISTS knowledge_base (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            question TEXT NOT NULL,
-            answer TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-
-        # Таблица менеджеров
-        c.execute('''CREATE TABLE IF NOT EXISTS managers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE NOT NULL,
-            username TEXT,
-            is_active BOOLEAN DEFAULT TRUE
-        )''')
-
-        self.conn.commit()
+        raise NotImplementedError
+
+    def get_schema_version(self) -> int:
+        raise NotImplementedError
+
+    def set_schema_version(self, version: int):
+        raise NotImplementedError
+
+    def close(self):
+        pass
 
     # Методы для заявок
     def add_request(self, user_data: dict):
-        c = self.conn.cursor()
-        c.execute('''INSERT INTO requests 
+        request_id = self._insert('''INSERT INTO requests 
                     (user_id, username, contact, business_type, bot_tasks)
                     VALUES (?, ?, ?, ?, ?)''',
                   (user_data['user_id'], 
@@ -131,129 +690,906 @@ class Database:
                    user_data['contact'],
                    user_data.get('business_type', ''),
                    user_data.get('bot_tasks', '')))
-        self.conn.commit()
-        return c.lastrowid
+        self._changed()
+        return request_id
 
     def get_requests(self, status='new'):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM requests WHERE status = ? ORDER BY created_at DESC", (status,))
-        return c.fetchall()
+        return self._query(f"SELECT {self.REQUEST_COLUMNS} FROM requests WHERE status = ? ORDER BY created_at DESC", (status,))
 
     def update_request_status(self, request_id: int, status: str):
-        c = self.conn.cursor()
-        c.execute("UPDATE requests SET status = ? WHERE id = ?", (status, request_id))
-        self.conn.commit()
+        self._execute("UPDATE requests SET status = ? WHERE id = ?", (status, request_id))
+        self._changed()
 
     def get_request_by_id(self, request_id: int):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM requests WHERE id = ?", (request_id,))
-        return c.fetchone()
+        return self._query_one(f"SELECT {self.REQUEST_COLUMNS} FROM requests WHERE id = ?", (request_id,))
 
     # Методы для вопросов
     def add_question(self, user_id: int, username: str, question: str):
-        c = self.conn.cursor()
-        c.execute('''INSERT INTO questions 
+        question_id = self._insert('''INSERT INTO questions 
                     (user_id, username, question)
                     VALUES (?, ?, ?)''',
                   (user_id, username, question))
-        self.conn.commit()
-        return c.lastrowid
+        self._changed()
+        return question_id
 
     def get_questions(self, answered=False):
-        c = self.conn.cursor()
         if answered:
-            c.execute("SELECT * FROM questions WHERE answer IS NOT NULL ORDER BY created_at DESC")
+            return self._query(f"SELECT {self.QUESTION_COLUMNS} FROM questions WHERE answer IS NOT NULL ORDER BY created_at DESC")
         else:
-            c.execute("SELECT * FROM questions WHERE answer IS NULL ORDER BY created_at DESC")
-        return c.fetchall()
+            return self._query(f"SELECT {self.QUESTION_COLUMNS} FROM questions WHERE answer IS NULL ORDER BY created_at DESC")
 
     def answer_question(self, question_id: int, answer: str):
-        c = self.conn.cursor()
-        c.execute("UPDATE questions SET answer = ?, status = 'answered' WHERE id = ?", (answer, question_id))
-        self.conn.commit()
+        self._execute("UPDATE questions SET answer = ?, status = 'answered' WHERE id = ?", (answer, question_id))
+        self._changed()
 
     def get_question_by_id(self, question_id: int):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM questions WHERE id = ?", (question_id,))
-        return c.fetchone()
+        return self._query_one(f"SELECT {self.QUESTION_COLUMNS} FROM questions WHERE id = ?", (question_id,))
+
+    def _search_filter(self, columns, pattern: str):
+        """Условие "подстрока pattern в одной из колонок" без учёта регистра, % и _ экранируются"""
+        escaped = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        condition = '(' + ' OR '.join(f"{self.SQL_ILIKE.format(column=column)} ESCAPE '\\'" for column in columns) + ')'
+        return condition, [f'%{escaped}%'] * len(columns)
+
+    # Массовые операции: вся выборка обрабатывается одной командой UPDATE
+    def _open_items_filter(self, kind: str, pattern: str = None, manager_id: int = None, item_ids=None):
+        """WHERE для открытых элементов: поиск по тексту, назначенные менеджеру, конкретные id"""
+        open_condition, search_columns = self.BULK_FILTERABLE[kind]
+        conditions, params = [open_condition], []
+        if pattern:
+            condition, search_params = self._search_filter(search_columns, pattern)
+            conditions.append(condition)
+            params.extend(search_params)
+        if manager_id is not None:
+            conditions.append("(assigned_to IS NULL OR assigned_to = ?)")
+            params.append(manager_id)
+        if item_ids is not None:
+            conditions.append(f"id IN ({', '.join('?' * len(item_ids))})" if item_ids else "1 = 0")
+            params.extend(item_ids)
+        return ' AND '.join(conditions), params
+
+    def get_open_page(self, kind: str, before_id: int = None, limit: int = 10, pattern: str = None, manager_id: int = None):
+        """Страница открытых элементов, новые первыми (keyset по id)"""
+        table, columns, _ = self.ARCHIVABLE[kind]
+        where, params = self._open_items_filter(kind, pattern, manager_id)
+        if before_id is not None:
+            where += " AND id < ?"
+            params.append(before_id)
+        return self._query(f"SELECT {columns} FROM {table} WHERE {where} ORDER BY id DESC LIMIT ?", (*params, limit))
+
+    def count_open(self, kind: str, pattern: str = None, manager_id: int = None):
+        where, params = self._open_items_filter(kind, pattern, manager_id)
+        return self._query_one(f"SELECT COUNT(*) FROM {self.ARCHIVABLE[kind][0]} WHERE {where}", params)[0]
+
+    def bulk_set_request_status(self, status: str, request_ids=None, pattern: str = None, manager_id: int = None):
+        """Закрывает все подходящие новые заявки, возвращает [(id, user_id, assigned_to)]"""
+        where, params = self._open_items_filter('request', pattern, manager_id, request_ids)
+        rows = self._query(f"UPDATE requests SET status = ? WHERE {where} RETURNING id, user_id, assigned_to",
+                           (status, *params))
+        if rows:
+            self._changed()
+        return rows
+
+    def bulk_answer_questions(self, answer: str, question_ids=None, pattern: str = None, manager_id: int = None):
+        """Отвечает на все подходящие открытые вопросы, возвращает [(id, user_id, assigned_to)]"""
+        where, params = self._open_items_filter('question', pattern, manager_id, question_ids)
+        rows = self._query(f"UPDATE questions SET answer = ?, status = 'answered' WHERE {where} RETURNING id, user_id, assigned_to",
+                           (answer, *params))
+        if rows:
+            self._changed()
+        return rows
 
     # Методы для базы знаний
     def add_to_knowledge_base(self, question: str, answer: str):
-        c = self.conn.cursor()
-        c.execute("INSERT INTO knowledge_base (question, answer) VALUES (?, ?)", (question, answer))
-        self.conn.commit()
+        return self._insert("INSERT INTO knowledge_base (question, answer) VALUES (?, ?)", (question, answer))
+
+    def get_knowledge_index_rows(self):
+        """Записи (id, question, answer) от новых к старым и псевдонимы (entry_id, question)"""
+        with self.transaction() as tx:
+            entries = tx.query("SELECT id, question, answer FROM knowledge_base ORDER BY created_at DESC, id DESC")
+            aliases = tx.query("SELECT entry_id, question FROM knowledge_aliases ORDER BY id")
+        return entries, aliases
+
+    def refresh_knowledge_entry(self, entry_id: int, answer: str, alias: str = None):
+        """Новый ответ на уже известный вопрос: запись становится самой свежей, формулировка - псевдонимом"""
+        with self.transaction() as tx:
+            tx.execute(f"UPDATE knowledge_base SET answer = ?, created_at = {self.SQL_NOW} WHERE id = ?", (answer, entry_id))
+            if alias is not None:
+                tx.execute("INSERT INTO knowledge_aliases (entry_id, question) VALUES (?, ?)", (entry_id, alias))
+
+    def merge_knowledge_entries(self, clusters: list):
+        """[(canonical_id, [duplicate_id, ...])]: дубли становятся псевдонимами, всё в одной транзакции"""
+        with self.transaction() as tx:
+            for canonical_id, duplicate_ids in clusters:
+                placeholders = ', '.join('?' * len(duplicate_ids))
+                tx.execute(f'''INSERT INTO knowledge_aliases (entry_id, question)
+                            SELECT ?, question FROM knowledge_base WHERE id IN ({placeholders})''',
+                           (canonical_id, *duplicate_ids))
+                tx.execute(f"UPDATE knowledge_aliases SET entry_id = ? WHERE entry_id IN ({placeholders})",
+                           (canonical_id, *duplicate_ids))
+                tx.execute(f"DELETE FROM knowledge_base WHERE id IN ({placeholders})", duplicate_ids)
 
     def get_knowledge_base(self):
-        c = self.conn.cursor()
-        c.execute("SELECT question, answer FROM knowledge_base ORDER BY created_at DESC")
-        return c.fetchall()
+        return self._query("SELECT question, answer FROM knowledge_base ORDER BY created_at DESC")
+
+    def get_knowledge_entries(self, limit: int = 10):
+        return self._query("SELECT id, question, answer FROM knowledge_base ORDER BY id DESC LIMIT ?", (limit,))
+
+    def get_knowledge_entry(self, entry_id: int):
+        return self._query_one("SELECT id, question, answer FROM knowledge_base WHERE id = ?", (entry_id,))
+
+    def _knowledge_filter(self, pattern: str = None):
+        """WHERE для поиска по вопросу, ответу и другим формулировкам записи"""
+        if not pattern:
+            return "1 = 1", []
+        condition, params = self._search_filter(('question', 'answer'), pattern)
+        alias_condition, alias_params = self._search_filter(('question',), pattern)
+        return (f"({condition} OR id IN (SELECT entry_id FROM knowledge_aliases WHERE {alias_condition}))",
+                params + alias_params)
+
+    def get_knowledge_page(self, before_id: int = None, limit: int = 10, pattern: str = None):
+        """Страница базы знаний, новые первыми (keyset по id)"""
+        where, params = self._knowledge_filter(pattern)
+        if before_id is not None:
+            where += " AND id < ?"
+            params.append(before_id)
+        return self._query(f"SELECT id, question, answer FROM knowledge_base WHERE {where} ORDER BY id DESC LIMIT ?",
+                           (*params, limit))
+
+    def count_knowledge(self, pattern: str = None):
+        where, params = self._knowledge_filter(pattern)
+        return self._query_one(f"SELECT COUNT(*) FROM knowledge_base WHERE {where}", params)[0]
+
+    def get_knowledge_aliases(self, entry_id: int, limit: int = 5):
+        return [row[0] for row in self._query(
+            "SELECT question FROM knowledge_aliases WHERE entry_id = ? ORDER BY id DESC LIMIT ?", (entry_id, limit))]
+
+    def update_knowledge_entry(self, entry_id: int, question: str = None, answer: str = None):
+        """Меняет вопрос и/или ответ записи, возвращает число изменённых строк"""
+        return self._execute("UPDATE knowledge_base SET question = COALESCE(?, question), answer = COALESCE(?, answer) WHERE id = ?",
+                             (question, answer, entry_id))
+
+    def delete_knowledge_entry(self, entry_id: int):
+        """Удаляет запись вместе с её формулировками, возвращает число удалённых записей"""
+        with self.transaction() as tx:
+            tx.execute("DELETE FROM knowledge_aliases WHERE entry_id = ?", (entry_id,))
+            return tx.execute("DELETE FROM knowledge_base WHERE id = ?", (entry_id,))
 
     # Методы для напоминаний
     def get_inactive_leads(self, days=2):
-        c = self.conn.cursor()
-        c.execute('''SELECT * FROM requests 
+        # Заявки, созданные не позже чем days дней назад (по календарным дням)
+        return self._query(f'''SELECT {self.REQUEST_COLUMNS} FROM requests 
                     WHERE status = 'new' 
-                    AND date(created_at) <= date('now', ?)''', (f'-{days} days',))
-        return c.fetchall()
+                    AND created_at < {self.SQL_TODAY_MINUS}''', (f'-{days - 1} days',))
 
     # Методы для статистики
-    def get_stats(self):
-        c = self.conn.cursor()
+    def get_stats(self, include_archive=False):
         stats = {}
+        if include_archive:
+            self.attach_archive()
+        with self.transaction() as tx:
+            if include_archive:
+                stats['archived_requests'] = tx.query_one("SELECT COUNT(*) FROM archive.requests")[0]
+                stats['archived_questions'] = tx.query_one("SELECT COUNT(*) FROM archive.questions")[0]
 
-        # Общее количество заявок
-        c.execute("SELECT COUNT(*) FROM requests")
-        stats['total_requests'] = c.fetchone()[0]
+            # Общее количество заявок
+            stats['total_requests'] = tx.query_one("SELECT COUNT(*) FROM requests")[0]
 
-        # Новые заявки
-        c.execute("SELECT COUNT(*) FROM requests WHERE status = 'new'")
-        stats['new_requests'] = c.fetchone()[0]
+            # Новые заявки
+            stats['new_requests'] = tx.query_one("SELECT COUNT(*) FROM requests WHERE status = 'new'")[0]
 
-        # Принятые заявки
-        c.execute("SELECT COUNT(*) FROM requests WHERE status = 'accepted'")
-        stats['accepted_requests'] = c.fetchone()[0]
+            # Принятые заявки
+            stats['accepted_requests'] = tx.query_one("SELECT COUNT(*) FROM requests WHERE status = 'accepted'")[0]
 
-        # Общее количество вопросов
-        c.execute("SELECT COUNT(*) FROM questions")
-        stats['total_questions'] = c.fetchone()[0]
+            # Общее количество вопросов
+            stats['total_questions'] = tx.query_one("SELECT COUNT(*) FROM questions")[0]
 
-        # Неотвеченные вопросы
-        c.execute("SELECT COUNT(*) FROM questions WHERE answer IS NULL")
-        stats['unanswered_questions'] = c.fetchone()[0]
+            # Неотвеченные вопросы
+            stats['unanswered_questions'] = tx.query_one("SELECT COUNT(*) FROM questions WHERE answer IS NULL")[0]
 
-        # Количество менеджеров
-        c.execute("SELECT COUNT(*) FROM managers WHERE is_active = TRUE")
-        stats['active_managers'] = c.fetchone()[0]
+            # Количество менеджеров
+            stats['active_managers'] = tx.query_one("SELECT COUNT(*) FROM managers WHERE is_active = TRUE")[0]
 
         return stats
 
     # Методы для менеджеров
     def add_manager(self, user_id: int, username: str):
-        c = self.conn.cursor()
-        try:
-            c.execute("INSERT INTO managers (user_id, username) VALUES (?, ?)", (user_id, username))
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+        added = self._execute('''INSERT INTO managers (user_id, username) VALUES (?, ?)
+                    ON CONFLICT (user_id) DO NOTHING''', (user_id, username)) > 0
+        if added:
+            self._changed()
+        return added
 
     def get_active_managers(self):
-        c = self.conn.cursor()
-        c.execute("SELECT user_id FROM managers WHERE is_active = TRUE")
-        return [row[0] for row in c.fetchall()]
+        return [row[0] for row in self._query("SELECT user_id FROM managers WHERE is_active = TRUE")]
+
+    def get_manager_digest_settings(self):
+        rows = self._query("SELECT user_id, digest_interval FROM managers WHERE is_active = TRUE")
+        return [(row[0], row[1] or 0) for row in rows]
+
+    def get_manager_digest_interval(self, user_id: int):
+        row = self._query_one("SELECT digest_interval FROM managers WHERE user_id = ?", (user_id,))
+        return (row[0] or 0) if row else None
+
+    def set_manager_digest_interval(self, user_id: int, minutes: int):
+        return self._execute("UPDATE managers SET digest_interval = ? WHERE user_id = ?", (minutes, user_id)) > 0
 
     def remove_manager(self, user_id: int):
-        c = self.conn.cursor()
-        c.execute("DELETE FROM managers WHERE user_id = ?", (user_id,))
-        self.conn.commit()
+        self._execute("DELETE FROM managers WHERE user_id = ?", (user_id,))
+        self._changed()
 
     def is_manager(self, user_id: int):
-        c = self.conn.cursor()
-        c.execute("SELECT COUNT(*) FROM managers WHERE user_id = ? AND is_active = TRUE", (user_id,))
-        return c.fetchone()[0] > 0
+        return self._query_one("SELECT COUNT(*) FROM managers WHERE user_id = ? AND is_active = TRUE", (user_id,))[0] > 0
+
+    # Методы для архива и обслуживания
+    def attach_archive(self):
+        """Делает доступной схему archive (реализуется бэкендом)"""
+        self.archive_attached = True
+
+    def archive_batch(self, kind: str, days: int, batch_size: int):
+        """Переносит одну пачку закрытых записей старше days в архив. Возвращает количество"""
+        table, columns, closed_condition = self.ARCHIVABLE[kind]
+        self.attach_archive()
+        with self.transaction() as tx:
+            rows = tx.query(f'''SELECT id FROM {self.MAIN_SCHEMA}.{table}
+                        WHERE {closed_condition} AND created_at <= {self.SQL_NOW_MINUS}
+                        ORDER BY id LIMIT ?''', (f'-{days} days', batch_size))
+            ids = [row[0] for row in rows]
+            if not ids:
+                return 0
+
+            placeholders = ','.join('?' * len(ids))
+            tx.execute(f"DELETE FROM archive.{table} WHERE id IN ({placeholders})", ids)
+            tx.execute(f'''INSERT INTO archive.{table} ({columns})
+                        SELECT {columns} FROM {self.MAIN_SCHEMA}.{table} WHERE id IN ({placeholders})''', ids)
+            tx.execute(f"DELETE FROM {self.MAIN_SCHEMA}.{table} WHERE id IN ({placeholders})", ids)
+        self._changed()
+        return len(ids)
+
+    def get_archived(self, kind: str, limit: int = 50):
+        table, columns, _ = self.ARCHIVABLE[kind]
+        self.attach_archive()
+        return self._query(f"SELECT {columns} FROM archive.{table} ORDER BY created_at DESC LIMIT ?", (limit,))
+
+    def get_size(self):
+        """(размер базы в байтах, из них свободно)"""
+        raise NotImplementedError
+
+    def ensure_incremental_vacuum(self):
+        pass
+
+    def incremental_vacuum(self, pages: int):
+        """Освобождает до pages свободных страниц. Возвращает True, если свободные страницы ещё остались"""
+        return False
+
+    def analyze(self):
+        self._execute("ANALYZE")
+
+    # Методы для аналитики воронки
+    # Гранулярность -> (таблица агрегатов, размер корзины в секундах)
+    FUNNEL_BUCKETS = {
+        'minute': ('funnel_minute', 60),
+        'hour': ('funnel_hour', 3600),
+        'day': ('funnel_day', 86400)
+    }
+
+    def add_funnel_events(self, events: list):
+        """Пачка событий (user_id, event, latency, ts): сырые строки и инкремент агрегатов в одной транзакции"""
+        with self.transaction() as tx:
+            tx.executemany("INSERT INTO funnel_events (user_id, event, latency, ts) VALUES (?, ?, ?, ?)", events)
+
+            for table, size in self.FUNNEL_BUCKETS.values():
+                # Сначала сворачиваем пачку в памяти - одна строка на (корзина, событие)
+                rollup = {}
+                for _, event, latency, ts in events:
+                    row = rollup.setdefault((ts - ts % size, event), [0, 0.0, 0])
+                    row[0] += 1
+                    if latency is not None:
+                        row[1] += latency
+                        row[2] += 1
+                tx.executemany(f'''INSERT INTO {table} (bucket, event, count, latency_sum, latency_count)
+                            VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT (bucket, event) DO UPDATE SET
+                                count = {table}.count + excluded.count,
+                                latency_sum = {table}.latency_sum + excluded.latency_sum,
+                                latency_count = {table}.latency_count + excluded.latency_count''',
+                               [(bucket, event, *values) for (bucket, event), values in rollup.items()])
+
+    def get_funnel_totals(self, granularity: str, since: int, until: int):
+        """Суммы по событиям за период: {event: (count, latency_sum, latency_count)}"""
+        table, _ = self.FUNNEL_BUCKETS[granularity]
+        rows = self._query(f'''SELECT event, CAST(SUM(count) AS BIGINT), SUM(latency_sum), CAST(SUM(latency_count) AS BIGINT) FROM {table}
+                    WHERE bucket >= ? AND bucket < ? GROUP BY event''', (since, until))
+        return {event: (count, latency_sum, latency_count) for event, count, latency_sum, latency_count in rows}
+
+    def get_funnel_series(self, granularity: str, since: int, until: int, events: list):
+        table, _ = self.FUNNEL_BUCKETS[granularity]
+        placeholders = ','.join('?' * len(events))
+        return self._query(f'''SELECT bucket, event, count FROM {table}
+                    WHERE bucket >= ? AND bucket < ? AND event IN ({placeholders})
+                    ORDER BY bucket''', (since, until, *events))
+
+    def prune_funnel_events(self, days: int):
+        return self._execute("DELETE FROM funnel_events WHERE ts < ?", (int(time.time()) - days * 86400,))
+
+    # Методы для пользователей
+    def upsert_users(self, users: list):
+        """Пачка (user_id, username, first_name, ts) одной транзакцией; написавший снова - не заблокировал бота"""
+        with self.transaction() as tx:
+            tx.executemany('''INSERT INTO users (user_id, username, first_name, first_seen, last_seen)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (user_id) DO UPDATE SET
+                            username = excluded.username,
+                            first_name = excluded.first_name,
+                            last_seen = excluded.last_seen,
+                            blocked = 0''',
+                           [(user_id, username, first_name, ts, ts) for user_id, username, first_name, ts in users])
+
+    def count_users(self, include_blocked=False):
+        where = "" if include_blocked else " WHERE blocked = 0"
+        return self._query_one(f"SELECT COUNT(*) FROM users{where}")[0]
+
+    # Методы для рассылок
+    BROADCAST_COLUMNS = "id, text, status, created_by, total, sent, failed, blocked, last_user_id, progress_chat_id, progress_message_id, created_at, finished_at"
+
+    def create_broadcast(self, text: str, created_by: int):
+        """Рассылка всем незаблокировавшим пользователям на момент создания"""
+        with self.transaction() as tx:
+            total = tx.query_one("SELECT COUNT(*) FROM users WHERE blocked = 0")[0]
+            return tx.insert("INSERT INTO broadcasts (text, created_by, total, created_at) VALUES (?, ?, ?, ?)",
+                             (text, created_by, total, int(time.time())))
+
+    def get_broadcast(self, broadcast_id: int):
+        return self._query_one(f"SELECT {self.BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+    def get_broadcasts(self, status: str = None, limit: int = 5):
+        if status:
+            return self._query(f"SELECT {self.BROADCAST_COLUMNS} FROM broadcasts WHERE status = ? ORDER BY id DESC LIMIT ?", (status, limit))
+        return self._query(f"SELECT {self.BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+
+    def set_broadcast_progress_message(self, broadcast_id: int, chat_id: int, message_id: int):
+        self._execute("UPDATE broadcasts SET progress_chat_id = ?, progress_message_id = ? WHERE id = ?",
+                      (chat_id, message_id, broadcast_id))
+
+    def set_broadcast_status(self, broadcast_id: int, status: str):
+        """running -> done/cancelled; возвращает False, если рассылка уже не выполняется"""
+        finished_at = None if status == 'running' else int(time.time())
+        return self._execute("UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+                             (status, finished_at, broadcast_id)) > 0
+
+    def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        """Следующая пачка получателей по курсору user_id (keyset, без OFFSET)"""
+        rows = self._query("SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+                           (after_user_id, limit))
+        return [row[0] for row in rows]
+
+    def claim_broadcast_delivery(self, broadcast_id: int, user_id: int):
+        """Отмечает получателя как pending перед отправкой. False - рассылка ему уже уходила"""
+        return self._execute('''INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, ts) VALUES (?, ?, 'pending', ?)
+                    ON CONFLICT (broadcast_id, user_id) DO NOTHING''', (broadcast_id, user_id, int(time.time()))) > 0
+
+    def release_broadcast_delivery(self, broadcast_id: int, user_id: int):
+        """Снимает отметку pending, если отправка так и не началась"""
+        self._execute("DELETE FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id = ? AND status = 'pending'",
+                      (broadcast_id, user_id))
+
+    def settle_interrupted_deliveries(self, broadcast_id: int):
+        """pending от прерванного запуска: запрос мог уйти, но ответ не получен - не повторяем, считаем ошибкой"""
+        with self.transaction() as tx:
+            count = tx.execute("UPDATE broadcast_deliveries SET status = 'interrupted' WHERE broadcast_id = ? AND status = 'pending'",
+                               (broadcast_id,))
+            if count:
+                tx.execute("UPDATE broadcasts SET failed = failed + ? WHERE id = ?", (count, broadcast_id))
+        return count
+
+    def record_broadcast_batch(self, broadcast_id: int, last_user_id: int, results: list):
+        """Статусы доставки пачки [(user_id, status)], курсор и счётчики - в одной транзакции.
+
+        last_user_id=None оставляет курсор на месте (пачка отправлена не полностью).
+        """
+        ts = int(time.time())
+        counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+        for _, status in results:
+            counts[status] += 1
+        with self.transaction() as tx:
+            tx.executemany('''INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, ts) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (broadcast_id, user_id) DO UPDATE SET status = excluded.status, ts = excluded.ts''',
+                           [(broadcast_id, user_id, status, ts) for user_id, status in results])
+            blocked = [(user_id,) for user_id, status in results if status == 'blocked']
+            if blocked:
+                tx.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", blocked)
+            tx.execute('''UPDATE broadcasts SET last_user_id = COALESCE(?, last_user_id),
+                        sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE id = ?''',
+                       (last_user_id, counts['sent'], counts['failed'], counts['blocked'], broadcast_id))
+
+    def prune_broadcast_deliveries(self, days: int):
+        """Статусы доставки завершённых рассылок старше days дней"""
+        return self._execute('''DELETE FROM broadcast_deliveries WHERE broadcast_id IN
+                    (SELECT id FROM broadcasts WHERE status != 'running' AND finished_at < ?)''',
+                             (int(time.time()) - days * 86400,))
+
+    # Методы для распределения
+    # Тип элемента -> (таблица, условие "ещё не обработан")
+    ASSIGNABLE = {
+        'request': ('requests', "status = 'new'"),
+        'question': ('questions', "answer IS NULL")
+    }
+
+    def assign_item(self, kind: str, item_id: int, manager_id: int):
+        table, _ = self.ASSIGNABLE[kind]
+        self._execute(f"UPDATE {table} SET assigned_to = ?, assigned_at = {self.SQL_NOW} WHERE id = ?",
+                      (manager_id, item_id))
+
+    def get_open_assignment_counts(self):
+        counts = {}
+        with self.transaction() as tx:
+            for table, open_condition in self.ASSIGNABLE.values():
+                rows = tx.query(f'''SELECT assigned_to, COUNT(*) FROM {table}
+                            WHERE {open_condition} AND assigned_to IS NOT NULL
+                            GROUP BY assigned_to''')
+                for manager_id, count in rows:
+                    counts[manager_id] = counts.get(manager_id, 0) + count
+        return counts
+
+    def get_last_assignee(self, user_id: int):
+        row = self._query_one('''SELECT assigned_to FROM (
+                        SELECT assigned_to, assigned_at FROM requests WHERE user_id = ? AND assigned_to IS NOT NULL
+                        UNION ALL
+                        SELECT assigned_to, assigned_at FROM questions WHERE user_id = ? AND assigned_to IS NOT NULL
+                    ) AS assignments ORDER BY assigned_at DESC LIMIT 1''', (user_id, user_id))
+        return row[0] if row else None
+
+    def get_stale_assignments(self, timeout_seconds: int, limit: int):
+        """Открытые элементы без менеджера, с просроченным или неактивным менеджером"""
+        items = []
+        with self.transaction() as tx:
+            for kind, (table, open_condition) in self.ASSIGNABLE.items():
+                rows = tx.query(f'''SELECT id, user_id, assigned_to FROM {table}
+                            WHERE {open_condition}
+                            AND (assigned_to IS NULL
+                                 OR assigned_at <= {self.SQL_NOW_MINUS}
+                                 OR assigned_to NOT IN (SELECT user_id FROM managers WHERE is_active = TRUE))
+                            ORDER BY id LIMIT ?''', (f'-{timeout_seconds} seconds', limit))
+                items.extend((kind, item_id, user_id, assigned_to) for item_id, user_id, assigned_to in rows)
+        return items
+
+class SQLiteDatabase(Database):
+    """Хранилище в локальном файле SQLite"""
+
+    supports_file_backup = True
+
+    def __init__(self):
+        self.conn = sqlite3.connect(Config.DB_NAME, check_same_thread=False)
+        self.conn.create_function('unicode_lower', 1, lambda value: value.lower() if isinstance(value, str) else value,
+                                  deterministic=True)
+        # Действует только для новой базы, существующая переводится в maintenance
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # Одно соединение на бот и Flask-поток - транзакции не должны перемешиваться
+        self._lock = threading.RLock()
+        super().__init__()
+
+    @contextmanager
+    def transaction(self):
+        with track_time('db'), self._lock:
+            try:
+                yield Transaction(self.conn.cursor())
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def close(self):
+        self.conn.close()
+
+    def create_tables(self):
+        with self.transaction() as tx:
+            c = tx.cursor
+
+            # Таблица заявок
+            c.execute('''CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                contact TEXT NOT NULL,
+                business_type TEXT,
+                bot_tasks TEXT,
+                status TEXT DEFAULT 'new',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+
+            # Таблица вопросов
+            c.execute('''CREATE TABLE IF NOT EXISTS questions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                question TEXT NOT NULL,
+                answer TEXT,
+                status TEXT DEFAULT 'new',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+
+            # Таблица знаний
+            c.execute('''CREATE TABLE IF NOT EXISTS knowledge_base (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+
+            # Другие формулировки вопросов, объединённые с записью базы знаний
+            c.execute('''CREATE TABLE IF NOT EXISTS knowledge_aliases (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entry_id INTEGER NOT NULL,
+                question TEXT NOT NULL
+            )''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_aliases_entry ON knowledge_aliases (entry_id)")
+
+            # Таблица менеджеров
+            c.execute('''CREATE TABLE IF NOT EXISTS managers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER UNIQUE NOT NULL,
+                username TEXT,
+                is_active BOOLEAN DEFAULT TRUE
+            )''')
+
+            # Миграции существующих баз
+            self._add_column_if_missing(c, 'managers', 'digest_interval', 'INTEGER DEFAULT 0')
+            for table in ('requests', 'questions'):
+                self._add_column_if_missing(c, table, 'assigned_to', 'INTEGER')
+                self._add_column_if_missing(c, table, 'assigned_at', 'TIMESTAMP')
+                c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_assigned_to ON {table} (assigned_to)")
+                c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_status_created ON {table} (status, created_at)")
+
+            # Аналитика воронки: сырые события и агрегаты по корзинам времени
+            c.execute('''CREATE TABLE IF NOT EXISTS funnel_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                latency REAL,
+                ts INTEGER NOT NULL
+            )''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_funnel_events_ts ON funnel_events (ts)")
+            for table, _ in self.FUNNEL_BUCKETS.values():
+                c.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                    bucket INTEGER NOT NULL,
+                    event TEXT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    latency_sum REAL NOT NULL DEFAULT 0,
+                    latency_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (bucket, event)
+                )''')
+
+            # Пользователи бота и рассылки
+            c.execute('''CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                first_seen INTEGER NOT NULL,
+                last_seen INTEGER NOT NULL,
+                blocked INTEGER NOT NULL DEFAULT 0
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_by INTEGER,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                last_user_id INTEGER NOT NULL DEFAULT 0,
+                progress_chat_id INTEGER,
+                progress_message_id INTEGER,
+                created_at INTEGER NOT NULL,
+                finished_at INTEGER
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                broadcast_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                PRIMARY KEY (broadcast_id, user_id)
+            )''')
+
+    def get_schema_version(self) -> int:
+        return self._query_one("PRAGMA user_version")[0]
+
+    def set_schema_version(self, version: int):
+        # PRAGMA не принимает параметры, version - всегда int
+        self._execute(f"PRAGMA user_version = {int(version)}")
+
+    def _add_column_if_missing(self, c, table: str, column: str, definition: str):
+        c.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in c.fetchall()]:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    # Архив - отдельный файл, подключаемый через ATTACH
+    def attach_archive(self):
+        """Подключает архивную базу к текущему соединению (один раз)"""
+        if self.archive_attached:
+            return
+
+        with self._lock:
+            self.conn.execute("ATTACH DATABASE ? AS archive", (Config.ARCHIVE_DB_NAME,))
+            with self.transaction() as tx:
+                tx.execute('''CREATE TABLE IF NOT EXISTS archive.requests (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    contact TEXT NOT NULL,
+                    business_type TEXT,
+                    bot_tasks TEXT,
+                    status TEXT,
+                    created_at TIMESTAMP,
+                    assigned_to INTEGER,
+                    assigned_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+                tx.execute('''CREATE TABLE IF NOT EXISTS archive.questions (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    question TEXT NOT NULL,
+                    answer TEXT,
+                    status TEXT,
+                    created_at TIMESTAMP,
+                    assigned_to INTEGER,
+                    assigned_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+            self.archive_attached = True
+
+    def get_size(self):
+        """Размер основной базы в байтах и объём свободных страниц"""
+        with self.transaction() as tx:
+            page_count = tx.query_one("PRAGMA main.page_count")[0]
+            freelist_count = tx.query_one("PRAGMA main.freelist_count")[0]
+            page_size = tx.query_one("PRAGMA main.page_size")[0]
+        return page_count * page_size, freelist_count * page_size
+
+    def ensure_incremental_vacuum(self):
+        """Старые базы созданы без auto_vacuum - переводим их один раз полным VACUUM"""
+        with self._lock:
+            if self.conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+                logger.info("Перевод базы в режим incremental auto_vacuum (однократный VACUUM)")
+                self.conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+                self.conn.execute("VACUUM main")
+
+    def incremental_vacuum(self, pages: int):
+        with self.transaction() as tx:
+            tx.query(f"PRAGMA main.incremental_vacuum({int(pages)})")
+            return tx.query_one("PRAGMA main.freelist_count")[0] > 0
+
+    def analyze(self):
+        # Ограниченная выборка: ANALYZE большой базы не держит соединение долго
+        with self.transaction() as tx:
+            tx.execute(f"PRAGMA analysis_limit = {int(Config.ANALYZE_ROWS_LIMIT)}")
+            tx.execute("ANALYZE main")
+
+    def backup_to(self, target_path: str, name: str = 'main'):
+        """Онлайн-копия через SQLite backup API небольшими шагами.
+
+        Копия идёт через то же соединение, поэтому запись в процессе не
+        перезапускает backup, а между шагами соединение свободно для записи.
+        """
+        target = sqlite3.connect(target_path)
+        try:
+            self.conn.backup(
+                target,
+                pages=Config.BACKUP_PAGES_PER_STEP,
+                name=name,
+                progress=lambda status, remaining, total: time.sleep(Config.BACKUP_STEP_PAUSE)
+            )
+        finally:
+            target.close()
+
+class PostgresTransaction(Transaction):
+    def _sql(self, sql: str):
+        return sql.replace('?', '%s')
+
+    def insert(self, sql: str, params=()):
+        self.cursor.execute(self._sql(sql) + " RETURNING id", params)
+        return self.cursor.fetchone()[0]
+
+class PostgresDatabase(Database):
+    """Хранилище в PostgreSQL с пулом соединений (psycopg 3)"""
+
+    MAIN_SCHEMA = 'public'
+    # Время хранится в UTC без зоны - как CURRENT_TIMESTAMP в SQLite
+    SQL_NOW = "(NOW() AT TIME ZONE 'utc')"
+    SQL_NOW_MINUS = "((NOW() AT TIME ZONE 'utc') + CAST(? AS INTERVAL))"
+    SQL_TODAY_MINUS = "CAST((NOW() AT TIME ZONE 'utc') + CAST(? AS INTERVAL) AS DATE)"
+    SQL_ILIKE = "{column} ILIKE ?"
+
+    def __init__(self, url: str):
+        try:
+            from psycopg_pool import ConnectionPool
+        except ImportError:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres нужны пакеты psycopg и psycopg-pool: pip install 'psycopg[binary,pool]'")
+
+        # prepare_threshold=0 - каждый запрос готовится на сервере с первого выполнения
+        self.pool = ConnectionPool(
+            url,
+            min_size=Config.PG_POOL_MIN_SIZE,
+            max_size=Config.PG_POOL_MAX_SIZE,
+            timeout=Config.PG_POOL_TIMEOUT,
+            kwargs={'prepare_threshold': 0},
+            open=True
+        )
+        super().__init__()
+
+    @contextmanager
+    def transaction(self):
+        # Пул коммитит транзакцию при выходе из блока и откатывает при исключении
+        with track_time('db'), self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                yield PostgresTransaction(cursor)
 
-# Инициализация базы данных
-db = Database()
+    def close(self):
+        self.pool.close()
+
+    def create_tables(self):
+        now = self.SQL_NOW
+        with self.transaction() as tx:
+            tx.execute(f'''CREATE TABLE IF NOT EXISTS requests (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                contact TEXT NOT NULL,
+                business_type TEXT,
+                bot_tasks TEXT,
+                status TEXT DEFAULT 'new',
+                created_at TIMESTAMP DEFAULT {now},
+                assigned_to BIGINT,
+                assigned_at TIMESTAMP
+            )''')
+            tx.execute(f'''CREATE TABLE IF NOT EXISTS questions (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                question TEXT NOT NULL,
+                answer TEXT,
+                status TEXT DEFAULT 'new',
+                created_at TIMESTAMP DEFAULT {now},
+                assigned_to BIGINT,
+                assigned_at TIMESTAMP
+            )''')
+            tx.execute(f'''CREATE TABLE IF NOT EXISTS knowledge_base (
+                id BIGSERIAL PRIMARY KEY,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT {now}
+            )''')
+            tx.execute('''CREATE TABLE IF NOT EXISTS knowledge_aliases (
+                id BIGSERIAL PRIMARY KEY,
+                entry_id BIGINT NOT NULL,
+                question TEXT NOT NULL
+            )''')
+            tx.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_aliases_entry ON knowledge_aliases (entry_id)")
+            tx.execute('''CREATE TABLE IF NOT EXISTS managers (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT UNIQUE NOT NULL,
+                username TEXT,
+                is_active BOOLEAN DEFAULT TRUE,
+                digest_interval INTEGER DEFAULT 0
+            )''')
+            for table in ('requests', 'questions'):
+                tx.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_assigned_to ON {table} (assigned_to)")
+                tx.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_status_created ON {table} (status, created_at)")
+
+            # Аналитика воронки: сырые события и агрегаты по корзинам времени
+            tx.execute('''CREATE TABLE IF NOT EXISTS funnel_events (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                event TEXT NOT NULL,
+                latency DOUBLE PRECISION,
+                ts BIGINT NOT NULL
+            )''')
+            tx.execute("CREATE INDEX IF NOT EXISTS idx_funnel_events_ts ON funnel_events (ts)")
+            for table, _ in self.FUNNEL_BUCKETS.values():
+                tx.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                    bucket BIGINT NOT NULL,
+                    event TEXT NOT NULL,
+                    count BIGINT NOT NULL DEFAULT 0,
+                    latency_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    latency_count BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (bucket, event)
+                )''')
+
+            # Пользователи бота и рассылки
+            tx.execute('''CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                first_seen BIGINT NOT NULL,
+                last_seen BIGINT NOT NULL,
+                blocked INTEGER NOT NULL DEFAULT 0
+            )''')
+            tx.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+                id BIGSERIAL PRIMARY KEY,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_by BIGINT,
+                total BIGINT NOT NULL DEFAULT 0,
+                sent BIGINT NOT NULL DEFAULT 0,
+                failed BIGINT NOT NULL DEFAULT 0,
+                blocked BIGINT NOT NULL DEFAULT 0,
+                last_user_id BIGINT NOT NULL DEFAULT 0,
+                progress_chat_id BIGINT,
+                progress_message_id BIGINT,
+                created_at BIGINT NOT NULL,
+                finished_at BIGINT
+            )''')
+            tx.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                broadcast_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                status TEXT NOT NULL,
+                ts BIGINT NOT NULL,
+                PRIMARY KEY (broadcast_id, user_id)
+            )''')
+
+            # Архив - отдельная схема в той же базе
+            tx.execute("CREATE SCHEMA IF NOT EXISTS archive")
+            tx.execute(f'''CREATE TABLE IF NOT EXISTS archive.requests (
+                id BIGINT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                contact TEXT NOT NULL,
+                business_type TEXT,
+                bot_tasks TEXT,
+                status TEXT,
+                created_at TIMESTAMP,
+                assigned_to BIGINT,
+                assigned_at TIMESTAMP,
+                archived_at TIMESTAMP DEFAULT {now}
+            )''')
+            tx.execute(f'''CREATE TABLE IF NOT EXISTS archive.questions (
+                id BIGINT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                question TEXT NOT NULL,
+                answer TEXT,
+                status TEXT,
+                created_at TIMESTAMP,
+                assigned_to BIGINT,
+                assigned_at TIMESTAMP,
+                archived_at TIMESTAMP DEFAULT {now}
+            )''')
+
+    def get_schema_version(self) -> int:
+        with self.transaction() as tx:
+            tx.execute("CREATE TABLE IF NOT EXISTS schema_meta (version INTEGER NOT NULL)")
+            row = tx.query_one("SELECT MAX(version) FROM schema_meta")
+        return row[0] or 0
+
+    def set_schema_version(self, version: int):
+        with self.transaction() as tx:
+            tx.execute("DELETE FROM schema_meta")
+            tx.execute("INSERT INTO schema_meta (version) VALUES (?)", (version,))
+
+    def get_size(self):
+        # Место после удаления освобождает autovacuum самого PostgreSQL
+        return self._query_one("SELECT pg_database_size(current_database())")[0], 0
+
+def create_database():
+    """Создаёт хранилище по Config.STORAGE_BACKEND"""
+    if Config.STORAGE_BACKEND == 'postgres':
+        if not Config.DATABASE_URL:
+            raise RuntimeError("STORAGE_BACKEND=postgres требует DATABASE_URL")
+        return PostgresDatabase(Config.DATABASE_URL)
+    if Config.STORAGE_BACKEND != 'sqlite':
+        raise RuntimeError(f"Неизвестный STORAGE_BACKEND: {Config.STORAGE_BACKEND}")
+    return SQLiteDatabase()
+
+# База открывается в main()/run_cli(), а не при импорте модуля
+db = None
+
+def init_database():
+    """Открывает хранилище один раз за процесс"""
+    global db
+    if db is None:
+        db = create_database()
+    return db
 
 # ===== ТЕКСТЫ =====
 GREETING = f"""
@@ -282,6 +1618,40 @@ REQUEST_FLOW = [
     "📱 Оставьте контакт для связи (телефон или @username):"
 ]
 
+ANSWER_MESSAGE = "💬 *Ответ на ваш вопрос:*\n\n{answer}"
+
+# Уведомления пользователю о решении по заявке
+REQUEST_STATUS_MESSAGES = {
+    'accepted': "✅ *Ваша заявка принята!*\n\nНаш менеджер свяжется с вами в ближайшее время.\n\nЗаявка #{request_id}",
+    'rejected': "❌ *К сожалению, ваша заявка не подошла.*\n\nВы можете оставить новую заявку с другими требованиями.\n\nЗаявка #{request_id}"
+}
+
+# ===== КЭШ МЕНЕДЖЕРОВ =====
+class ManagerCache:
+    """Список активных менеджеров в общем хранилище, чтобы не ходить в БД на каждую кнопку"""
+
+    KEY = 'managers:active'
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self):
+        cached = self.store.get(self.KEY)
+        if cached is not None:
+            return set(json.loads(cached))
+
+        managers = db.get_active_managers()
+        self.store.set(self.KEY, json.dumps(managers), ttl=Config.MANAGER_CACHE_TTL)
+        return set(managers)
+
+    def is_manager(self, user_id: int):
+        return user_id in self.get()
+
+    def invalidate(self):
+        self.store.delete(self.KEY)
+
+manager_cache = ManagerCache(shared_store)
+
 # ===== ФУНКЦИИ КНОПОК =====
 def get_menu_buttons():
     """Возвращает стандартные кнопки меню"""
@@ -290,8 +1660,8 @@ def get_menu_buttons():
         [InlineKeyboardButton("❓ Задать вопрос", callback_data='ask_ai_question')]
     ]
 
-def get_main_menu_keyboard(user_id=None):
-    """Возвращает клавиатуру главного меню"""
+def get_main_menu_keyboard(show_admin: bool = False):
+    """Возвращает клавиатуру главного меню (show_admin - для админа и менеджеров)"""
     keyboard = [
         [InlineKeyboardButton("🚀 Оставить заявку", callback_data='request_bot')],
         [InlineKeyboardButton("ℹ️ Услуги и цены", callback_data='info')],
@@ -300,7 +1670,7 @@ def get_main_menu_keyboard(user_id=None):
     ]
 
     # Добавляем кнопку админ панели если это админ или менеджер
-    if user_id and (user_id == Config.ADMIN_USER_ID or db.is_manager(user_id)):
+    if show_admin:
         keyboard.append([InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')])
 
     return InlineKeyboardMarkup(keyboard)
@@ -315,27 +1685,573 @@ def get_admin_keyboard():
         [InlineKeyboardButton("➕ Добавить менеджера", callback_data='admin_add_manager')],
         [InlineKeyboardButton("➖ Удалить менеджера", callback_data='admin_remove_manager')],
         [InlineKeyboardButton("👥 Список менеджеров", callback_data='admin_list_managers')],
+        [InlineKeyboardButton("🔔 Режим уведомлений", callback_data='admin_digest')],
+        [InlineKeyboardButton("🗄 Архив", callback_data='admin_archive')],
+        [InlineKeyboardButton("📣 Рассылка", callback_data='admin_broadcast')],
         [InlineKeyboardButton("🏠 Главное меню", callback_data='back_to_menu')]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def get_digest_keyboard(current: int):
+    """Возвращает клавиатуру выбора режима уведомлений"""
+    keyboard = []
+    for minutes in Config.DIGEST_INTERVAL_OPTIONS:
+        label = "⚡️ Мгновенно" if minutes == 0 else f"📬 Раз в {minutes} мин"
+        if minutes == current:
+            label = f"✅ {label}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f'admin_digest_set_{minutes}')])
+    keyboard.append([InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')])
+    return InlineKeyboardMarkup(keyboard)
+
 # ===== ФУНКЦИИ ПРОВЕРКИ ПРАВ =====
 def is_admin_or_manager(user_id):
     """Проверяет, является ли пользователь админом или менеджером"""
-    return user_id == Config.ADMIN_USER_ID or db.is_manager(user_id)
+    return user_id == Config.ADMIN_USER_ID or manager_cache.is_manager(user_id)
+
+# ===== ЗАЩИТА ОТ ФЛУДА =====
+class RateLimiter:
+    """Token bucket на каждого пользователя с LRU-вытеснением и нарастающим кулдауном"""
+
+    class _Bucket:
+        __slots__ = ('tokens', 'updated', 'strikes', 'blocked_until')
+
+        def __init__(self, tokens: float, now: float):
+            self.tokens = tokens
+            self.updated = now
+            self.strikes = 0
+            self.blocked_until = 0.0
+
+    def __init__(self, capacity: int, refill_rate: float, max_users: int,
+                 cooldown: int, max_cooldown: int, strike_reset: int):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.max_users = max_users
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.strike_reset = strike_reset
+        self._buckets = OrderedDict()
+
+        # Счётчики
+        self.allowed = 0
+        self.rejected = 0
+        self.cooldowns = 0
+        self.evicted = 0
+
+    def check(self, user_id: int, now: float = None):
+        """Проверяет апдейт пользователя.
+
+        Возвращает (allowed, cooldown): cooldown > 0 только в момент, когда
+        пользователь впервые уходит в кулдаун, чтобы предупредить его один раз.
+        """
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._Bucket(self.capacity, now)
+            self._buckets[user_id] = bucket
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._buckets.move_to_end(user_id)
+
+        if now < bucket.blocked_until:
+            self.rejected += 1
+            return False, 0
+
+        # Долго вёл себя хорошо - забываем прошлые нарушения
+        if bucket.strikes and now - bucket.blocked_until > self.strike_reset:
+            bucket.strikes = 0
+
+        bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.refill_rate)
+        bucket.updated = now
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            self.allowed += 1
+            return True, 0
+
+        # Корзина пуста - кулдаун, удваивается с каждым нарушением
+        bucket.strikes += 1
+        cooldown = min(self.cooldown * 2 ** (bucket.strikes - 1), self.max_cooldown)
+        bucket.blocked_until = now + cooldown
+        bucket.updated = bucket.blocked_until
+        self.rejected += 1
+        self.cooldowns += 1
+        logger.warning("Пользователь %s превысил лимит сообщений, кулдаун %s сек", user_id, cooldown)
+        return False, cooldown
+
+    def get_stats(self):
+        return {
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'cooldowns': self.cooldowns,
+            'evicted': self.evicted,
+            'tracked_users': len(self._buckets)
+        }
+
+rate_limiter = RateLimiter(
+    capacity=Config.RATE_LIMIT_CAPACITY,
+    refill_rate=Config.RATE_LIMIT_REFILL_RATE,
+    max_users=Config.RATE_LIMIT_MAX_USERS,
+    cooldown=Config.RATE_LIMIT_COOLDOWN,
+    max_cooldown=Config.RATE_LIMIT_MAX_COOLDOWN,
+    strike_reset=Config.RATE_LIMIT_STRIKE_RESET
+)
+
+def is_rate_limit_exempt(user_id):
+    """Админ и менеджеры не ограничиваются, в том числе добавленные через админ-панель.
+
+    Менеджеры из конфига проверяются сразу, остальные - по manager_cache
+    (БД читается не чаще раза в MANAGER_CACHE_TTL).
+    """
+    return user_id in Config.MANAGER_USER_IDS or is_admin_or_manager(user_id)
+
+# ===== АНАЛИТИКА ВОРОНКИ =====
+# Шаги воронки заявки по порядку
+FUNNEL_STEPS = ['flow_start', 'step_business', 'step_tasks', 'flow_complete']
+
+class FunnelTracker:
+    """Буфер событий воронки, записывается в БД пачками в фоне"""
+
+    def __init__(self):
+        self._buffer = []
+        self._flushing = False
+        self._flush_task = None  # Ссылка на задачу, иначе цикл событий держит её только слабо
+
+    def track(self, user_id: int, event: str, latency: float = None):
+        self._buffer.append((user_id, event, latency, int(time.time())))
+        if len(self._buffer) >= Config.FUNNEL_BATCH_SIZE and not self._flushing:
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def track_click(self, user_id: int, callback_data: str):
+        # ID в конце (accept_req_12, answer_question_from_manager_5) не нужны в агрегатах
+        parts = callback_data.split('_')
+        while len(parts) > 1 and parts[-1].isdigit():
+            parts.pop()
+        self.track(user_id, 'click:' + '_'.join(parts))
+
+    async def flush(self):
+        if self._flushing or not self._buffer:
+            return
+
+        self._flushing = True
+        batch, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(db.add_funnel_events, batch)
+        except Exception as e:
+            logger.error("Ошибка записи событий воронки (%s шт.): %s", len(batch), e)
+        finally:
+            self._flushing = False
+
+funnel = FunnelTracker()
+
+def track_flow_step(context, user_id: int, event: str):
+    """Событие шага воронки с временем, прошедшим с предыдущего шага"""
+    now = time.time()
+    previous = context.user_data.get('flow_ts')
+    funnel.track(user_id, event, now - previous if previous else None)
+    context.user_data['flow_ts'] = now
+
+async def flush_funnel(context: CallbackContext):
+    """Периодическая запись буфера событий (на каждом воркере - буфер свой)"""
+    await funnel.flush()
+
+# ===== ПОЛЬЗОВАТЕЛИ =====
+class UserRegistry:
+    """Буфер последних появлений пользователей, записывается в БД пачками в фоне"""
+
+    def __init__(self):
+        self._buffer = {}  # user_id -> (user_id, username, first_name, ts)
+        self._flushing = False
+        self._flush_task = None
+
+    def touch(self, user):
+        self._buffer[user.id] = (user.id, user.username, user.first_name, int(time.time()))
+        if len(self._buffer) >= Config.USER_BATCH_SIZE and not self._flushing:
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        if self._flushing or not self._buffer:
+            return
+
+        self._flushing = True
+        batch, self._buffer = self._buffer, {}
+        try:
+            await asyncio.to_thread(db.upsert_users, list(batch.values()))
+        except Exception as e:
+            logger.error("Ошибка записи пользователей (%s шт.): %s", len(batch), e)
+            # Вернём в буфер всех, кто не появился заново за время записи
+            for user_id, row in batch.items():
+                self._buffer.setdefault(user_id, row)
+        finally:
+            self._flushing = False
+
+user_registry = UserRegistry()
+
+async def track_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запоминает автора каждого апдейта (группа -1, до остальных обработчиков)"""
+    user = update.effective_user
+    if user and not user.is_bot:
+        user_registry.touch(user)
+
+async def flush_users(context: CallbackContext):
+    """Периодическая запись буфера пользователей (на каждом воркере - буфер свой)"""
+    await user_registry.flush()
+
+def build_funnel_report(since: int, until: int, granularity: str = None, series: bool = False):
+    """Конверсия и задержки по шагам воронки из агрегатов"""
+    if granularity is None:
+        span = until - since
+        granularity = 'minute' if span <= 6 * 3600 else 'hour' if span <= 14 * 86400 else 'day'
+
+    # Границы по корзинам: иначе первая корзина попадёт в отчёт целиком, а 'from' этого не покажет
+    _, size = db.FUNNEL_BUCKETS[granularity]
+    since -= since % size
+    until += -until % size
+
+    totals = db.get_funnel_totals(granularity, since, until)
+    started = totals.get(FUNNEL_STEPS[0], (0, 0, 0))[0]
+
+    steps = []
+    previous = None
+    for step in FUNNEL_STEPS:
+        count, latency_sum, latency_count = totals.get(step, (0, 0, 0))
+        steps.append({
+            'event': step,
+            'count': count,
+            'conversion_from_start': round(count / started, 4) if started else None,
+            'conversion_from_previous': round(count / previous, 4) if previous else None,
+            'avg_latency_sec': round(latency_sum / latency_count, 2) if latency_count else None
+        })
+        previous = count
+
+    report = {
+        'granularity': granularity,
+        'from': since,
+        'to': until,
+        'steps': steps,
+        'abandoned': {event: values[0] for event, values in totals.items() if event.startswith('flow_abandon')},
+        'clicks': {event[len('click:'):]: values[0] for event, values in totals.items() if event.startswith('click:')}
+    }
+
+    if series:
+        report['series'] = [
+            {'bucket': bucket, 'event': event, 'count': count}
+            for bucket, event, count in db.get_funnel_series(granularity, since, until, FUNNEL_STEPS)
+        ]
+    return report
+
+# ===== БАЗА ЗНАНИЙ =====
+def kb_vector(text: str) -> dict:
+    """Хэшированный вектор символьных n-грамм: {номер корзины: количество}"""
+    words = re.findall(r'\w+', text.lower())
+    normalized = f" {' '.join(words)} "
+    vector = {}
+    for i in range(len(normalized) - Config.KB_NGRAM + 1):
+        bucket = zlib.crc32(normalized[i:i + Config.KB_NGRAM].encode()) % Config.KB_VECTOR_DIM
+        vector[bucket] = vector.get(bucket, 0) + 1
+    return vector
+
+def find_duplicate_clusters(questions: list, threshold: float):
+    """Группы индексов похожих вопросов (косинус n-грамм >= threshold), только группы из 2+.
+
+    Сходство считается матрично пачками по KB_COMPACT_BATCH строк, пары
+    объединяются через union-find.
+    """
+    import numpy as np
+
+    matrix = np.zeros((len(questions), Config.KB_VECTOR_DIM), dtype=np.float32)
+    for row, question in enumerate(questions):
+        for bucket, count in kb_vector(question).items():
+            matrix[row, bucket] = count
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+
+    parent = list(range(len(questions)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    columns = np.arange(len(questions))
+    for start in range(0, len(questions), Config.KB_COMPACT_BATCH):
+        rows = columns[start:start + Config.KB_COMPACT_BATCH]
+        similar = (matrix[rows] @ matrix.T >= threshold) & (columns[None, :] > rows[:, None])
+        for i, j in zip(*np.nonzero(similar)):
+            root_i, root_j = find(rows[i]), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for i in range(len(questions)):
+        groups.setdefault(find(i), []).append(i)
+    return [group for group in groups.values() if len(group) > 1]
+
+class KnowledgeIndex:
+    """База знаний в памяти: поиск ответа без запроса к БД и проверка дублей при добавлении.
+
+    Поиск сохраняет прежнюю логику: выигрывает самая свежая запись, у которой
+    хотя бы одно слово вопроса (длиннее 3 букв) входит в текст пользователя;
+    слова псевдонимов считаются словами записи. Версия в общем хранилище
+    сообщает другим воркерам, что индекс нужно перечитать.
+    """
+
+    VERSION_KEY = 'kb:version'
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.RLock()
+        self._version = None  # Версия, с которой загружен индекс; None - не загружен
+        self._entries = {}  # entry_id -> [answer, [вопрос, псевдонимы...]]
+        self._order = []  # entry_id от новых к старым
+        self._keywords = None  # [(слово, entry_id)] в порядке свежести, строится лениво
+        self._vectors = {}  # entry_id -> [(вектор, норма)] вопроса и псевдонимов
+        self._postings = {}  # корзина n-граммы -> {entry_id}
+
+    def _store_version(self):
+        return int(self.store.get(self.VERSION_KEY) or 0)
+
+    def _ensure_loaded(self):
+        version = self._store_version()
+        if self._version == version:
+            return
+
+        entries, aliases = db.get_knowledge_index_rows()
+        self._entries, self._order, self._vectors, self._postings = {}, [], {}, {}
+        for entry_id, question, answer in entries:
+            self._entries[entry_id] = [answer, []]
+            self._order.append(entry_id)
+            self._add_question(entry_id, question)
+        for entry_id, question in aliases:
+            if entry_id in self._entries:
+                self._add_question(entry_id, question)
+        self._keywords = None
+        self._version = version
+
+    def _add_question(self, entry_id: int, question: str):
+        self._entries[entry_id][1].append(question)
+        vector = kb_vector(question)
+        norm = sum(count * count for count in vector.values()) ** 0.5
+        self._vectors.setdefault(entry_id, []).append((vector, norm))
+        for bucket in vector:
+            self._postings.setdefault(bucket, set()).add(entry_id)
+        self._keywords = None
+
+    def _remove_questions(self, entry_id: int):
+        """Убирает вопросы записи из векторов и корзин n-грамм"""
+        for vector, _ in self._vectors.pop(entry_id, []):
+            for bucket in vector:
+                entry_ids = self._postings.get(bucket)
+                if entry_ids is not None:
+                    entry_ids.discard(entry_id)
+                    if not entry_ids:
+                        del self._postings[bucket]
+        self._keywords = None
+
+    def _bump_version(self):
+        """Сообщает другим воркерам об изменении; перечитываем, если они успели изменить индекс раньше"""
+        version = self.store.incr(self.VERSION_KEY)
+        if self._version is not None and version == self._version + 1:
+            self._version = version
+
+    def size(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._entries), sum(len(questions) for _, questions in self._entries.values())
+
+    def lookup(self, text: str):
+        """Ответ самой свежей записи, чьё ключевое слово входит в текст, или None"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._keywords is None:
+                keywords = {}
+                for entry_id in self._order:
+                    for question in self._entries[entry_id][1]:
+                        for word in question.lower().split():
+                            if len(word) > 3:
+                                keywords.setdefault(word, entry_id)
+                self._keywords = list(keywords.items())
+
+            text_lower = text.lower()
+            for word, entry_id in self._keywords:
+                if word in text_lower:
+                    return self._entries[entry_id][0]
+            return None
+
+    def find_duplicate(self, question: str):
+        """(entry_id, сходство) самой похожей записи не ниже порога или None"""
+        vector = kb_vector(question)
+        norm = sum(count * count for count in vector.values()) ** 0.5
+
+        with self._lock:
+            self._ensure_loaded()
+            if not norm:
+                # Вопрос без букв и цифр ("???", эмодзи) ни с чем не сравнивается
+                return None
+            # Сравниваем только с записями, у которых есть общие n-граммы
+            candidates = set()
+            for bucket in vector:
+                candidates |= self._postings.get(bucket, set())
+
+            best = None
+            for entry_id in candidates:
+                for other, other_norm in self._vectors[entry_id]:
+                    dot = sum(count * other.get(bucket, 0) for bucket, count in vector.items())
+                    similarity = dot / (norm * other_norm)
+                    if similarity >= Config.KB_DUPLICATE_THRESHOLD and (best is None or similarity > best[1]):
+                        best = (entry_id, similarity)
+            return best
+
+    def add(self, question: str, answer: str):
+        """Добавляет ответ в базу знаний; похожий вопрос обновляет существующую запись"""
+        with self._lock:
+            self._ensure_loaded()
+            duplicate = self.find_duplicate(question)
+            if duplicate:
+                entry_id = duplicate[0]
+                known = {q.strip().lower() for q in self._entries[entry_id][1]}
+                alias = question if question.strip().lower() not in known else None
+                db.refresh_knowledge_entry(entry_id, answer, alias)
+                self._entries[entry_id][0] = answer
+                self._order.remove(entry_id)
+                if alias is not None:
+                    self._add_question(entry_id, alias)
+                logger.info("Вопрос объединён с записью базы знаний #%s (сходство %.2f)", entry_id, duplicate[1])
+            else:
+                entry_id = db.add_to_knowledge_base(question, answer)
+                self._entries[entry_id] = [answer, []]
+                self._add_question(entry_id, question)
+
+            self._order.insert(0, entry_id)
+            self._keywords = None
+            self._bump_version()
+            return entry_id
+
+    def update(self, entry_id: int, question: str = None, answer: str = None):
+        """Правка записи админом: БД и индекс меняются сразу, без перечитывания таблицы"""
+        with self._lock:
+            self._ensure_loaded()
+            if not db.update_knowledge_entry(entry_id, question, answer):
+                return False
+            entry = self._entries.get(entry_id)
+            if entry is not None:
+                if answer is not None:
+                    entry[0] = answer
+                if question is not None:
+                    questions = [question] + entry[1][1:]
+                    self._remove_questions(entry_id)
+                    entry[1] = []
+                    for text in questions:
+                        self._add_question(entry_id, text)
+            self._bump_version()
+            return True
+
+    def remove(self, entry_id: int):
+        """Удаление записи: ответ перестаёт находиться сразу"""
+        with self._lock:
+            self._ensure_loaded()
+            if not db.delete_knowledge_entry(entry_id):
+                return False
+            if self._entries.pop(entry_id, None) is not None:
+                self._order.remove(entry_id)
+                self._remove_questions(entry_id)
+            self._bump_version()
+            return True
+
+    def compact(self):
+        """Объединяет похожие записи: в группе остаётся самая свежая, остальные - её псевдонимы"""
+        with self._lock:
+            self._ensure_loaded()
+            order = list(self._order)
+            questions = [self._entries[entry_id][1][0] for entry_id in order]
+
+        # Матричные вычисления - без блокировки, поиск ответов продолжает работать
+        groups = find_duplicate_clusters(questions, Config.KB_DUPLICATE_THRESHOLD)
+        # Индексы в порядке свежести - первый в группе и есть самая свежая запись
+        clusters = [(order[group[0]], [order[i] for i in group[1:]]) for group in groups]
+        if clusters:
+            with self._lock:
+                db.merge_knowledge_entries(clusters)
+                self.store.incr(self.VERSION_KEY)
+                self._ensure_loaded()
+        return clusters
+
+knowledge_index = KnowledgeIndex(shared_store)
+
+def measure_kb_lookup(samples: list, repeat: int = 3):
+    """Среднее время поиска ответа (мс): в индексе и полным перебором строк БД, как раньше"""
+    if not samples:
+        return 0.0, 0.0
+    knowledge_index.lookup(samples[0])  # Список ключевых слов строится при первом поиске
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in samples:
+            knowledge_index.lookup(text)
+    index_ms = (time.perf_counter() - started) * 1000 / (len(samples) * repeat)
+
+    started = time.perf_counter()
+    for text in samples[:20]:
+        text_lower = text.lower()
+        for question, _ in db.get_knowledge_base():
+            if any(word in text_lower for word in question.lower().split() if len(word) > 3):
+                break
+    scan_ms = (time.perf_counter() - started) * 1000 / len(samples[:20])
+    return index_ms, scan_ms
+
+def run_kb_compaction():
+    """Сжатие базы знаний с замером размера и времени поиска до и после"""
+    entries_before, questions = knowledge_index.size()
+    with knowledge_index._lock:
+        samples = [knowledge_index._entries[entry_id][1][0] for entry_id in knowledge_index._order[:200]]
+    index_before, scan_before = measure_kb_lookup(samples)
+
+    started = time.perf_counter()
+    clusters = knowledge_index.compact()
+    elapsed = time.perf_counter() - started
+
+    entries_after, _ = knowledge_index.size()
+    index_after, scan_after = measure_kb_lookup(samples)
+    return {
+        "entries_before": entries_before,
+        "entries_after": entries_after,
+        "questions": questions,
+        "clusters": len(clusters),
+        "lookup_ms_before": round(index_before, 4),
+        "lookup_ms_after": round(index_after, 4),
+        "scan_ms_before": round(scan_before, 3),
+        "scan_ms_after": round(scan_after, 3),
+        "compaction_seconds": round(elapsed, 2)
+    }
+
+async def compact_knowledge_job(context: CallbackContext):
+    """Периодическое объединение дублей в базе знаний"""
+    try:
+        report = await asyncio.to_thread(run_kb_compaction)
+        logger.info("Сжатие базы знаний: %s", report)
+        if report['clusters']:
+            await notify_admin(
+                context,
+                f"📚 Сжатие базы знаний\n\nЗаписей: {report['entries_before']} → {report['entries_after']} "
+                f"(групп дублей: {report['clusters']})\n"
+                f"Поиск ответа: {report['lookup_ms_before']:.3f} → {report['lookup_ms_after']:.3f} мс "
+                f"(перебор БД: {report['scan_ms_before']:.1f} → {report['scan_ms_after']:.1f} мс)"
+            )
+    except Exception as e:
+        logger.error("Ошибка сжатия базы знаний: %s", e)
 
 # ===== AI ФУНКЦИИ =====
 async def generate_ai_response(user_input: str) -> str:
     """Генерация ответа через AI"""
     try:
         # Сначала проверяем базу знаний
-        knowledge = db.get_knowledge_base()
+        answer = await asyncio.to_thread(knowledge_index.lookup, user_input)
+        if answer is not None:
+            return f"💡 {answer}\n\nЕсли нужна дополнительная информация, обращайтесь к менеджеру!"
         user_input_lower = user_input.lower()
 
-        for question, answer in knowledge:
-            if any(word in user_input_lower for word in question.lower().split() if len(word) > 3):
-                return f"💡 {answer}\n\nЕсли нужна дополнительная информация, обращайтесь к менеджеру!"
-
         # Ключевые слова для распознавания тем
         bot_keywords = ["бот", "telegram", "создани", "разраб", "автоматиз", "лид", "заявк", "интеграц"]
         price_keywords = ["цена", "стоимость", "сколько", "прайс", "тариф", "оплата", "стоит", "деньги"]
@@ -373,9 +2289,123 @@ async def generate_ai_response(user_input: str) -> str:
             return f"🤖 *Понял вас!*\n\nМы можем обсудить создание Telegram-бота для вашего бизнеса, который будет решать множество задач.\n\n{SERVICE_INFO}\n\nЧто вас интересует больше всего? Или, возможно, вы хотите оставить заявку на консультацию?"
 
     except Exception as e:
-        logger.error(f"AI response error: {str(e)}")
+        logger.error("AI response error: %s", str(e))
         return "🤖 Извините, произошла техническая ошибка. Попробуйте переформулировать вопрос или свяжитесь с менеджером напрямую."
 
+# ===== РАСПРЕДЕЛЕНИЕ ЗАЯВОК =====
+class AssignmentEngine:
+    """Назначает каждую заявку или вопрос одному менеджеру.
+
+    Методы вызываются из потоков (asyncio.to_thread) - состояние под блокировкой.
+    """
+
+    MODES = ('round_robin', 'least_loaded', 'sticky')
+    MAX_STICKY = 10000
+
+    def __init__(self, mode: str):
+        if mode not in self.MODES:
+            logger.warning("Неизвестный режим распределения %s, используется round_robin", mode)
+            mode = 'round_robin'
+        self.mode = mode
+        self._load = None  # manager_id -> количество открытых элементов, загружается лениво
+        self._sticky = OrderedDict()  # customer_id -> manager_id
+        self._lock = threading.RLock()
+
+    @property
+    def load(self):
+        # С несколькими воркерами нагрузка меняется и в других процессах - читаем из БД
+        if self._load is None or Config.INSTANCE_COUNT > 1:
+            self._load = db.get_open_assignment_counts()
+        return self._load
+
+    def pick(self, customer_id: int = None, exclude: int = None):
+        """Выбирает менеджера, не записывая назначение"""
+        with self._lock:
+            return self._pick(customer_id, exclude)
+
+    def _pick(self, customer_id: int = None, exclude: int = None):
+        managers = sorted(db.get_active_managers())
+        if not managers:
+            return None
+
+        # Если кроме текущего менеджера никого нет - оставляем его
+        candidates = [m for m in managers if m != exclude] or managers
+
+        if self.mode == 'sticky' and customer_id is not None:
+            manager_id = self._sticky.get(customer_id)
+            if manager_id is None:
+                manager_id = db.get_last_assignee(customer_id)
+            if manager_id in candidates:
+                self._remember(customer_id, manager_id)
+                return manager_id
+
+        if self.mode == 'round_robin':
+            # Счётчик в общем хранилище - очередь одна на все воркеры
+            manager_id = candidates[shared_store.incr('assignment:rr') % len(candidates)]
+        else:
+            manager_id = min(candidates, key=lambda m: (self.load.get(m, 0), m))
+
+        if customer_id is not None:
+            self._remember(customer_id, manager_id)
+        return manager_id
+
+    def _remember(self, customer_id: int, manager_id: int):
+        self._sticky[customer_id] = manager_id
+        self._sticky.move_to_end(customer_id)
+        if len(self._sticky) > self.MAX_STICKY:
+            self._sticky.popitem(last=False)
+
+    def assign(self, kind: str, item_id: int, customer_id: int, exclude: int = None):
+        """Назначает элемент менеджеру и сохраняет назначение в БД.
+
+        Если кроме exclude назначить некому, элемент остаётся у него без записи
+        (время назначения не сбрасывается) - вызывающий сравнивает результат с exclude.
+        """
+        with self._lock:
+            load = self.load  # Загружаем счётчики до записи, чтобы не учесть элемент дважды
+            manager_id = self._pick(customer_id, exclude)
+            if manager_id is None or manager_id == exclude:
+                return manager_id
+
+            db.assign_item(kind, item_id, manager_id)
+            if exclude is not None:
+                self.release(exclude)
+            load[manager_id] = load.get(manager_id, 0) + 1
+            return manager_id
+
+    def release(self, manager_id: int):
+        """Уменьшает нагрузку менеджера после закрытия элемента"""
+        self.release_many([manager_id])
+
+    def release_many(self, manager_ids):
+        """То же для нескольких закрытых элементов (счётчики читаются один раз)"""
+        with self._lock:
+            load = self.load
+            for manager_id in manager_ids:
+                if manager_id is not None and load.get(manager_id):
+                    load[manager_id] -= 1
+
+assignment_engine = AssignmentEngine(Config.ASSIGNMENT_MODE)
+
+def can_handle_assigned(user_id, assigned_to):
+    """Обработать элемент может назначенный менеджер или админ"""
+    return user_id == Config.ADMIN_USER_ID or assigned_to is None or assigned_to == user_id
+
+async def close_question(question_id: int, answer: str):
+    """Сохраняет ответ, добавляет его в базу знаний и снимает нагрузку с менеджера"""
+    question_data = db.get_question_by_id(question_id)
+    db.answer_question(question_id, answer)
+    if question_data:
+        if question_data[4] is None:
+            await asyncio.to_thread(assignment_engine.release, question_data[7])
+        # Поиск дубля перебирает записи с общими n-граммами - не на цикле событий.
+        # Ответ уже сохранён: ошибка базы знаний не должна помешать отправить его пользователю
+        try:
+            await asyncio.to_thread(knowledge_index.add, question_data[3], answer)
+        except Exception as e:
+            logger.error("Ошибка добавления ответа в базу знаний: %s", e)
+    return question_data
+
 # ===== ФУНКЦИИ УВЕДОМЛЕНИЙ =====
 async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str):
     """Отправка уведомления администратору"""
@@ -385,38 +2415,145 @@ async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str):
                 chat_id=Config.ADMIN_USER_ID,
                 text=message
             )
-            logger.info(f"Уведомление админу отправлено")
+            notify_logger.info("Уведомление админу отправлено")
         except Exception as e:
-            logger.error(f"Ошибка отправки уведомления админу: {e}")
+            notify_logger.error("Ошибка отправки уведомления админу: %s", e)
+
+class NotificationDigest:
+    """Буфер уведомлений для менеджеров, выбравших режим дайджеста.
+
+    Хранится в общем хранилище, чтобы события со всех воркеров попадали
+    в один дайджест.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def add(self, manager_id: int, message: str, question_id: int = None):
+        # Время первого события в окне
+        self.store.set(f"digest:{manager_id}:started", str(time.time()), nx=True)
+        self.store.push(f"digest:{manager_id}", json.dumps([message, question_id]))
+
+    def pop_due(self, intervals: dict, now: float = None):
+        """Забирает накопленные события тех менеджеров, у которых истекло окно"""
+        now = time.time() if now is None else now
+        due = {}
+        for manager_id, minutes in intervals.items():
+            started = self.store.get(f"digest:{manager_id}:started")
+            if started is None:
+                continue
+
+            # Менеджер переключился на мгновенный режим - отдаём сразу
+            if not minutes or now - float(started) >= minutes * 60:
+                self.store.delete(f"digest:{manager_id}:started")
+                events = [tuple(json.loads(event)) for event in self.store.pop_all(f"digest:{manager_id}")]
+                if events:
+                    due[manager_id] = events
+        return due
+
+notification_digest = NotificationDigest(shared_store)
+
+def render_digest(events: list):
+    """Собирает одно сообщение из накопленных событий"""
+    header = f"📬 *Дайджест: {len(events)} событий*\n\n"
+    parts = []
+    length = len(header)
+    for i, (message, _) in enumerate(events):
+        part = message if len(message) <= 500 else message[:500] + "..."
+        # Лимит Telegram - 4096 символов на сообщение
+        if length + len(part) + 100 > 4096:
+            parts.append(f"...и ещё {len(events) - i}")
+            break
+        parts.append(part)
+        length += len(part) + 2
+
+    question_ids = [question_id for _, question_id in events if question_id]
+    return header + "\n\n".join(parts), question_ids[:Config.DIGEST_MAX_BUTTONS]
+
+async def send_manager_notification(bot, manager_id: int, text: str, question_ids: list = None):
+    """Отправка одного сообщения менеджеру с кнопками ответа"""
+    try:
+        keyboard = []
+        for question_id in question_ids or []:
+            label = "💬 Ответить на вопрос" if len(question_ids) == 1 else f"💬 Ответить на вопрос #{question_id}"
+            keyboard.append([InlineKeyboardButton(label, callback_data=f'answer_question_from_manager_{question_id}')])
+        keyboard.append([InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')])
 
-async def notify_managers(context: ContextTypes.DEFAULT_TYPE, message: str, question_id: int = None):
-    """Отправка уведомления всем активным менеджерам"""
-    manager_ids = db.get_active_managers()
-    if not manager_ids:
+        await bot.send_message(
+            chat_id=manager_id,
+            text=text,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        notify_logger.info("Уведомление менеджеру %s отправлено", manager_id)
+    except Exception as e:
+        notify_logger.error("Ошибка отправки уведомления менеджеру %s: %s", manager_id, e)
+
+async def notify_managers(context: ContextTypes.DEFAULT_TYPE, message: str, question_id: int = None,
+                          event: str = None, manager_id: int = None):
+    """Отправка уведомления активным менеджерам (сразу или в дайджест).
+
+    Если передан manager_id, уведомляется только назначенный менеджер.
+    """
+    managers = db.get_manager_digest_settings()
+    if manager_id is not None:
+        managers = [m for m in managers if m[0] == manager_id]
+    if not managers:
         logger.warning("Нет активных менеджеров для уведомления.")
         return
 
-    for manager_id in manager_ids:
-        try:
-            keyboard = []
-            if question_id:
-                keyboard.append([InlineKeyboardButton("💬 Ответить на вопрос", callback_data=f'answer_question_from_manager_{question_id}')])
-            keyboard.append([InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')])
-            
-            await context.bot.send_message(
-                chat_id=manager_id,
-                text=f"📢 *Новое уведомление!*\n\n{message}",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            logger.info(f"Уведомление менеджеру {manager_id} отправлено")
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления менеджеру {manager_id}: {e}")
+    urgent = event in Config.DIGEST_URGENT_EVENTS
+    for target_id, digest_interval in managers:
+        if digest_interval and not urgent:
+            await asyncio.to_thread(notification_digest.add, target_id, message, question_id)
+            continue
+
+        await send_manager_notification(
+            context.bot,
+            target_id,
+            f"📢 *Новое уведомление!*\n\n{message}",
+            [question_id] if question_id else None
+        )
+
+async def flush_digests(context: CallbackContext):
+    """Отправка накопленных дайджестов, у которых истекло окно"""
+    try:
+        intervals = dict(db.get_manager_digest_settings())
+        for manager_id, events in (await asyncio.to_thread(notification_digest.pop_due, intervals)).items():
+            text, question_ids = render_digest(events)
+            await send_manager_notification(context.bot, manager_id, text, question_ids)
+    except Exception as e:
+        logger.error("Ошибка в задаче дайджестов: %s", e)
+
+async def reassign_stale_items(context: CallbackContext):
+    """Переназначение необработанных вовремя заявок и вопросов"""
+    try:
+        stale = db.get_stale_assignments(Config.ASSIGNMENT_TIMEOUT, Config.ASSIGNMENT_BATCH)
+        for kind, item_id, customer_id, old_manager_id in stale:
+            manager_id = await asyncio.to_thread(assignment_engine.assign, kind, item_id, customer_id, exclude=old_manager_id)
+            if manager_id is None:
+                logger.warning("Нет активных менеджеров для переназначения.")
+                return
+            if manager_id == old_manager_id:
+                # Единственный активный менеджер - передать некому, повторно не уведомляем
+                continue
+
+            if kind == 'request':
+                req = db.get_request_by_id(item_id)
+                message = f"🔁 Вам назначена заявка #{item_id}\n\n👤 От: @{req[2] or 'N/A'}\n🏢 Бизнес: {req[4]}\n🔧 Задачи: {req[5][:100]}...\n📱 Контакт: {req[3]}"
+                await notify_managers(context, message, event='request', manager_id=manager_id)
+            else:
+                q = db.get_question_by_id(item_id)
+                message = f"🔁 Вам назначен вопрос #{item_id}\n\n👤 От: @{q[2] or 'N/A'}\n📝 Вопрос: {q[3]}"
+                await notify_managers(context, message, item_id, event='question', manager_id=manager_id)
+            logger.info("%s #%s переназначен: %s -> %s", kind, item_id, old_manager_id, manager_id)
+    except Exception as e:
+        logger.error("Ошибка в задаче переназначения: %s", e)
 
 async def send_answer_to_user(context: ContextTypes.DEFAULT_TYPE, question_id: int, answer: str):
     """Отправка ответа пользователю, который задал вопрос"""
     question_data = db.get_question_by_id(question_id)
     if not question_data:
-        logger.error(f"Не удалось найти вопрос с ID {question_id}")
+        logger.error("Не удалось найти вопрос с ID %s", question_id)
         return
 
     user_id = question_data[1]
@@ -424,12 +2561,297 @@ async def send_answer_to_user(context: ContextTypes.DEFAULT_TYPE, question_id: i
     try:
         await context.bot.send_message(
             chat_id=user_id,
-            text=f"💬 *Ответ на ваш вопрос:*\n\n{answer}",
+            text=ANSWER_MESSAGE.format(answer=answer),
             reply_markup=menu_buttons
         )
-        logger.info(f"Ответ на вопрос #{question_id} отправлен пользователю {user_id}")
+        logger.info("Ответ на вопрос #%s отправлен пользователю %s", question_id, user_id)
     except Exception as e:
-        logger.error(f"Ошибка отправки ответа пользователю {user_id}: {e}")
+        logger.error("Ошибка отправки ответа пользователю %s: %s", user_id, e)
+
+# ===== ОЧЕРЕДЬ УВЕДОМЛЕНИЙ =====
+class BulkProgress:
+    """Прогресс отправки уведомлений по массовому действию - одно сообщение, обновляемое на месте"""
+
+    def __init__(self, chat_id: int, message_id: int, title: str, total: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.title = title
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.last_edit = 0.0
+
+    @property
+    def done(self):
+        return self.sent + self.failed >= self.total
+
+    def record(self, ok: bool):
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def render(self):
+        if not self.done:
+            return f"{self.title}\n\n⏳ Уведомления: {self.sent + self.failed}/{self.total}"
+        text = f"{self.title}\n\n✅ Уведомлено пользователей: {self.sent}/{self.total}"
+        if self.failed:
+            text += f"\n⚠️ Не доставлено: {self.failed}"
+        return text
+
+class NotificationQueue:
+    """Фоновая отправка сообщений с общим лимитом скорости (token bucket).
+
+    Ответ 429 (RetryAfter) приостанавливает всю очередь на указанное время,
+    сообщение отправляется повторно. Задачи-отправители создаются при первом
+    сообщении, уже внутри цикла событий бота.
+    """
+
+    def __init__(self, rate: float, burst: int, workers: int):
+        self.rate = rate
+        self.burst = burst
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def submit(self, bot, chat_id: int, text: str, progress: BulkProgress = None, **kwargs):
+        """Ставит сообщение в очередь; kwargs передаются в bot.send_message"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._queue.put_nowait((bot, chat_id, text, kwargs, progress))
+
+    @property
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def get_stats(self):
+        return {"pending": self.pending, "sent": self.sent, "failed": self.failed, "retried": self.retried}
+
+    async def _acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _worker(self):
+        clear_log_context()
+        while True:
+            bot, chat_id, text, kwargs, progress = await self._queue.get()
+            try:
+                status = await self.send(bot, chat_id, text, **kwargs)
+                if progress is not None:
+                    progress.record(status == 'sent')
+                    await self._report(bot, progress)
+            except Exception as e:
+                notify_logger.error("Ошибка в очереди уведомлений: %s", e)
+            finally:
+                self._queue.task_done()
+
+    async def send(self, bot, chat_id: int, text: str, before_attempt=None, **kwargs):
+        """Отправка в общем лимите скорости, минуя очередь: 'sent', 'blocked' или 'failed'.
+
+        before_attempt() вызывается непосредственно перед каждым запросом к Bot API.
+        """
+        status = 'failed'
+        for attempt in range(Config.NOTIFY_MAX_RETRIES + 1):
+            await self._acquire()
+            if before_attempt is not None:
+                before_attempt()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.sent += 1
+                return 'sent'
+            except RetryAfter as e:
+                self.retried += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+                notify_logger.warning("Telegram ограничил отправку, пауза %s сек", e.retry_after)
+            except Forbidden:
+                # Пользователь заблокировал бота - повтор не поможет
+                status = 'blocked'
+                break
+            except Exception as e:
+                notify_logger.error("Ошибка отправки уведомления пользователю %s: %s", chat_id, e)
+                break
+        self.failed += 1
+        return status
+
+    async def _report(self, bot, progress: BulkProgress):
+        now = time.monotonic()
+        if not progress.done and now - progress.last_edit < Config.BULK_PROGRESS_INTERVAL:
+            return
+        progress.last_edit = now
+        await self.edit_text(bot, progress.chat_id, progress.message_id, progress.render(),
+                             get_admin_keyboard() if progress.done else None)
+
+    async def edit_text(self, bot, chat_id: int, message_id: int, text: str, reply_markup=None):
+        """Обновление сообщения о прогрессе в том же лимите скорости"""
+        await self._acquire()
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup)
+        except BadRequest:
+            # Текст не изменился или сообщение удалено
+            pass
+
+notification_queue = NotificationQueue(Config.NOTIFY_RATE, Config.NOTIFY_BURST, Config.NOTIFY_WORKERS)
+
+# ===== РАССЫЛКИ =====
+BROADCAST_STATUS_LABELS = {'running': "⏳ идёт", 'done': "✅ завершена", 'cancelled': "⏹ остановлена"}
+
+def render_broadcast(broadcast, rate: float = None):
+    """Текст сообщения о прогрессе рассылки (строка из db.get_broadcast)"""
+    broadcast_id, text, status, _, total, sent, failed, blocked = broadcast[:8]
+    processed = sent + failed + blocked
+    result = (f"📣 Рассылка #{broadcast_id}: {BROADCAST_STATUS_LABELS.get(status, status)}\n\n"
+              f"📝 {text[:100]}\n\n"
+              f"✅ Доставлено: {sent} из {total}\n"
+              f"🚫 Заблокировали бота: {blocked}\n"
+              f"⚠️ Ошибок: {failed}")
+    if status == 'running' and rate:
+        remaining = max(total - processed, 0)
+        result += f"\n🚀 Скорость: {rate:.1f} сообщ./сек\n⏱ Осталось: ~{int(remaining / rate // 60)} мин"
+    return result
+
+def get_broadcast_keyboard(broadcast):
+    if broadcast[2] == 'running':
+        return InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Остановить", callback_data=f'admin_broadcast_cancel_{broadcast[0]}')]])
+    return get_admin_keyboard()
+
+class Broadcaster:
+    """Выполняет рассылки в фоне.
+
+    Получатели читаются пачками по курсору user_id, внутри пачки сообщения
+    уходят параллельно (BROADCAST_CONCURRENCY) в общем лимите скорости
+    notification_queue. Каждый получатель отмечается как pending прямо
+    перед своей отправкой, и после перезапуска отмеченным сообщение повторно
+    не уходит: не более одного сообщения на пользователя. Если остановка
+    пришлась до запроса к Bot API, отметка снимается и сообщение уйдёт после
+    перезапуска. Курсор, счётчики и итоговые статусы пишутся одной
+    транзакцией на пачку.
+    """
+
+    def __init__(self, sender: NotificationQueue):
+        self.sender = sender
+        self._tasks = {}  # broadcast_id -> asyncio.Task
+
+    def is_running(self, broadcast_id: int):
+        return broadcast_id in self._tasks
+
+    def start(self, bot, broadcast_id: int):
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, bot, broadcast_id: int):
+        clear_log_context()
+        broadcast = await asyncio.to_thread(db.get_broadcast, broadcast_id)
+        text, cursor = broadcast[1], broadcast[8]
+        # Отправки, прерванные прошлым запуском на середине пачки
+        interrupted = await asyncio.to_thread(db.settle_interrupted_deliveries, broadcast_id)
+        if interrupted:
+            logger.warning("Рассылка #%s: %s доставок прервано перезапуском, повторно не отправляются", broadcast_id, interrupted)
+        semaphore = asyncio.Semaphore(Config.BROADCAST_CONCURRENCY)
+        started, delivered, last_edit = time.monotonic(), 0, 0.0
+        logger.info("Рассылка #%s: старт с user_id > %s", broadcast_id, cursor)
+
+        async def deliver(user_id):
+            async with semaphore:
+                attempted = False
+
+                def mark_attempted():
+                    nonlocal attempted
+                    attempted = True
+
+                claim = asyncio.ensure_future(asyncio.to_thread(db.claim_broadcast_delivery, broadcast_id, user_id))
+                send = None
+                try:
+                    if not await asyncio.shield(claim):
+                        return None  # Уже отправлялось до перезапуска
+                    send = asyncio.ensure_future(self.sender.send(bot, user_id, text, before_attempt=mark_attempted))
+                    return user_id, await asyncio.shield(send)
+                except asyncio.CancelledError:
+                    if attempted:
+                        # Запрос уже ушёл в Bot API - дожидаемся ответа, чтобы записать точный статус
+                        return user_id, await send
+                    # Запрос не начинался - снимаем отметку, сообщение уйдёт после перезапуска
+                    if send is not None:
+                        send.cancel()
+                    if await asyncio.shield(claim):
+                        await asyncio.shield(asyncio.to_thread(db.release_broadcast_delivery, broadcast_id, user_id))
+                    raise
+
+        try:
+            while broadcast[2] == 'running':
+                # В многопроцессном режиме рассылку ведёт только лидер
+                if not cluster.is_leader:
+                    logger.info("Рассылка #%s: лидерство потеряно, остановка", broadcast_id)
+                    return
+
+                recipients = await asyncio.to_thread(db.get_broadcast_recipients, cursor, Config.BROADCAST_BATCH)
+                if not recipients:
+                    await asyncio.to_thread(db.set_broadcast_status, broadcast_id, 'done')
+                else:
+                    tasks = [asyncio.ensure_future(deliver(user_id)) for user_id in recipients]
+                    try:
+                        results = [result for result in await asyncio.gather(*tasks) if result is not None]
+                    except asyncio.CancelledError:
+                        # Остановка посреди пачки: сохраняем доставки, запрос по которым успел уйти.
+                        # pending остаются только при аварийном завершении процесса.
+                        # gather завершается по первой отменённой задаче - дожидаемся остальных
+                        await asyncio.wait(tasks)
+                        done = [task.result() for task in tasks
+                                if task.done() and not task.cancelled() and task.exception() is None
+                                and task.result() is not None]
+                        await asyncio.shield(asyncio.to_thread(db.record_broadcast_batch, broadcast_id, None, done))
+                        raise
+                    cursor = recipients[-1]
+                    await asyncio.to_thread(db.record_broadcast_batch, broadcast_id, cursor, results)
+                    delivered += len(results)
+
+                broadcast = await asyncio.to_thread(db.get_broadcast, broadcast_id)
+                now = time.monotonic()
+                if broadcast[2] != 'running' or now - last_edit >= Config.BROADCAST_PROGRESS_INTERVAL:
+                    last_edit = now
+                    await self._report(bot, broadcast, delivered / (now - started))
+
+            logger.info(
+                "Рассылка #%s %s: доставлено %s, заблокировали %s, ошибок %s, %.1f сообщ./сек",
+                broadcast_id, broadcast[2], broadcast[5], broadcast[7], broadcast[6],
+                delivered / (time.monotonic() - started)
+            )
+        except Exception as e:
+            logger.error("Ошибка рассылки #%s: %s", broadcast_id, e)
+
+    async def _report(self, bot, broadcast, rate: float):
+        if broadcast[9] and broadcast[10]:
+            await self.sender.edit_text(bot, broadcast[9], broadcast[10], render_broadcast(broadcast, rate),
+                                        get_broadcast_keyboard(broadcast))
+
+broadcaster = Broadcaster(notification_queue)
+
+async def resume_broadcasts(context: CallbackContext):
+    """Запускает рассылки в статусе running, которые ещё не выполняются (новые и прерванные перезапуском)"""
+    try:
+        for broadcast in db.get_broadcasts('running', limit=100):
+            if not broadcaster.is_running(broadcast[0]):
+                broadcaster.start(context.bot, broadcast[0])
+    except Exception as e:
+        logger.error("Ошибка возобновления рассылок: %s", e)
 
 # ===== ОСНОВНЫЕ ФУНКЦИИ БОТА =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -439,9 +2861,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Добавляем пользователя как менеджера, если он есть в списке Config
     if user_id in Config.MANAGER_USER_IDS:
-        db.add_manager(user_id, update.message.from_user.username)
+        if db.add_manager(user_id, update.message.from_user.username):
+            await asyncio.to_thread(manager_cache.invalidate)
 
-    reply_markup = get_main_menu_keyboard(user_id)
+    reply_markup = get_main_menu_keyboard(await asyncio.to_thread(is_admin_or_manager, user_id))
     await update.message.reply_text(GREETING, reply_markup=reply_markup)
 
 async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -449,12 +2872,15 @@ async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
+    funnel.track_click(user_id, query.data)
 
     try:
         # Кнопка "Вернуться в меню"
         if query.data == 'back_to_menu':
+            if 'step' in context.user_data:
+                track_flow_step(context, user_id, f"flow_abandon_{context.user_data['step']}")
             context.user_data.clear()
-            reply_markup = get_main_menu_keyboard(user_id)
+            reply_markup = get_main_menu_keyboard(await asyncio.to_thread(is_admin_or_manager, user_id))
             await query.edit_message_text(text=GREETING, reply_markup=reply_markup)
             return
 
@@ -471,6 +2897,8 @@ async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Обычные пользовательские кнопки
         elif query.data == 'request_bot':
             context.user_data['step'] = 0
+            context.user_data.pop('flow_ts', None)
+            track_flow_step(context, user_id, 'flow_start')
             menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
             await query.edit_message_text(text=REQUEST_FLOW[0], reply_markup=menu_buttons)
 
@@ -488,7 +2916,7 @@ async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Админ панель
         elif query.data == 'admin_panel':
-            if is_admin_or_manager(user_id):
+            if await asyncio.to_thread(is_admin_or_manager, user_id):
                 reply_markup = get_admin_keyboard()
                 await query.edit_message_text("🔐 *Панель управления:*", reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
             else:
@@ -497,8 +2925,14 @@ async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Обработка ответов от менеджеров
         elif query.data.startswith('answer_question_from_manager_'):
-            if is_admin_or_manager(user_id):
+            if await asyncio.to_thread(is_admin_or_manager, user_id):
                 question_id = int(query.data.split('_')[-1])
+                question_data = db.get_question_by_id(question_id)
+                if question_data and not can_handle_assigned(user_id, question_data[7]):
+                    menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
+                    await query.edit_message_text("❌ Вопрос назначен другому менеджеру", reply_markup=menu_buttons)
+                    return
+
                 context.user_data['answering_question_as_manager'] = question_id
                 reply_markup = InlineKeyboardMarkup(get_menu_buttons())
                 await query.edit_message_text(
@@ -510,11 +2944,11 @@ async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.edit_message_text("❌ У вас нет прав для этого действия", reply_markup=menu_buttons)
 
         # Админские кнопки
-        elif query.data.startswith('admin_') and is_admin_or_manager(user_id):
+        elif query.data.startswith('admin_') and await asyncio.to_thread(is_admin_or_manager, user_id):
             await handle_admin_callbacks(query, context)
         
         # Кнопки принятия/отклонения заявок
-        elif query.data.startswith(('accept_req_', 'reject_req_')) and is_admin_or_manager(user_id):
+        elif query.data.startswith(('accept_req_', 'reject_req_')) and await asyncio.to_thread(is_admin_or_manager, user_id):
             await handle_request_actions(query, context)
             
         else:
@@ -522,7 +2956,7 @@ async def handle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ У вас нет прав для этого действия", reply_markup=menu_buttons)
 
     except Exception as e:
-        logger.error(f"Ошибка в обработчике callback: {e}")
+        logger.error("Ошибка в обработчике callback: %s", e)
         menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
         try:
             await query.edit_message_text("❌ Произошла ошибка. Попробуйте позже.", reply_markup=menu_buttons)
@@ -533,42 +2967,48 @@ async def handle_request_actions(query, context):
     """Обработка действий с заявками"""
     user_id = query.from_user.id
     
+    request_id = int(query.data.split('_')[2])
+    request_data = db.get_request_by_id(request_id)
+    if request_data:
+        if not can_handle_assigned(user_id, request_data[8]):
+            reply_markup = get_admin_keyboard()
+            await query.edit_message_text(f"❌ Заявка #{request_id} назначена другому менеджеру", reply_markup=reply_markup)
+            return
+        if request_data[6] == 'new':
+            await asyncio.to_thread(assignment_engine.release, request_data[8])
+
     if query.data.startswith('accept_req_'):
-        request_id = int(query.data.split('_')[2])
         db.update_request_status(request_id, "accepted")
         
         # Уведомляем пользователя о принятии заявки
-        request_data = db.get_request_by_id(request_id)
         if request_data:
             try:
                 await context.bot.send_message(
                     chat_id=request_data[1],
-                    text=f"✅ *Ваша заявка принята!*\n\nНаш менеджер свяжется с вами в ближайшее время.\n\nЗаявка #{request_id}",
+                    text=REQUEST_STATUS_MESSAGES['accepted'].format(request_id=request_id),
                     reply_markup=InlineKeyboardMarkup(get_menu_buttons()),
                     parse_mode=ParseMode.MARKDOWN
                 )
             except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя о принятии заявки: {e}")
+                logger.error("Ошибка уведомления пользователя о принятии заявки: %s", e)
         
         reply_markup = get_admin_keyboard()
         await query.edit_message_text(f"✅ Заявка #{request_id} принята", reply_markup=reply_markup)
 
     elif query.data.startswith('reject_req_'):
-        request_id = int(query.data.split('_')[2])
         db.update_request_status(request_id, "rejected")
         
         # Уведомляем пользователя об отклонении заявки
-        request_data = db.get_request_by_id(request_id)
         if request_data:
             try:
                 await context.bot.send_message(
                     chat_id=request_data[1],
-                    text=f"❌ *К сожалению, ваша заявка не подошла.*\n\nВы можете оставить новую заявку с другими требованиями.\n\nЗаявка #{request_id}",
+                    text=REQUEST_STATUS_MESSAGES['rejected'].format(request_id=request_id),
                     reply_markup=InlineKeyboardMarkup(get_menu_buttons()),
                     parse_mode=ParseMode.MARKDOWN
                 )
             except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя об отклонении заявки: {e}")
+                logger.error("Ошибка уведомления пользователя об отклонении заявки: %s", e)
         
         reply_markup = get_admin_keyboard()
         await query.edit_message_text(f"❌ Заявка #{request_id} отклонена", reply_markup=reply_markup)
@@ -577,65 +3017,65 @@ async def handle_admin_callbacks(query, context):
     """Обработка админских callback-запросов"""
     user_id = query.from_user.id
 
-    if query.data == 'admin_requests':
-        requests = db.get_requests()
-        if not requests:
-            reply_markup = get_admin_keyboard()
-            await query.edit_message_text("🟢 Новых заявок нет", reply_markup=reply_markup)
-            return
+    if query.data == 'admin_requests' or query.data.startswith('admin_requests_after_'):
+        before_id = int(query.data.split('_')[-1]) if query.data != 'admin_requests' else None
+        await show_open_page(query, context, 'request', before_id)
 
-        await query.edit_message_text("📋 Загружаю заявки...", reply_markup=None)
-        
-        for req in requests:
-            text = f"📋 Заявка #{req[0]}\n👤 Пользователь: @{req[2] or 'N/A'}\n📱 Контакт: {req[3]}\n🏢 Бизнес: {req[4]}\n🔧 Задачи: {req[5]}\n📅 Создана: {req[7]}"
+    elif query.data == 'admin_questions' or query.data.startswith('admin_questions_after_'):
+        before_id = int(query.data.split('_')[-1]) if query.data != 'admin_questions' else None
+        await show_open_page(query, context, 'question', before_id)
 
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Принять", callback_data=f'accept_req_{req[0]}'),
-                    InlineKeyboardButton("❌ Отклонить", callback_data=f'reject_req_{req[0]}')
-                ],
-                [InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')]
-            ]
-            await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    elif query.data.startswith('admin_bulk_'):
+        await handle_bulk_actions(query, context)
 
-    elif query.data == 'admin_questions':
-        questions = db.get_questions(answered=False)
-        if not questions:
-            reply_markup = get_admin_keyboard()
-            await query.edit_message_text("🟢 Новых вопросов нет", reply_markup=reply_markup)
-            return
-
-        await query.edit_message_text("❓ Загружаю вопросы...", reply_markup=None)
-        
-        for q in questions:
-            text = f"❓ Вопрос #{q[0]}\n👤 От: @{q[2] or 'N/A'}\n📝 Текст: {q[3]}\n📅 Создан: {q[5]}"
-
-            keyboard = [
-                [InlineKeyboardButton("💬 Ответить", callback_data=f'answer_{q[0]}')],
-                [InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')]
-            ]
-            await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    elif query.data.startswith('admin_broadcast'):
+        await handle_broadcast_actions(query, context)
 
     elif query.data == 'admin_stats':
         stats = db.get_stats()
-        text = f"📊 *Статистика бота:*\n\n📝 Всего заявок: {stats['total_requests']}\n🆕 Новых: {stats['new_requests']}\n✅ Принятых: {stats['accepted_requests']}\n\n❓ Всего вопросов: {stats['total_questions']}\n⏳ Неотвеченных: {stats['unanswered_questions']}\n👨‍💼 Активных менеджеров: {stats['active_managers']}"
+        text = f"📊 *Статистика бота:*\n\n📝 Всего заявок: {stats['total_requests']}\n🆕 Новых: {stats['new_requests']}\n✅ Принятых: {stats['accepted_requests']}\n\n❓ Всего вопросов: {stats['total_questions']}\n⏳ Неотвеченных: {stats['unanswered_questions']}\n👨‍💼 Активных менеджеров: {stats['active_managers']}\n🚫 Отклонено (флуд): {rate_limiter.rejected}"
 
         reply_markup = get_admin_keyboard()
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
 
-    elif query.data == 'admin_knowledge':
-        knowledge = db.get_knowledge_base()
-        if not knowledge:
+    elif query.data == 'admin_knowledge' or query.data.startswith('admin_knowledge_after_'):
+        before_id = int(query.data.split('_')[-1]) if query.data != 'admin_knowledge' else None
+        await show_knowledge_page(query, context, before_id)
+
+    elif query.data.startswith('admin_kb_'):
+        await handle_knowledge_actions(query, context)
+
+    elif query.data == 'admin_archive':
+        stats = db.get_stats(include_archive=True)
+        size, free = db.get_size()
+        text = f"🗄 Архив:\n\n📝 Заявок в архиве: {stats['archived_requests']}\n❓ Вопросов в архиве: {stats['archived_questions']}\n💾 Рабочая база: {format_bytes(size)} (свободно {format_bytes(free)})\n\nПоследние архивные заявки:\n"
+        for req in db.get_archived('request', limit=5):
+            text += f"#{req[0]} @{req[2] or 'N/A'} - {req[6]} ({req[7]})\n"
+
+        reply_markup = get_admin_keyboard()
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+    elif query.data == 'admin_digest':
+        current = db.get_manager_digest_interval(user_id)
+        if current is None:
             reply_markup = get_admin_keyboard()
-            await query.edit_message_text("📚 База знаний пуста", reply_markup=reply_markup)
+            await query.edit_message_text("❌ Режим уведомлений настраивается только для менеджеров.", reply_markup=reply_markup)
             return
 
-        text = "📚 *База знаний:*\n\n"
-        for i, (question, answer) in enumerate(knowledge[-5:], 1):
-            text += f"{i}. *Q:* {question[:50]}...\n   *A:* {answer[:50]}...\n\n"
+        await query.edit_message_text(
+            "🔔 Выберите, как получать уведомления о заявках и вопросах:",
+            reply_markup=get_digest_keyboard(current)
+        )
 
-        reply_markup = get_admin_keyboard()
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    elif query.data.startswith('admin_digest_set_'):
+        minutes = int(query.data.split('_')[-1])
+        if minutes not in Config.DIGEST_INTERVAL_OPTIONS or not db.set_manager_digest_interval(user_id, minutes):
+            reply_markup = get_admin_keyboard()
+            await query.edit_message_text("❌ Не удалось изменить режим уведомлений.", reply_markup=reply_markup)
+            return
+
+        mode = "мгновенные уведомления" if minutes == 0 else f"дайджест раз в {minutes} мин"
+        await query.edit_message_text(f"✅ Режим уведомлений: {mode}", reply_markup=get_digest_keyboard(minutes))
 
     elif query.data == 'admin_add_manager':
         context.user_data['mode'] = 'add_manager'
@@ -673,17 +3113,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.from_user.username or "N/A"
     text = update.message.text
 
+    # Защита от флуда - до любых обращений к БД и уведомлений
+    if not await asyncio.to_thread(is_rate_limit_exempt, user_id):
+        allowed, cooldown = rate_limiter.check(user_id)
+        if not allowed:
+            if cooldown:
+                await update.message.reply_text(
+                    f"⏳ Слишком много сообщений. Пожалуйста, подождите {cooldown} сек."
+                )
+            return
+
     # Проверяем, это менеджер и он отвечает на вопрос
     if 'answering_question_as_manager' in context.user_data:
-        if is_admin_or_manager(user_id):
+        if await asyncio.to_thread(is_admin_or_manager, user_id):
             question_id = context.user_data['answering_question_as_manager']
             answer = text
-            db.answer_question(question_id, answer)
-
-            # Получаем текст вопроса и добавляем в базу знаний
-            question_data = db.get_question_by_id(question_id)
-            if question_data:
-                db.add_to_knowledge_base(question_data[3], answer)
+            await close_question(question_id, answer)
 
             # Отправляем ответ пользователю
             await send_answer_to_user(context, question_id, answer)
@@ -697,12 +3142,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id == Config.ADMIN_USER_ID and 'answering_question' in context.user_data:
         question_id = context.user_data['answering_question']
         answer = text
-        db.answer_question(question_id, answer)
-
-        # Получаем текст вопроса и добавляем в базу знаний
-        question_data = db.get_question_by_id(question_id)
-        if question_data:
-            db.add_to_knowledge_base(question_data[3], answer)
+        await close_question(question_id, answer)
 
         # Уведомляем пользователя об ответе
         await send_answer_to_user(context, question_id, answer)
@@ -718,6 +3158,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 manager_user_id = int(text)
                 if db.add_manager(manager_user_id, "N/A"):
+                    await asyncio.to_thread(manager_cache.invalidate)
                     await update.message.reply_text(f"✅ Пользователь с ID {manager_user_id} добавлен в менеджеры.")
                 else:
                     await update.message.reply_text(f"❌ Пользователь с ID {manager_user_id} уже является менеджером.")
@@ -731,10 +3172,52 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("🔐 Админ панель:", reply_markup=reply_markup)
                 return
 
+        elif context.user_data['mode'] == 'bulk_filter' and await asyncio.to_thread(is_admin_or_manager, user_id):
+            kind = context.user_data.pop('bulk_filter_kind', 'request')
+            del context.user_data['mode']
+            context.user_data.setdefault('bulk_filters', {})[kind] = text.strip()
+            count = db.count_open(kind, **get_bulk_scope(context, user_id, kind))
+            keyboard = [[InlineKeyboardButton("📋 Показать", callback_data=BULK_PAGE_CALLBACKS[kind])]]
+            await update.message.reply_text(f"🔎 Фильтр «{text.strip()}»: найдено {count}", reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+
+        elif context.user_data['mode'] == 'kb_search' and await asyncio.to_thread(is_admin_or_manager, user_id):
+            del context.user_data['mode']
+            context.user_data['kb_search'] = text.strip()
+            keyboard = [[InlineKeyboardButton("📋 Показать", callback_data='admin_knowledge')]]
+            await update.message.reply_text(
+                f"🔎 Поиск «{text.strip()}»: найдено {db.count_knowledge(text.strip())}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return
+
+        elif context.user_data['mode'] == 'kb_edit' and await asyncio.to_thread(is_admin_or_manager, user_id):
+            del context.user_data['mode']
+            edit = context.user_data.pop('kb_edit', {})
+            entry_id = edit.get('entry_id')
+            if entry_id is None or not await asyncio.to_thread(knowledge_index.update, entry_id, **{edit['field']: text.strip()}):
+                await update.message.reply_text("❌ Запись базы знаний не найдена", reply_markup=get_admin_keyboard())
+                return
+            logger.info("Запись базы знаний #%s изменена пользователем %s", entry_id, user_id)
+            entry_text, reply_markup = render_knowledge_entry(db.get_knowledge_entry(entry_id))
+            await update.message.reply_text(f"✅ Сохранено\n\n{entry_text}", reply_markup=reply_markup)
+            return
+
+        elif context.user_data['mode'] == 'broadcast_text' and user_id == Config.ADMIN_USER_ID:
+            del context.user_data['mode']
+            context.user_data['broadcast_text'] = text
+            keyboard = [
+                [InlineKeyboardButton(f"✅ Отправить ({db.count_users()} получателей)", callback_data='admin_broadcast_send')],
+                [InlineKeyboardButton("✖️ Отмена", callback_data='admin_broadcast')]
+            ]
+            await update.message.reply_text(f"📣 Предпросмотр рассылки:\n\n{text}", reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+
         elif context.user_data['mode'] == 'remove_manager' and user_id == Config.ADMIN_USER_ID:
             try:
                 manager_user_id = int(text)
                 db.remove_manager(manager_user_id)
+                await asyncio.to_thread(manager_cache.invalidate)
                 await update.message.reply_text(f"✅ Пользователь с ID {manager_user_id} удалён из менеджеров.")
             except ValueError:
                 await update.message.reply_text("❌ Неверный формат ID. Пожалуйста, введите число.")
@@ -753,12 +3236,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if step == 0:
             context.user_data['step'] = 1
             context.user_data['business_type'] = text
+            track_flow_step(context, user_id, 'step_business')
             menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
             await update.message.reply_text(REQUEST_FLOW[1], reply_markup=menu_buttons)
 
         elif step == 1:
             context.user_data['step'] = 2
             context.user_data['bot_tasks'] = text
+            track_flow_step(context, user_id, 'step_tasks')
             menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
             await update.message.reply_text(REQUEST_FLOW[2], reply_markup=menu_buttons)
 
@@ -772,12 +3257,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
 
             request_id = db.add_request(request_data)
-            logger.info(f"Новая заявка #{request_id} от пользователя {user_id}")
+            track_flow_step(context, user_id, 'flow_complete')
+            manager_id = await asyncio.to_thread(assignment_engine.assign, 'request', request_id, user_id)
+            logger.info("Новая заявка #%s от пользователя %s, менеджер %s", request_id, user_id, manager_id)
 
             # Уведомляем администратора и менеджеров
             message = f"🚀 Новая заявка #{request_id}!\n\n👤 От: @{username}\n🏢 Бизнес: {request_data['business_type']}\n🔧 Задачи: {request_data['bot_tasks'][:100]}...\n📱 Контакт: {text}"
             await notify_admin(context, message)
-            await notify_managers(context, message)
+            await notify_managers(context, message, event='request', manager_id=manager_id)
 
             menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
             await update.message.reply_text(
@@ -790,12 +3277,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Обработка AI вопроса
     elif context.user_data.get('mode') == 'ai_question':
         question_id = db.add_question(user_id, username, text)
-        logger.info(f"Новый вопрос #{question_id} от пользователя {user_id}")
+        manager_id = await asyncio.to_thread(assignment_engine.assign, 'question', question_id, user_id)
+        logger.info("Новый вопрос #%s от пользователя %s, менеджер %s", question_id, user_id, manager_id)
 
         # Уведомляем админа и менеджеров о новом вопросе
         message = f"❓ Новый вопрос #{question_id}!\n\n👤 От: @{username}\n📝 Вопрос: {text}"
         await notify_admin(context, message)
-        await notify_managers(context, message, question_id)
+        await notify_managers(context, message, question_id, event='question', manager_id=manager_id)
 
         # Генерируем AI ответ
         response = await generate_ai_response(text)
@@ -807,7 +3295,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif context.user_data.get('mode') == 'contact':
         message = f"👤 Запрос на связь с менеджером:\n\nID: {user_id}\nUsername: @{username}\nКонтакт: {text}"
         await notify_admin(context, message)
-        await notify_managers(context, message)
+        # Запрос на связь не хранится в БД - выбираем менеджера без записи назначения
+        await notify_managers(context, message, event='contact', manager_id=await asyncio.to_thread(assignment_engine.pick, user_id))
         
         menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
         await update.message.reply_text(
@@ -820,12 +3309,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Обычное сообщение - обработка AI
     else:
         question_id = db.add_question(user_id, username, text)
-        logger.info(f"Новый вопрос #{question_id} от пользователя {user_id}")
+        manager_id = await asyncio.to_thread(assignment_engine.assign, 'question', question_id, user_id)
+        logger.info("Новый вопрос #%s от пользователя %s, менеджер %s", question_id, user_id, manager_id)
 
         # Уведомляем админа и менеджеров о новом вопросе
         message = f"❓ Новый вопрос #{question_id}!\n\n👤 От: @{username}\n📝 Вопрос: {text}"
         await notify_admin(context, message)
-        await notify_managers(context, message, question_id)
+        await notify_managers(context, message, question_id, event='question', manager_id=manager_id)
 
         response = await generate_ai_response(text)
         menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
@@ -835,7 +3325,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Панель администратора"""
     user_id = update.message.from_user.id
-    if not is_admin_or_manager(user_id):
+    if not await asyncio.to_thread(is_admin_or_manager, user_id):
         menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
         await update.message.reply_text("❌ У вас нет прав доступа", reply_markup=menu_buttons)
         return
@@ -843,6 +3333,333 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = get_admin_keyboard()
     await update.message.reply_text("🔐 *Панель управления:*", reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
 
+# Массовые действия: страницы открытых элементов, фильтр и закрытие выборки одной командой
+BULK_PAGE_CALLBACKS = {'request': 'admin_requests', 'question': 'admin_questions'}
+
+def get_bulk_scope(context, user_id: int, kind: str):
+    """Фильтр из админ-панели; менеджер работает только со своими и неназначенными элементами"""
+    return {
+        'pattern': context.user_data.get('bulk_filters', {}).get(kind),
+        'manager_id': None if user_id == Config.ADMIN_USER_ID else user_id
+    }
+
+async def show_open_page(query, context, kind: str, before_id: int = None):
+    """Страница новых заявок или вопросов в одном сообщении"""
+    scope = get_bulk_scope(context, query.from_user.id, kind)
+    rows = db.get_open_page(kind, before_id, Config.ADMIN_PAGE_SIZE, **scope)
+    context.user_data['bulk_page'] = {'kind': kind, 'ids': [row[0] for row in rows]}
+    page_callback = BULK_PAGE_CALLBACKS[kind]
+    pattern = scope['pattern']
+
+    keyboard = []
+    if kind == 'request':
+        text = "📝 Новые заявки"
+        for req in rows:
+            text += f"\n\n#{req[0]} @{req[2] or 'N/A'} · {req[4][:30]}\n📱 {req[3]}\n🔧 {req[5][:60]}\n👨‍💼 {req[8] or 'не назначен'}"
+            keyboard.append([
+                InlineKeyboardButton(f"✅ #{req[0]}", callback_data=f'accept_req_{req[0]}'),
+                InlineKeyboardButton(f"❌ #{req[0]}", callback_data=f'reject_req_{req[0]}')
+            ])
+        if rows:
+            keyboard.append([
+                InlineKeyboardButton("✅ Принять страницу", callback_data='admin_bulk_page_accept'),
+                InlineKeyboardButton("❌ Отклонить страницу", callback_data='admin_bulk_page_reject')
+            ])
+        if rows and pattern:
+            keyboard.append([InlineKeyboardButton("❌ Отклонить все по фильтру", callback_data='admin_bulk_reject_filtered')])
+    else:
+        text = "❓ Новые вопросы"
+        for q in rows:
+            text += f"\n\n#{q[0]} @{q[2] or 'N/A'} · {q[6]}\n📝 {q[3][:100]}\n👨‍💼 {q[7] or 'не назначен'}"
+            keyboard.append([InlineKeyboardButton(f"💬 Ответить на #{q[0]}", callback_data=f'answer_question_from_manager_{q[0]}')])
+        if rows:
+            keyboard.append([InlineKeyboardButton("📚 Ответить из базы знаний", callback_data='admin_bulk_kb')])
+
+    if pattern:
+        text = f"{text} · 🔎 «{pattern}» · всего {db.count_open(kind, **scope)}"
+    if not rows:
+        text = f"🔎 По фильтру «{pattern}» ничего не найдено" if pattern else (
+            "🟢 Новых заявок нет" if kind == 'request' else "🟢 Новых вопросов нет")
+
+    navigation = []
+    if before_id is not None:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=page_callback))
+    if len(rows) == Config.ADMIN_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("➡️ Далее", callback_data=f'{page_callback}_after_{rows[-1][0]}'))
+    if navigation:
+        keyboard.append(navigation)
+
+    filter_row = [InlineKeyboardButton("🔎 Фильтр", callback_data=f'admin_bulk_filter_{kind}')]
+    if pattern:
+        filter_row.append(InlineKeyboardButton("✖️ Сбросить фильтр", callback_data=f'admin_bulk_clear_{kind}'))
+    keyboard.append(filter_row)
+    keyboard.append([InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')])
+
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def run_bulk_action(query, context, kind: str, value: str, item_ids=None):
+    """Закрывает выборку одной командой UPDATE и ставит уведомления пользователей в очередь.
+
+    value - новый статус заявок или текст ответа на вопросы. Без item_ids
+    обрабатываются все открытые элементы по текущему фильтру.
+    """
+    user_id = query.from_user.id
+    scope = get_bulk_scope(context, user_id, kind)
+    if item_ids is not None:
+        scope['pattern'] = None  # Страница уже отобрана с учётом фильтра
+
+    if kind == 'request':
+        rows = db.bulk_set_request_status(value, item_ids, **scope)
+        title = f"{'✅ Принято' if value == 'accepted' else '❌ Отклонено'} заявок: {len(rows)}"
+    else:
+        rows = db.bulk_answer_questions(value, item_ids, **scope)
+        title = f"💬 Отвечено вопросов: {len(rows)}"
+    context.user_data.pop('bulk_page', None)
+    await asyncio.to_thread(assignment_engine.release_many, [assigned_to for _, _, assigned_to in rows])
+    logger.info("Массовое действие над %s от %s: %s шт.", kind, user_id, len(rows))
+
+    if not rows:
+        await query.edit_message_text("🟢 Обрабатывать нечего - элементы уже закрыты", reply_markup=get_admin_keyboard())
+        return
+
+    progress = BulkProgress(query.message.chat_id, query.message.message_id, title, len(rows))
+    await query.edit_message_text(progress.render())
+
+    menu_buttons = InlineKeyboardMarkup(get_menu_buttons())
+    for item_id, customer_id, _ in rows:
+        if kind == 'request':
+            notification_queue.submit(
+                context.bot, customer_id, REQUEST_STATUS_MESSAGES[value].format(request_id=item_id), progress,
+                reply_markup=menu_buttons, parse_mode=ParseMode.MARKDOWN
+            )
+        else:
+            notification_queue.submit(context.bot, customer_id, ANSWER_MESSAGE.format(answer=value), progress,
+                                      reply_markup=menu_buttons)
+
+async def handle_bulk_actions(query, context):
+    """Кнопки массовых действий (admin_bulk_*)"""
+    user_id = query.from_user.id
+    page = context.user_data.get('bulk_page', {})
+
+    if query.data.startswith('admin_bulk_filter_'):
+        kind = query.data[len('admin_bulk_filter_'):]
+        context.user_data['mode'] = 'bulk_filter'
+        context.user_data['bulk_filter_kind'] = kind
+        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=BULK_PAGE_CALLBACKS[kind])]]
+        await query.edit_message_text(
+            "🔎 Введите текст для поиска (username, контакт, бизнес, задачи или текст вопроса):",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    elif query.data.startswith('admin_bulk_clear_'):
+        kind = query.data[len('admin_bulk_clear_'):]
+        context.user_data.get('bulk_filters', {}).pop(kind, None)
+        await show_open_page(query, context, kind)
+
+    elif query.data in ('admin_bulk_page_accept', 'admin_bulk_page_reject'):
+        if page.get('kind') != 'request':
+            await show_open_page(query, context, 'request')
+            return
+        status = 'accepted' if query.data == 'admin_bulk_page_accept' else 'rejected'
+        await run_bulk_action(query, context, 'request', status, item_ids=page['ids'])
+
+    elif query.data == 'admin_bulk_reject_filtered':
+        scope = get_bulk_scope(context, user_id, 'request')
+        if not scope['pattern']:
+            await show_open_page(query, context, 'request')
+            return
+        count = db.count_open('request', **scope)
+        keyboard = [
+            [InlineKeyboardButton(f"❌ Да, отклонить {count}", callback_data='admin_bulk_reject_filtered_confirm')],
+            [InlineKeyboardButton("⬅️ Назад", callback_data='admin_requests')]
+        ]
+        await query.edit_message_text(
+            f"❌ Отклонить все новые заявки по фильтру «{scope['pattern']}»: {count} шт.?\nПользователи получат уведомление.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    elif query.data == 'admin_bulk_reject_filtered_confirm':
+        if not get_bulk_scope(context, user_id, 'request')['pattern']:
+            await show_open_page(query, context, 'request')
+            return
+        await run_bulk_action(query, context, 'request', 'rejected')
+
+    elif query.data == 'admin_bulk_kb':
+        scope = get_bulk_scope(context, user_id, 'question')
+        if scope['pattern']:
+            target = f"всех новых вопросов по фильтру «{scope['pattern']}» ({db.count_open('question', **scope)} шт.)"
+        elif page.get('kind') == 'question':
+            target = f"вопросов на странице ({len(page['ids'])} шт.)"
+        else:
+            await show_open_page(query, context, 'question')
+            return
+
+        entries = db.get_knowledge_entries(Config.ADMIN_PAGE_SIZE)
+        if not entries:
+            await query.edit_message_text("📚 База знаний пуста", reply_markup=get_admin_keyboard())
+            return
+        text = f"📚 Выберите ответ для {target}:\n"
+        keyboard = []
+        for entry_id, question, answer in entries:
+            text += f"\n#{entry_id} {question[:60]}\n→ {answer[:80]}\n"
+            keyboard.append([InlineKeyboardButton(f"#{entry_id} {question[:40]}", callback_data=f'admin_bulk_kb_answer_{entry_id}')])
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='admin_questions')])
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+    elif query.data.startswith('admin_bulk_kb_answer_'):
+        entry = db.get_knowledge_entry(int(query.data.split('_')[-1]))
+        if not entry:
+            await query.edit_message_text("❌ Запись базы знаний не найдена", reply_markup=get_admin_keyboard())
+            return
+        if get_bulk_scope(context, user_id, 'question')['pattern']:
+            await run_bulk_action(query, context, 'question', entry[2])
+        elif page.get('kind') == 'question':
+            await run_bulk_action(query, context, 'question', entry[2], item_ids=page['ids'])
+        else:
+            await show_open_page(query, context, 'question')
+
+async def show_knowledge_page(query, context, before_id: int = None):
+    """Страница базы знаний (новые записи первыми) с поиском и переходом к правке"""
+    pattern = context.user_data.get('kb_search')
+    rows = db.get_knowledge_page(before_id, Config.ADMIN_PAGE_SIZE, pattern)
+
+    text = f"📚 База знаний · всего {db.count_knowledge(pattern)}"
+    if pattern:
+        text += f" · 🔎 «{pattern}»"
+    keyboard = []
+    for entry_id, question, answer in rows:
+        text += f"\n\n#{entry_id} ❓ {question[:60]}\n💬 {answer[:80]}"
+        keyboard.append([InlineKeyboardButton(f"✏️ #{entry_id} {question[:40]}", callback_data=f'admin_kb_entry_{entry_id}')])
+    if not rows:
+        text = f"🔎 По запросу «{pattern}» ничего не найдено" if pattern else "📚 База знаний пуста"
+
+    navigation = []
+    if before_id is not None:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data='admin_knowledge'))
+    if len(rows) == Config.ADMIN_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("➡️ Далее", callback_data=f'admin_knowledge_after_{rows[-1][0]}'))
+    if navigation:
+        keyboard.append(navigation)
+
+    search_row = [InlineKeyboardButton("🔎 Поиск", callback_data='admin_kb_search')]
+    if pattern:
+        search_row.append(InlineKeyboardButton("✖️ Сбросить поиск", callback_data='admin_kb_clear'))
+    keyboard.append(search_row)
+    keyboard.append([InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')])
+
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+def render_knowledge_entry(entry) -> tuple:
+    """Текст и кнопки карточки записи базы знаний"""
+    entry_id, question, answer = entry
+    text = f"📚 Запись #{entry_id}\n\n❓ {question}\n\n💬 {answer[:3000]}"
+    aliases = db.get_knowledge_aliases(entry_id)
+    if aliases:
+        text += "\n\nДругие формулировки:\n" + "\n".join(f"• {alias[:80]}" for alias in aliases)
+    keyboard = [
+        [InlineKeyboardButton("✏️ Вопрос", callback_data=f'admin_kb_edit_question_{entry_id}'),
+         InlineKeyboardButton("✏️ Ответ", callback_data=f'admin_kb_edit_answer_{entry_id}')],
+        [InlineKeyboardButton("🗑 Удалить", callback_data=f'admin_kb_delete_{entry_id}')],
+        [InlineKeyboardButton("⬅️ К базе знаний", callback_data='admin_knowledge')]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def handle_knowledge_actions(query, context):
+    """Кнопки записей базы знаний (admin_kb_*): поиск, правка и удаление"""
+    if query.data == 'admin_kb_search':
+        context.user_data['mode'] = 'kb_search'
+        await query.edit_message_text("🔎 Отправьте текст для поиска по вопросам и ответам базы знаний:")
+        return
+
+    if query.data == 'admin_kb_clear':
+        context.user_data.pop('kb_search', None)
+        await show_knowledge_page(query, context)
+        return
+
+    entry_id = int(query.data.split('_')[-1])
+    back = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К базе знаний", callback_data='admin_knowledge')]])
+
+    if query.data.startswith('admin_kb_delete_confirm_'):
+        if await asyncio.to_thread(knowledge_index.remove, entry_id):
+            logger.info("Запись базы знаний #%s удалена пользователем %s", entry_id, query.from_user.id)
+            await query.edit_message_text(f"🗑 Запись #{entry_id} удалена", reply_markup=back)
+        else:
+            await query.edit_message_text("❌ Запись базы знаний не найдена", reply_markup=back)
+        return
+
+    entry = db.get_knowledge_entry(entry_id)
+    if not entry:
+        await query.edit_message_text("❌ Запись базы знаний не найдена", reply_markup=back)
+        return
+
+    if query.data.startswith('admin_kb_entry_'):
+        text, reply_markup = render_knowledge_entry(entry)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+    elif query.data.startswith('admin_kb_edit_'):
+        field = 'question' if query.data.startswith('admin_kb_edit_question_') else 'answer'
+        context.user_data['mode'] = 'kb_edit'
+        context.user_data['kb_edit'] = {'entry_id': entry_id, 'field': field}
+        current = entry[1] if field == 'question' else entry[2]
+        await query.edit_message_text(
+            f"✏️ Отправьте новый {'вопрос' if field == 'question' else 'ответ'} для записи #{entry_id}.\n\nСейчас:\n{current[:3000]}"
+        )
+
+    elif query.data.startswith('admin_kb_delete_'):
+        keyboard = [
+            [InlineKeyboardButton("🗑 Да, удалить", callback_data=f'admin_kb_delete_confirm_{entry_id}')],
+            [InlineKeyboardButton("⬅️ Назад", callback_data=f'admin_kb_entry_{entry_id}')]
+        ]
+        await query.edit_message_text(
+            f"🗑 Удалить запись #{entry_id}?\n\n❓ {entry[1][:200]}\n\nБот перестанет использовать этот ответ сразу.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+async def handle_broadcast_actions(query, context):
+    """Кнопки рассылок (admin_broadcast*), доступны только администратору"""
+    if query.from_user.id != Config.ADMIN_USER_ID:
+        await query.edit_message_text("❌ Рассылки доступны только администратору", reply_markup=get_admin_keyboard())
+        return
+
+    if query.data == 'admin_broadcast':
+        context.user_data.pop('broadcast_text', None)
+        text = f"📣 *Рассылки*\n\n👥 Пользователей: {db.count_users(include_blocked=True)}, доступно для рассылки: {db.count_users()}\n"
+        for broadcast in db.get_broadcasts(limit=3):
+            text += f"\n#{broadcast[0]} {BROADCAST_STATUS_LABELS.get(broadcast[2], broadcast[2])} - {broadcast[5]} из {broadcast[4]}"
+        keyboard = [
+            [InlineKeyboardButton("✏️ Новая рассылка", callback_data='admin_broadcast_new')],
+            [InlineKeyboardButton("🔐 Админ панель", callback_data='admin_panel')]
+        ]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+
+    elif query.data == 'admin_broadcast_new':
+        context.user_data['mode'] = 'broadcast_text'
+        keyboard = [[InlineKeyboardButton("✖️ Отмена", callback_data='admin_broadcast')]]
+        await query.edit_message_text("✏️ Введите текст рассылки:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+    elif query.data == 'admin_broadcast_send':
+        text = context.user_data.pop('broadcast_text', None)
+        if not text:
+            await query.edit_message_text("❌ Текст рассылки не найден, начните заново", reply_markup=get_admin_keyboard())
+            return
+
+        broadcast_id = db.create_broadcast(text, query.from_user.id)
+        db.set_broadcast_progress_message(broadcast_id, query.message.chat_id, query.message.message_id)
+        broadcast = db.get_broadcast(broadcast_id)
+        await query.edit_message_text(render_broadcast(broadcast), reply_markup=get_broadcast_keyboard(broadcast))
+        logger.info("Рассылка #%s создана: %s получателей", broadcast_id, broadcast[4])
+
+        # На остальных воркерах рассылку подхватит лидер (resume_broadcasts)
+        if cluster.is_leader:
+            broadcaster.start(context.bot, broadcast_id)
+
+    elif query.data.startswith('admin_broadcast_cancel_'):
+        broadcast_id = int(query.data.split('_')[-1])
+        db.set_broadcast_status(broadcast_id, 'cancelled')
+        broadcast = db.get_broadcast(broadcast_id)
+        if broadcast:
+            await query.edit_message_text(render_broadcast(broadcast), reply_markup=get_broadcast_keyboard(broadcast))
+
 # ===== НАПОМИНАНИЯ =====
 async def send_reminders(context: CallbackContext):
     """Отправка напоминаний неактивным лидам"""
@@ -858,9 +3675,491 @@ async def send_reminders(context: CallbackContext):
                     parse_mode=ParseMode.MARKDOWN
                 )
             except Exception as e:
-                logger.error(f"Ошибка отправки напоминания: {e}")
+                logger.error("Ошибка отправки напоминания: %s", e)
+    except Exception as e:
+        logger.error("Ошибка в задаче напоминаний: %s", e)
+
+# ===== ОБСЛУЖИВАНИЕ БАЗЫ =====
+def format_bytes(size: int):
+    for unit in ('Б', 'КБ', 'МБ'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+async def run_retention(context: CallbackContext):
+    """Перенос закрытых записей в архив, incremental VACUUM и ANALYZE.
+
+    Вызовы БД идут в потоке короткими шагами: пачка архивации, шаг VACUUM,
+    ANALYZE с ограничением выборки. Однократный перевод старой базы в режим
+    incremental auto_vacuum (полный VACUUM) выполняется при запуске, до polling.
+    """
+    try:
+        size_before, _ = await asyncio.to_thread(db.get_size)
+
+        moved = {}
+        for kind in db.ARCHIVABLE:
+            moved[kind] = 0
+            while True:
+                count = await asyncio.to_thread(db.archive_batch, kind, Config.RETENTION_DAYS, Config.RETENTION_BATCH)
+                moved[kind] += count
+                if count < Config.RETENTION_BATCH:
+                    break
+
+        pruned = await asyncio.to_thread(db.prune_funnel_events, Config.FUNNEL_RAW_RETENTION_DAYS)
+        if pruned:
+            logger.info("Удалено сырых событий воронки: %s", pruned)
+
+        pruned = await asyncio.to_thread(db.prune_broadcast_deliveries, Config.RETENTION_DAYS)
+        if pruned:
+            logger.info("Удалено статусов доставки рассылок: %s", pruned)
+
+        while await asyncio.to_thread(db.incremental_vacuum, Config.VACUUM_PAGES_PER_STEP):
+            pass
+        await asyncio.to_thread(db.analyze)
+
+        size_after, _ = await asyncio.to_thread(db.get_size)
+        reclaimed = size_before - size_after
+        logger.info("Архивация: заявок %s, вопросов %s, освобождено %s байт", moved['request'], moved['question'], reclaimed)
+
+        if moved['request'] or moved['question'] or reclaimed > 0:
+            await notify_admin(
+                context,
+                f"🗄 Обслуживание базы\n\nВ архив: заявок {moved['request']}, вопросов {moved['question']}\n"
+                f"Размер: {format_bytes(size_before)} → {format_bytes(size_after)} (освобождено {format_bytes(reclaimed)})"
+            )
     except Exception as e:
-        logger.error(f"Ошибка в задаче напоминаний: {e}")
+        logger.error("Ошибка в задаче архивации: %s", e)
+
+# ===== РЕЗЕРВНОЕ КОПИРОВАНИЕ =====
+def check_integrity(path: str):
+    """PRAGMA integrity_check для файла базы, True если всё в порядке"""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+    finally:
+        conn.close()
+
+def snapshot_prefix(db_name: str):
+    return os.path.join(Config.BACKUP_DIR, os.path.splitext(os.path.basename(db_name))[0])
+
+def create_snapshot(db_name: str, schema: str):
+    """Снимок одной базы: backup API -> проверка целостности -> gzip -> ротация"""
+    os.makedirs(Config.BACKUP_DIR, exist_ok=True)
+    prefix = snapshot_prefix(db_name)
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    raw_path = f"{prefix}-{timestamp}.db.tmp"
+    snapshot_path = f"{prefix}-{timestamp}.db.gz"
+
+    try:
+        db.backup_to(raw_path, schema)
+        if not check_integrity(raw_path):
+            raise RuntimeError(f"Снимок {raw_path} не прошёл проверку целостности")
+
+        with open(raw_path, 'rb') as src, gzip.open(snapshot_path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+    # Ротация: оставляем только последние BACKUP_KEEP снимков
+    snapshots = sorted(glob.glob(f"{prefix}-*.db.gz"))
+    for old in snapshots[:-Config.BACKUP_KEEP]:
+        os.remove(old)
+
+    return snapshot_path
+
+def create_backup():
+    """Снимки основной и архивной базы, возвращает список (путь, размер)"""
+    if not db.supports_file_backup:
+        raise RuntimeError("Снимки файлов доступны только для SQLite, для PostgreSQL используйте pg_dump")
+
+    db.attach_archive()
+    result = []
+    for db_name, schema in ((Config.DB_NAME, 'main'), (Config.ARCHIVE_DB_NAME, 'archive')):
+        path = create_snapshot(db_name, schema)
+        result.append((path, os.path.getsize(path)))
+    return result
+
+def restore_backup(snapshot_path: str):
+    """Восстановление базы из снимка. Бот должен быть остановлен"""
+    archive_prefix = os.path.splitext(os.path.basename(Config.ARCHIVE_DB_NAME))[0]
+    target = Config.ARCHIVE_DB_NAME if os.path.basename(snapshot_path).startswith(archive_prefix + '-') else Config.DB_NAME
+    restored_path = target + '.restore'
+
+    with gzip.open(snapshot_path, 'rb') as src, open(restored_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+    if not check_integrity(restored_path):
+        os.remove(restored_path)
+        raise RuntimeError(f"Снимок {snapshot_path} повреждён, восстановление отменено")
+
+    if os.path.exists(target):
+        os.replace(target, target + '.before-restore')
+    os.replace(restored_path, target)
+    return target
+
+async def backup_job(context: CallbackContext):
+    """Регулярное резервное копирование в фоновом потоке"""
+    try:
+        snapshots = await asyncio.to_thread(create_backup)
+        for path, size in snapshots:
+            logger.info("💾 Резервная копия создана: %s (%s)", path, format_bytes(size))
+    except Exception as e:
+        logger.error("Ошибка резервного копирования: %s", e)
+        await notify_admin(context, f"❌ Ошибка резервного копирования: {e}")
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /backup - внеочередная резервная копия (только админ)"""
+    if update.message.from_user.id != Config.ADMIN_USER_ID:
+        await update.message.reply_text("❌ У вас нет прав доступа")
+        return
+
+    await update.message.reply_text("💾 Создаю резервную копию...")
+    try:
+        snapshots = await asyncio.to_thread(create_backup)
+        text = "✅ Резервная копия создана:\n\n" + "\n".join(
+            f"{os.path.basename(path)} ({format_bytes(size)})" for path, size in snapshots
+        )
+    except Exception as e:
+        logger.error("Ошибка резервного копирования: %s", e)
+        text = f"❌ Ошибка резервного копирования: {e}"
+    await update.message.reply_text(text)
+
+# ===== ТРАНСПОРТ BOT API =====
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с метриками по методам Bot API.
+
+    Настраивается только публичными аргументами HTTPXRequest: все соединения
+    пула остаются keep-alive. Время запросов также попадает в разбивку
+    медленных апдейтов (track_time).
+    """
+
+    def __init__(self, name: str, connection_pool_size: int, connect_timeout: float = 5.0, read_timeout: float = 5.0,
+                 write_timeout: float = 5.0, pool_timeout: float = 1.0, http_version: str = '1.1'):
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            write_timeout=write_timeout,
+            pool_timeout=pool_timeout,
+            http_version=http_version
+        )
+        self.name = name
+        self.pool_size = connection_pool_size
+        self.timeouts = {'connect': connect_timeout, 'read': read_timeout, 'write': write_timeout, 'pool': pool_timeout}
+        self._lock = threading.Lock()  # Метрики пишет цикл событий, читает Flask
+        self._endpoints = {}  # Метод -> счётчики и последние задержки
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        started = time.perf_counter()
+        error = None
+        try:
+            with track_time('telegram'):
+                status, content = await super().do_request(url, method, request_data, **kwargs)
+            if status >= 400:
+                error = f"http_{status}"
+            return status, content
+        except TimedOut as e:
+            error = 'pool_timeout' if 'Pool timeout' in str(e) else 'timeout'
+            raise
+        except NetworkError:
+            error = 'network'
+            raise
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.in_flight -= 1
+            self._record(endpoint, time.perf_counter() - started, error)
+
+    def _record(self, endpoint: str, elapsed: float, error: str):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'calls': 0, 'errors': Counter(), 'max': 0.0,
+                    'latencies': deque(maxlen=Config.TRANSPORT_LATENCY_WINDOW)
+                }
+            stats['calls'] += 1
+            stats['latencies'].append(elapsed)
+            stats['max'] = max(stats['max'], elapsed)
+            if error:
+                stats['errors'][error] += 1
+
+    @staticmethod
+    def _percentile(latencies: list, share: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * share))] * 1000, 1)
+
+    def get_stats(self) -> dict:
+        """Настройки пула и задержки по методам (перцентили - по последним TRANSPORT_LATENCY_WINDOW запросам)"""
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self._endpoints.items():
+                latencies = sorted(stats['latencies'])
+                endpoints[endpoint] = {
+                    'calls': stats['calls'],
+                    'errors': dict(stats['errors']),
+                    'avg_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+                    'p50_ms': self._percentile(latencies, 0.5),
+                    'p95_ms': self._percentile(latencies, 0.95),
+                    'p99_ms': self._percentile(latencies, 0.99),
+                    'max_ms': round(stats['max'] * 1000, 1),
+                }
+        return {
+            'pool_size': self.pool_size,
+            'http_version': self.http_version,
+            'timeouts': self.timeouts,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'endpoints': endpoints,
+        }
+
+bot_requests = {}  # Пул -> InstrumentedRequest (для /api/transport)
+
+def create_bot_request(name: str, pool_size: int) -> InstrumentedRequest:
+    """Транспорт с настройками из Config; HTTP/2 требует python-telegram-bot[http2]"""
+    request = InstrumentedRequest(
+        name, pool_size,
+        connect_timeout=Config.TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=Config.TELEGRAM_READ_TIMEOUT,
+        write_timeout=Config.TELEGRAM_WRITE_TIMEOUT,
+        pool_timeout=Config.TELEGRAM_POOL_TIMEOUT,
+        http_version=Config.TELEGRAM_HTTP_VERSION
+    )
+    bot_requests[name] = request
+    return request
+
+# ===== ПРОФИЛИРОВАНИЕ =====
+class SlowUpdateLog:
+    """Последние медленные апдейты с разбивкой времени и их число по обработчикам"""
+
+    def __init__(self, size: int):
+        self._entries = deque(maxlen=size)
+        self._by_handler = Counter()
+        self._lock = threading.Lock()  # Пишет цикл событий, читает Flask
+
+    def record(self, handler: str, update, duration: float, timings: dict) -> dict:
+        user = update.effective_user if isinstance(update, Update) else None
+        db_time, telegram_time = timings['db'], timings['telegram']
+        entry = {
+            'ts': int(time.time()),
+            'handler': handler,
+            'update_id': getattr(update, 'update_id', None),
+            'user_id': user.id if user else None,
+            'total_ms': round(duration * 1000, 1),
+            'db_ms': round(db_time * 1000, 1),
+            'db_calls': timings['db_calls'],
+            'telegram_ms': round(telegram_time * 1000, 1),
+            'telegram_calls': timings['telegram_calls'],
+            # Параллельные ожидания могут перекрываться - тогда код считается нулём
+            'compute_ms': round(max(0.0, duration - db_time - telegram_time) * 1000, 1),
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self._by_handler[handler] += 1
+        return entry
+
+    def get(self) -> dict:
+        with self._lock:
+            return {
+                'threshold_ms': Config.LOG_SLOW_UPDATE_MS,
+                'by_handler': dict(self._by_handler.most_common()),
+                'recent': list(reversed(self._entries)),
+            }
+
+slow_update_log = SlowUpdateLog(Config.SLOW_UPDATE_LOG_SIZE)
+
+class SamplingProfiler:
+    """Статистический профайлер всех потоков: цикла событий, потоков БД и веб-сервера.
+
+    Отдельный поток раз в PROFILE_INTERVAL снимает стеки через sys._current_frames(),
+    остальные потоки не останавливаются и не трассируются. Снимок считается рабочим,
+    если поток потратил процессорное время с прошлого снимка: топ функций - по
+    процессору, файл стеков - по реальному времени (в нём видны и ожидания).
+    """
+
+    # Где нет часов процессора потока - простой определяется по листовой функции
+    IDLE_FUNCTIONS = {'select', 'wait', 'sleep', 'poll', 'accept', 'readinto', '_worker', 'serve_forever'}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels = {}  # code -> "функция (файл:строка)"
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    @staticmethod
+    def _cpu_time(ident: int):
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return None
+
+    def _is_busy(self, stack: list, cpu: float, last_cpu: float) -> bool:
+        if cpu is not None and last_cpu is not None:
+            return cpu - last_cpu >= Config.PROFILE_INTERVAL * 0.1
+        return stack[0].split(' ', 1)[0] not in self.IDLE_FUNCTIONS
+
+    def run(self, seconds: float):
+        """Профилирует seconds секунд, блокируя вызывающий поток. None - профиль уже снимается"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._sample(seconds)
+        finally:
+            self._lock.release()
+
+    def _sample(self, seconds: float) -> dict:
+        me = threading.get_ident()
+        stacks = Counter()  # (поток, внешняя функция, ..., листовая) -> число снимков
+        busy_stacks = Counter()  # То же, только снимки с расходом процессора
+        last_cpu = {}
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                cpu = self._cpu_time(ident)
+                busy = self._is_busy(stack, cpu, last_cpu.get(ident))
+                last_cpu[ident] = cpu
+                stack.append(names.get(ident, str(ident)))
+                stack = tuple(reversed(stack))
+                stacks[stack] += 1
+                if busy:
+                    busy_stacks[stack] += 1
+            samples += 1
+            if time.perf_counter() >= deadline:
+                break
+            time.sleep(Config.PROFILE_INTERVAL)
+        return {
+            'seconds': time.perf_counter() - started,
+            'samples': samples,
+            'stacks': stacks,
+            'busy_stacks': busy_stacks,
+        }
+
+    def report(self, result: dict, top: int = None) -> dict:
+        """Загрузка потоков, топ функций (доля времени) и стеки в формате flamegraph.pl"""
+        samples = result['samples'] or 1
+        threads = defaultdict(lambda: [0, 0])  # поток -> [снимков, из них занят]
+        for stack, count in result['stacks'].items():
+            threads[stack[0]][0] += count
+        self_counts, total_counts = Counter(), Counter()
+        for stack, count in result['busy_stacks'].items():
+            threads[stack[0]][1] += count
+            if len(stack) < 2:
+                continue
+            self_counts[stack[-1]] += count
+            for frame in set(stack[1:]):
+                total_counts[frame] += count
+
+        return {
+            'seconds': round(result['seconds'], 2),
+            'samples': result['samples'],
+            'threads': [
+                {'name': name, 'busy_pct': round(busy * 100 / seen, 1)}
+                for name, (seen, busy) in sorted(threads.items(), key=lambda item: -item[1][1])
+            ],
+            'top': [
+                {'function': function, 'self_pct': round(count * 100 / samples, 1),
+                 'total_pct': round(total_counts[function] * 100 / samples, 1)}
+                for function, count in self_counts.most_common(top or Config.PROFILE_TOP)
+            ],
+            'folded': "\n".join(f"{';'.join(stack)} {count}" for stack, count in result['stacks'].items()),
+        }
+
+profiler = SamplingProfiler()
+
+def render_profile(report: dict) -> str:
+    lines = [f"🔬 Профиль за {report['seconds']} с ({report['samples']} снимков)", "", "Загрузка потоков:"]
+    lines += [f"  {thread['name']}: {thread['busy_pct']}%" for thread in report['threads'][:8]]
+    lines += ["", "Топ функций по процессору (своё время / с вложенными):"]
+    lines += [f"  {item['self_pct']}% / {item['total_pct']}%  {item['function']}" for item in report['top']]
+    if not report['top']:
+        lines.append("  все потоки простаивали")
+    return "\n".join(lines)
+
+def render_slow_updates(log: dict, limit: int = 10) -> str:
+    if not log['recent']:
+        return f"🐢 Медленных апдейтов (дольше {log['threshold_ms']} мс) не было"
+    lines = [f"🐢 Медленные апдейты (дольше {log['threshold_ms']} мс)", "", "По обработчикам:"]
+    lines += [f"  {handler}: {count}" for handler, count in log['by_handler'].items()]
+    lines += ["", "Последние:"]
+    for entry in log['recent'][:limit]:
+        lines.append(
+            f"  {datetime.datetime.fromtimestamp(entry['ts']).strftime('%H:%M:%S')} {entry['handler']} "
+            f"{entry['total_ms']} мс: БД {entry['db_ms']} ({entry['db_calls']}), "
+            f"Telegram {entry['telegram_ms']} ({entry['telegram_calls']}), код {entry['compute_ms']}"
+        )
+    return "\n".join(lines)
+
+async def send_profile(message, seconds: float):
+    """Снимает профиль в отдельном потоке и отправляет отчёт и файл стеков"""
+    try:
+        result = await asyncio.to_thread(profiler.run, seconds)
+        if result is None:
+            await message.reply_text("⏳ Профилирование уже идёт")
+            return
+        report = profiler.report(result)
+        await message.reply_text(render_profile(report))
+        await message.reply_document(
+            document=io.BytesIO(report['folded'].encode()),
+            filename=f"profile-{int(time.time())}.folded",
+            caption="Стеки для flamegraph.pl или speedscope.app"
+        )
+    except Exception as e:
+        logger.error("Ошибка профилирования: %s", e)
+        await message.reply_text(f"❌ Ошибка профилирования: {e}")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile [секунды] - профиль всех потоков; без аргумента - медленные апдейты (только админ)"""
+    if update.message.from_user.id != Config.ADMIN_USER_ID:
+        await update.message.reply_text("❌ У вас нет прав доступа")
+        return
+
+    if not context.args:
+        await update.message.reply_text(
+            render_slow_updates(slow_update_log.get()) + "\n\nПрофиль потоков: /profile <секунды>"
+        )
+        return
+
+    try:
+        seconds = float(context.args[0])
+        if not math.isfinite(seconds):
+            raise ValueError(seconds)
+    except ValueError:
+        await update.message.reply_text("Использование: /profile <секунды>")
+        return
+    seconds = min(max(seconds, 1.0), Config.PROFILE_MAX_SECONDS)
+
+    if profiler.running:
+        await update.message.reply_text("⏳ Профилирование уже идёт")
+        return
+
+    await update.message.reply_text(f"🔬 Профилирую {seconds:g} с...")
+    # Отчёт отправит отдельная задача - окно профиля не должно считаться медленным апдейтом
+    context.application.create_task(send_profile(update.message, seconds))
 
 # ===== СИСТЕМА АВТОПИНГА =====
 def ping_self():
@@ -871,16 +4170,18 @@ def ping_self():
     try:
         ping_url = Config.PING_URL
         if ping_url == 'https://your-app.onrender.com':
-            logger.warning("PING_URL не настроен. Установите RENDER_EXTERNAL_URL в переменных окружения.")
+            ping_logger.warning("PING_URL не настроен. Установите RENDER_EXTERNAL_URL в переменных окружения.")
             return
-            
+
+        # requests нужен раз в 14 минут - не импортируем его при старте
+        import requests
         response = requests.get(f"{ping_url}/health", timeout=30)
         if response.status_code == 200:
-            logger.info(f"🏓 Пинг успешен: {ping_url}")
+            ping_logger.info("🏓 Пинг успешен: %s", ping_url)
         else:
-            logger.warning(f"🏓 Пинг неудачен: {response.status_code}")
+            ping_logger.warning("🏓 Пинг неудачен: %s", response.status_code)
     except Exception as e:
-        logger.error(f"🏓 Ошибка пинга: {e}")
+        ping_logger.error("🏓 Ошибка пинга: %s", e)
 
 async def ping_job(context: CallbackContext):
     """Задача для регулярного пинга"""
@@ -895,17 +4196,483 @@ def start_ping_system():
         while True:
             try:
                 time.sleep(Config.PING_INTERVAL)
-                ping_self()
+                if cluster.is_leader:
+                    ping_self()
             except Exception as e:
-                logger.error(f"Ошибка в цикле пинга: {e}")
+                logger.error("Ошибка в цикле пинга: %s", e)
                 time.sleep(60)  # Ждем минуту перед повторной попыткой
     
-    ping_thread = threading.Thread(target=ping_loop, daemon=True)
+    ping_thread = threading.Thread(target=ping_loop, name='ping', daemon=True)
     ping_thread.start()
-    logger.info(f"🏓 Система автопинга запущена (интервал: {Config.PING_INTERVAL} сек)")
+    logger.info("🏓 Система автопинга запущена (интервал: %s сек)", Config.PING_INTERVAL)
+
+# ===== МНОГОПРОЦЕССНЫЙ РЕЖИМ =====
+class Cluster:
+    """Выбор лидера и разбиение апдейтов между воркерами по chat id.
+
+    Лидер единственный опрашивает Telegram (getUpdates не допускает
+    нескольких потребителей) и выполняет периодические задачи. Апдейты
+    чужих разделов он кладёт в общий список, откуда их забирает воркер
+    нужного раздела - так все апдейты одного чата обрабатывает один процесс.
+    """
+
+    LEADER_KEY = 'cluster:leader'
+
+    def __init__(self, store):
+        self.store = store
+        self.enabled = Config.INSTANCE_COUNT > 1
+        self.is_leader = not self.enabled  # Одиночный процесс всегда лидер
+        self._renewed_at = 0.0
+        self._polling_start = None  # Задача запуска polling после получения лидерства
+
+    def partition_of(self, update: Update):
+        if update.effective_chat:
+            key = update.effective_chat.id
+        elif update.effective_user:
+            key = update.effective_user.id
+        else:
+            key = 0
+        return key % Config.INSTANCE_COUNT
+
+    async def election_loop(self, application):
+        while True:
+            try:
+                acquired = await asyncio.to_thread(
+                    self.store.acquire_lock, self.LEADER_KEY, Config.INSTANCE_ID, Config.LEADER_LOCK_TTL
+                )
+                if acquired:
+                    self._renewed_at = time.monotonic()
+                if acquired and not self.is_leader:
+                    self.is_leader = True
+                    logger.info("👑 Воркер %s стал лидером, запускаю polling", Config.INSTANCE_ID)
+                    # start_polling повторяет bootstrap без ограничения - блокировку продлевает этот цикл, не он
+                    self._polling_start = asyncio.create_task(self._start_polling(application))
+                elif not acquired and self.is_leader:
+                    await self._step_down(application)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка выбора лидера: %s", e)
+                # Без связи с хранилищем лидерство истекает - уступаем, чтобы не было двух лидеров
+                if self.is_leader and time.monotonic() - self._renewed_at > Config.LEADER_LOCK_TTL:
+                    await self._step_down(application)
+            await asyncio.sleep(Config.LEADER_RENEW_INTERVAL)
+
+    async def _start_polling(self, application):
+        try:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Следующий проход цикла выборов попробует снова, пока блокировка у нас
+            logger.error("Не удалось запустить polling: %s", e)
+            self.is_leader = False
+
+    async def _step_down(self, application):
+        self.is_leader = False
+        logger.warning("Воркер %s потерял лидерство, останавливаю polling", Config.INSTANCE_ID)
+        if self._polling_start is not None and not self._polling_start.done():
+            self._polling_start.cancel()
+            await asyncio.gather(self._polling_start, return_exceptions=True)
+        if application.updater.running:
+            try:
+                await application.updater.stop()
+            except Exception as e:
+                logger.error("Ошибка остановки polling: %s", e)
+
+    async def consume_partition(self, application):
+        """Забирает апдейты своего раздела, пересланные лидером"""
+        key = f"updates:{Config.INSTANCE_INDEX}"
+        while True:
+            try:
+                data = await asyncio.to_thread(self.store.pop, key, 5)
+                if data:
+                    await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка чтения раздела %s: %s", key, e)
+                await asyncio.sleep(1)
+
+    def release(self):
+        if self.enabled and self.is_leader:
+            self.store.release_lock(self.LEADER_KEY, Config.INSTANCE_ID)
+
+cluster = Cluster(shared_store)
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пересылает апдейт воркеру его раздела и прекращает обработку здесь"""
+    partition = cluster.partition_of(update)
+    if partition != Config.INSTANCE_INDEX:
+        await asyncio.to_thread(shared_store.push, f"updates:{partition}", json.dumps(update.to_dict()))
+        raise ApplicationHandlerStop
+
+def leader_only(callback):
+    """Периодическая задача выполняется только на лидере"""
+    async def wrapper(context: CallbackContext):
+        if cluster.is_leader:
+            await callback(context)
+    wrapper.__name__ = callback.__name__
+    return wrapper
+
+class SharedPersistence(BasePersistence):
+    """Хранит context.user_data в общем хранилище (переживает перезапуск воркера)"""
+
+    def __init__(self, store):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=Config.PERSISTENCE_UPDATE_INTERVAL
+        )
+        self.store = store
+
+    async def get_user_data(self):
+        # Загружаем только пользователей своего раздела
+        user_data = {}
+        for key in await asyncio.to_thread(self.store.keys, 'user_data:*'):
+            user_id = int(key.split(':')[1])
+            if user_id % Config.INSTANCE_COUNT != Config.INSTANCE_INDEX:
+                continue
+            value = await asyncio.to_thread(self.store.get, key)
+            if value is not None:
+                user_data[user_id] = json.loads(value)
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        if data:
+            await asyncio.to_thread(self.store.set, f"user_data:{user_id}", json.dumps(data))
+        else:
+            await asyncio.to_thread(self.store.delete, f"user_data:{user_id}")
+
+    async def drop_user_data(self, user_id):
+        await asyncio.to_thread(self.store.delete, f"user_data:{user_id}")
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+def run_cluster(application):
+    """Запуск воркера в многопроцессном режиме"""
+    async def runner():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        async with application:
+            await application.start()
+            tasks = [
+                asyncio.create_task(cluster.election_loop(application)),
+                asyncio.create_task(cluster.consume_partition(application))
+            ]
+            logger.info("🧩 Воркер %s/%s (%s) запущен", Config.INSTANCE_INDEX + 1, Config.INSTANCE_COUNT, Config.INSTANCE_ID)
+
+            await stop_event.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+            cluster.release()
+
+    asyncio.run(runner())
+
+# ===== ДАШБОРД =====
+DASHBOARD_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>{{business_name}} - Telegram Bot Status</title>
+    <meta charset="utf-8">
+    <style>
+        body { font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }
+        .container { max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+        h1 { color: #2c3e50; text-align: center; }
+        .status { background: #27ae60; color: white; padding: 10px; border-radius: 5px; text-align: center; margin: 20px 0; }
+        .stats { display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); gap: 20px; margin: 20px 0; }
+        .stat-card { background: #ecf0f1; padding: 20px; border-radius: 8px; text-align: center; }
+        .stat-number { font-size: 2em; font-weight: bold; color: #3498db; }
+        .stat-label { color: #7f8c8d; margin-top: 5px; }
+        .info { background: #e8f4f8; padding: 15px; border-radius: 5px; margin: 20px 0; }
+        .url { background: #34495e; color: white; padding: 10px; border-radius: 5px; font-family: monospace; word-break: break-all; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>🤖 {{business_name}}</h1>
+        <div class="status">✅ Бот работает в Telegram</div>
+
+        <div class="info">
+            <h3>📊 Статистика бота:</h3>
+            <div class="stats">
+                <div class="stat-card">
+                    <div class="stat-number" data-stat="total_requests">{{stats.total_requests}}</div>
+                    <div class="stat-label">Всего заявок</div>
+                </div>
+                <div class="stat-card">
+                    <div class="stat-number" data-stat="new_requests">{{stats.new_requests}}</div>
+                    <div class="stat-label">Новые заявки</div>
+                </div>
+                <div class="stat-card">
+                    <div class="stat-number" data-stat="total_questions">{{stats.total_questions}}</div>
+                    <div class="stat-label">Всего вопросов</div>
+                </div>
+                <div class="stat-card">
+                    <div class="stat-number" data-stat="active_managers">{{stats.active_managers}}</div>
+                    <div class="stat-label">Менеджеров</div>
+                </div>
+            </div>
+        </div>
+
+        <div class="info">
+            <h3>🌐 URL вашего приложения:</h3>
+            <div class="url">{{webhook_url}}</div>
+            <p><small>🏓 Автопинг активен для предотвращения засыпания</small></p>
+        </div>
+
+        <div class="info">
+            <h3>📱 Как использовать бота:</h3>
+            <p>1. Найдите бота в Telegram по токену</p>
+            <p>2. Отправьте команду /start</p>
+            <p>3. Используйте кнопки меню для взаимодействия</p>
+        </div>
+    </div>
+    <script>
+        // Живое обновление статистики без перезагрузки страницы
+        const source = new EventSource('/events');
+        source.onmessage = (event) => {
+            const stats = JSON.parse(event.data);
+            document.querySelectorAll('[data-stat]').forEach((el) => {
+                if (el.dataset.stat in stats) {
+                    el.textContent = stats[el.dataset.stat];
+                }
+            });
+        };
+    </script>
+</body>
+</html>
+"""
+
+class StatsFeed:
+    """Последний снимок статистики для дашборда.
+
+    Статистика пересчитывается одним фоновым потоком после изменений в БД
+    (не чаще DASHBOARD_MIN_INTERVAL), а все открытые дашборды получают
+    готовый снимок - число зрителей не влияет на нагрузку на БД.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._dirty = True
+        self._version = 0
+        self._snapshot = {}
+        self._thread = None
+
+    def mark_dirty(self):
+        with self._cond:
+            self._dirty = True
+            self._cond.notify_all()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, name='stats-feed', daemon=True)
+            self._thread.start()
+            # Первый снимок нужен сразу, до первого изменения
+            self.wait(0, timeout=5)
+
+    def _refresh_loop(self):
+        while True:
+            with self._cond:
+                # Без изменений всё равно обновляемся изредка: другие воркеры пишут в ту же БД
+                self._cond.wait_for(lambda: self._dirty, timeout=Config.DASHBOARD_MAX_STALENESS)
+                self._dirty = False
+            try:
+                stats = db.get_stats()
+                with self._cond:
+                    if stats != self._snapshot:
+                        self._snapshot = stats
+                        self._version += 1
+                        self._cond.notify_all()
+            except Exception as e:
+                logger.error("Ошибка обновления статистики дашборда: %s", e)
+            time.sleep(Config.DASHBOARD_MIN_INTERVAL)
+
+    def get(self):
+        with self._cond:
+            return self._snapshot
+
+    def wait(self, version: int, timeout: float):
+        """Ждёт снимок новее version, возвращает (версия, снимок)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != version, timeout=timeout)
+            return self._version, self._snapshot
+
+stats_feed = StatsFeed()
+
+# ===== ВЕБ-ИНТЕРФЕЙС =====
+def create_web_app():
+    """Flask-приложение с дашбордом и API (flask импортируется только здесь)"""
+    from flask import Flask, Response, request, jsonify
+
+    app = Flask(__name__)
+
+    # Шаблон компилируется один раз при старте
+    dashboard_template = app.jinja_env.from_string(DASHBOARD_TEMPLATE)
+
+    @app.route('/')
+    def home():
+        return dashboard_template.render(
+            business_name=Config.BUSINESS_NAME,
+            stats=stats_feed.get(),
+            webhook_url=Config.get_webhook_url()
+        )
+
+    @app.route('/events')
+    def events():
+        """Server-sent events: новые снимки статистики по мере изменений"""
+        def stream():
+            version = 0
+            while True:
+                new_version, stats = stats_feed.wait(version, timeout=Config.DASHBOARD_KEEPALIVE)
+                if new_version == version:
+                    yield ": keep-alive\n\n"
+                    continue
+                version = new_version
+                yield f"data: {json.dumps(stats)}\n\n"
+
+        return Response(
+            stream(),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    @app.route('/api/stats')
+    def api_stats():
+        if request.args.get('archive') == '1':
+            stats = db.get_stats(include_archive=True)
+        else:
+            stats = dict(stats_feed.get())
+        stats['rate_limit'] = rate_limiter.get_stats()
+        stats['notifications'] = notification_queue.get_stats()
+        stats['logging'] = get_logging_stats()
+        return jsonify(stats)
+
+    @app.route('/api/transport')
+    def api_transport():
+        """Пулы соединений с Bot API: настройки, задержки и ошибки по методам"""
+        return jsonify({name: transport.get_stats() for name, transport in bot_requests.items()})
+
+    @app.route('/api/archive')
+    def api_archive():
+        kind = request.args.get('kind', 'request')
+        if kind not in db.ARCHIVABLE:
+            return jsonify({"error": "kind должен быть request или question"}), 400
+
+        limit = min(request.args.get('limit', 50, type=int), 500)
+        columns = [col.strip() for col in db.ARCHIVABLE[kind][1].split(',')]
+        return jsonify([dict(zip(columns, row)) for row in db.get_archived(kind, limit)])
+    
+    @app.route('/api/funnel')
+    def api_funnel():
+        """Воронка за период: ?from=&to= (unix time), ?granularity=minute|hour|day, ?series=1"""
+        until = request.args.get('to', int(time.time()), type=int)
+        since = request.args.get('from', until - 30 * 86400, type=int)
+        granularity = request.args.get('granularity')
+        if granularity is not None and granularity not in db.FUNNEL_BUCKETS:
+            return jsonify({"error": "granularity должен быть minute, hour или day"}), 400
+
+        return jsonify(build_funnel_report(since, until, granularity, request.args.get('series') == '1'))
+
+    def profile_allowed():
+        token = request.headers.get('X-Profile-Token') or request.args.get('token', '')
+        return hmac.compare_digest(token.encode(), Config.PROFILE_TOKEN.encode())
+
+    @app.route('/debug/profile')
+    def debug_profile():
+        """Профиль всех потоков: ?seconds=10, ?format=folded; токен в X-Profile-Token или ?token="""
+        if not Config.PROFILE_TOKEN:
+            return jsonify({"error": "PROFILE_TOKEN не задан"}), 404
+        if not profile_allowed():
+            return jsonify({"error": "неверный токен"}), 403
+
+        seconds = request.args.get('seconds', 10, type=float)
+        # float() принимает nan/inf - такое окно профилирования никогда не закончится
+        if not math.isfinite(seconds):
+            return jsonify({"error": "seconds должно быть конечным числом"}), 400
+        seconds = min(max(seconds, 1.0), Config.PROFILE_MAX_SECONDS)
+        result = profiler.run(seconds)
+        if result is None:
+            return jsonify({"error": "профилирование уже идёт"}), 409
+        report = profiler.report(result, request.args.get('top', type=int))
+        if request.args.get('format') == 'folded':
+            return Response(
+                report['folded'], mimetype='text/plain',
+                headers={'Content-Disposition': 'attachment; filename=profile.folded'}
+            )
+        report.pop('folded')
+        return jsonify(report)
+
+    @app.route('/debug/slow')
+    def debug_slow():
+        """Последние медленные апдейты с разбивкой на БД, Telegram и код"""
+        if not Config.PROFILE_TOKEN:
+            return jsonify({"error": "PROFILE_TOKEN не задан"}), 404
+        if not profile_allowed():
+            return jsonify({"error": "неверный токен"}), 403
+        return jsonify(slow_update_log.get())
+
+    @app.route('/health')
+    def health():
+        return jsonify({"status": "ok", "bot": "running"})
+
+    return app
+
+def run_web_server():
+    """Дашборд и API: снимки статистики обновляются при изменениях в БД"""
+    db.add_change_listener(stats_feed.mark_dirty)
+    stats_feed.start()
+
+    app = create_web_app()
+    app.run(host='0.0.0.0', port=Config.PORT, debug=False)
 
 # ===== ЗАПУСК СЕРВЕРА =====
 def main():
+    setup_logging()
     if not Config.TELEGRAM_TOKEN:
         logger.error("TELEGRAM_TOKEN не установлен! Добавьте его в Secrets.")
         return
@@ -917,138 +4684,191 @@ def main():
         logger.warning("MANAGER_USER_IDS не установлены. Уведомления менеджерам не будут отправляться.")
 
     logger.info("Запуск бота...")
+    init_database()
+    # Однократный полный VACUUM старой базы - до polling, пока обработчики не ждут соединение
+    db.ensure_incremental_vacuum()
 
     # Создание приложения
-    application = Application.builder().token(Config.TELEGRAM_TOKEN).build()
+    builder = Application.builder().token(Config.TELEGRAM_TOKEN)
+    # Отдельные пулы: долгий getUpdates не занимает соединения, нужные для ответов и рассылок
+    builder = builder.request(create_bot_request('send', Config.TELEGRAM_POOL_SIZE))
+    builder = builder.get_updates_request(create_bot_request('updates', Config.TELEGRAM_UPDATES_POOL_SIZE))
+    if Config.TELEGRAM_API_URL:
+        builder = builder.base_url(Config.TELEGRAM_API_URL)
+    if cluster.enabled:
+        builder = builder.persistence(SharedPersistence(shared_store))
+    application = builder.build()
+
+    # В многопроцессном режиме апдейты чужих разделов уходят другим воркерам
+    if cluster.enabled:
+        application.add_handler(TypeHandler(Update, route_update), group=-100)
+
+    # Реестр пользователей - до остальных обработчиков, без записи в БД на каждый апдейт
+    application.add_handler(TypeHandler(Update, track_user), group=-1)
 
     # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("start", log_context(start)))
+    application.add_handler(CommandHandler("admin", log_context(admin_panel)))
+    application.add_handler(CommandHandler("backup", log_context(backup_command)))
+    application.add_handler(CommandHandler("profile", log_context(profile_command)))
 
     # Обработчики кнопок
-    application.add_handler(CallbackQueryHandler(handle_callbacks))
+    application.add_handler(CallbackQueryHandler(log_context(handle_callbacks)))
 
     # Обработчики сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_context(handle_message)))
 
     # Напоминания
     if hasattr(application, 'job_queue') and application.job_queue:
         try:
             application.job_queue.run_repeating(
-                send_reminders,
+                leader_only(send_reminders),
                 interval=Config.REMINDER_INTERVAL,
                 first=10
             )
             logger.info("Напоминания настроены")
         except Exception as e:
-            logger.warning(f"Не удалось настроить напоминания: {e}")
+            logger.warning("Не удалось настроить напоминания: %s", e)
 
-    # Создаем Flask приложение для preview
-    app = Flask(__name__)
-    
-    @app.route('/')
-    def home():
-        stats = db.get_stats()
-        webhook_url = Config.get_webhook_url()
-        
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>{{business_name}} - Telegram Bot Status</title>
-            <meta charset="utf-8">
-            <style>
-                body { font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }
-                .container { max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
-                h1 { color: #2c3e50; text-align: center; }
-                .status { background: #27ae60; color: white; padding: 10px; border-radius: 5px; text-align: center; margin: 20px 0; }
-                .stats { display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); gap: 20px; margin: 20px 0; }
-                .stat-card { background: #ecf0f1; padding: 20px; border-radius: 8px; text-align: center; }
-                .stat-number { font-size: 2em; font-weight: bold; color: #3498db; }
-                .stat-label { color: #7f8c8d; margin-top: 5px; }
-                .info { background: #e8f4f8; padding: 15px; border-radius: 5px; margin: 20px 0; }
-                .url { background: #34495e; color: white; padding: 10px; border-radius: 5px; font-family: monospace; word-break: break-all; }
-            </style>
-            <meta http-equiv="refresh" content="30">
-        </head>
-        <body>
-            <div class="container">
-                <h1>🤖 {{business_name}}</h1>
-                <div class="status">✅ Бот работает в Telegram</div>
-                
-                <div class="info">
-                    <h3>📊 Статистика бота:</h3>
-                    <div class="stats">
-                        <div class="stat-card">
-                            <div class="stat-number">{{stats.total_requests}}</div>
-                            <div class="stat-label">Всего заявок</div>
-                        </div>
-                        <div class="stat-card">
-                            <div class="stat-number">{{stats.new_requests}}</div>
-                            <div class="stat-label">Новые заявки</div>
-                        </div>
-                        <div class="stat-card">
-                            <div class="stat-number">{{stats.total_questions}}</div>
-                            <div class="stat-label">Всего вопросов</div>
-                        </div>
-                        <div class="stat-card">
-                            <div class="stat-number">{{stats.active_managers}}</div>
-                            <div class="stat-label">Менеджеров</div>
-                        </div>
-                    </div>
-                </div>
-                
-                <div class="info">
-                    <h3>🌐 URL вашего приложения:</h3>
-                    <div class="url">{{webhook_url}}</div>
-                    <p><small>🏓 Автопинг активен для предотвращения засыпания</small></p>
-                </div>
-                
-                <div class="info">
-                    <h3>📱 Как использовать бота:</h3>
-                    <p>1. Найдите бота в Telegram по токену</p>
-                    <p>2. Отправьте команду /start</p>
-                    <p>3. Используйте кнопки меню для взаимодействия</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return render_template_string(html_template, 
-                                    business_name=Config.BUSINESS_NAME,
-                                    stats=stats,
-                                    webhook_url=webhook_url)
-    
-    @app.route('/api/stats')
-    def api_stats():
-        stats = db.get_stats()
-        return jsonify(stats)
-    
-    @app.route('/health')
-    def health():
-        return jsonify({"status": "ok", "bot": "running"})
+        try:
+            application.job_queue.run_repeating(
+                leader_only(flush_digests),
+                interval=Config.DIGEST_CHECK_INTERVAL,
+                first=Config.DIGEST_CHECK_INTERVAL
+            )
+            logger.info("Дайджесты уведомлений настроены")
+        except Exception as e:
+            logger.warning("Не удалось настроить дайджесты: %s", e)
+
+        try:
+            application.job_queue.run_repeating(
+                leader_only(reassign_stale_items),
+                interval=Config.ASSIGNMENT_CHECK_INTERVAL,
+                first=Config.ASSIGNMENT_CHECK_INTERVAL
+            )
+            logger.info("Распределение заявок: %s", assignment_engine.mode)
+        except Exception as e:
+            logger.warning("Не удалось настроить переназначение: %s", e)
+
+        try:
+            application.job_queue.run_repeating(
+                leader_only(run_retention),
+                interval=Config.RETENTION_INTERVAL,
+                first=600
+            )
+            logger.info("Архивация настроена (старше %s дней)", Config.RETENTION_DAYS)
+        except Exception as e:
+            logger.warning("Не удалось настроить архивацию: %s", e)
+
+        try:
+            application.job_queue.run_repeating(
+                flush_funnel,
+                interval=Config.FUNNEL_FLUSH_INTERVAL,
+                first=Config.FUNNEL_FLUSH_INTERVAL
+            )
+        except Exception as e:
+            logger.warning("Не удалось настроить запись аналитики: %s", e)
+
+        try:
+            application.job_queue.run_repeating(
+                flush_users,
+                interval=Config.USER_FLUSH_INTERVAL,
+                first=Config.USER_FLUSH_INTERVAL
+            )
+            application.job_queue.run_repeating(
+                leader_only(resume_broadcasts),
+                interval=Config.BROADCAST_CHECK_INTERVAL,
+                first=5
+            )
+            logger.info("Реестр пользователей и рассылки настроены")
+        except Exception as e:
+            logger.warning("Не удалось настроить рассылки: %s", e)
+
+        try:
+            application.job_queue.run_repeating(
+                leader_only(compact_knowledge_job),
+                interval=Config.KB_COMPACT_INTERVAL,
+                first=900
+            )
+        except Exception as e:
+            logger.warning("Не удалось настроить сжатие базы знаний: %s", e)
+
+        if db.supports_file_backup:
+            try:
+                application.job_queue.run_repeating(
+                    leader_only(backup_job),
+                    interval=Config.BACKUP_INTERVAL,
+                    first=300
+                )
+                logger.info("Резервное копирование настроено: %s", Config.BACKUP_DIR)
+            except Exception as e:
+                logger.warning("Не удалось настроить резервное копирование: %s", e)
 
     # Запуск системы автопинга
     start_ping_system()
-    
-    # Запуск Flask в отдельном потоке
-    def run_flask():
-        app.run(host='0.0.0.0', port=Config.PORT, debug=False)
-    
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-    
+
+    # Веб-интерфейс поднимается в своём потоке и не задерживает первый апдейт.
+    # В кластере порт один на всех - его слушает только первый воркер
+    if not cluster.enabled or Config.INSTANCE_INDEX == 0:
+        web_thread = threading.Thread(target=run_web_server, name='web')
+        web_thread.daemon = True
+        web_thread.start()
+
     # Запуск бота в polling режиме
     webhook_url = Config.get_webhook_url()
-    logger.info(f"🌐 Веб-интерфейс: {webhook_url}")
-    logger.info(f"🏓 Автопинг: {'Включен' if Config.ENABLE_PING else 'Отключен'}")
-    logger.info(f"🤖 Telegram бот запускается...")
-    application.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=True
-    )
+    logger.info("🌐 Веб-интерфейс: %s", webhook_url)
+    logger.info("🏓 Автопинг: %s", 'Включен' if Config.ENABLE_PING else 'Отключен')
+    logger.info("🤖 Telegram бот запускается...")
+    if cluster.enabled:
+        run_cluster(application)
+    else:
+        application.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+
+def run_cli(args):
+    """Служебные команды: backup, restore <снимок>, check <снимок>, compact-kb.
+
+    restore и check работают с файлами снимков и не открывают базу: иначе
+    открытие запустило бы миграции на базе, которую сейчас заменят или проверяют.
+    """
+    setup_logging()
+    command = args[0]
+    if command == 'backup':
+        init_database()
+        for path, size in create_backup():
+            print(f"{path} ({format_bytes(size)})")
+
+    elif command == 'restore' and len(args) == 2:
+        target = restore_backup(args[1])
+        print(f"База {target} восстановлена из {args[1]}")
+
+    elif command == 'compact-kb':
+        init_database()
+        report = run_kb_compaction()
+        print(f"Записей: {report['entries_before']} -> {report['entries_after']} (групп дублей: {report['clusters']}, вопросов с псевдонимами: {report['questions']})")
+        print(f"Поиск ответа в индексе: {report['lookup_ms_before']:.4f} -> {report['lookup_ms_after']:.4f} мс")
+        print(f"Полный перебор БД (прежний способ): {report['scan_ms_before']:.2f} -> {report['scan_ms_after']:.2f} мс")
+        print(f"Сжатие заняло {report['compaction_seconds']} с")
+
+    elif command == 'check' and len(args) == 2:
+        raw_path = args[1] + '.check'
+        with gzip.open(args[1], 'rb') as src, open(raw_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        try:
+            ok = check_integrity(raw_path)
+        finally:
+            os.remove(raw_path)
+        print("ok" if ok else "ПОВРЕЖДЁН")
+        sys.exit(0 if ok else 1)
+
+    else:
+        print("Использование: python main.py [backup | restore <снимок> | check <снимок> | compact-kb]")
+        sys.exit(2)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
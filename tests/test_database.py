@@ -0,0 +1,408 @@
+"""Одинаковое поведение методов Database на SQLite и PostgreSQL.
+
+SQLite проверяется всегда (файлы во временном каталоге). PostgreSQL - если
+задан TEST_DATABASE_URL; схемы public и archive этой базы пересоздаются
+перед каждым тестом, поэтому рабочую базу указывать нельзя.
+
+Запуск: TEST_DATABASE_URL=postgresql://localhost/bot_test python -m pytest tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+
+def reset_postgres(url: str):
+    psycopg = pytest.importorskip('psycopg')
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute("DROP SCHEMA IF EXISTS archive CASCADE")
+        conn.execute("DROP SCHEMA IF EXISTS public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def db(request, tmp_path, monkeypatch):
+    if request.param == 'sqlite':
+        monkeypatch.setattr(main.Config, 'DB_NAME', str(tmp_path / 'leads.db'))
+        monkeypatch.setattr(main.Config, 'ARCHIVE_DB_NAME', str(tmp_path / 'leads_archive.db'))
+        database = main.SQLiteDatabase()
+    else:
+        if not TEST_DATABASE_URL:
+            pytest.skip("TEST_DATABASE_URL не задан")
+        reset_postgres(TEST_DATABASE_URL)
+        database = main.PostgresDatabase(TEST_DATABASE_URL)
+    yield database
+    database.close()
+
+
+def reopen(db):
+    db.close()
+    if isinstance(db, main.PostgresDatabase):
+        return main.PostgresDatabase(TEST_DATABASE_URL)
+    return main.SQLiteDatabase()
+
+
+def age(db, table: str, item_id: int, days: int, column: str = 'created_at'):
+    """Сдвигает время записи в прошлое в диалекте бэкенда"""
+    db._execute(f"UPDATE {table} SET {column} = {db.SQL_NOW_MINUS} WHERE id = ?", (f'-{days} days', item_id))
+
+
+def add_request(db, user_id: int, contact: str = '@lead', **fields):
+    return db.add_request({'user_id': user_id, 'username': f'user{user_id}', 'contact': contact, **fields})
+
+
+# ===== СХЕМА И ТРАНЗАКЦИИ =====
+def test_schema_version_is_set_once(db):
+    assert db.get_schema_version() == db.SCHEMA_VERSION
+    request_id = add_request(db, 1)
+
+    db = reopen(db)
+    try:
+        assert db.get_schema_version() == db.SCHEMA_VERSION
+        assert db.get_request_by_id(request_id)[3] == '@lead'
+    finally:
+        db.close()
+
+
+def test_transaction_commits(db):
+    with db.transaction() as tx:
+        first = tx.insert("INSERT INTO knowledge_base (question, answer) VALUES (?, ?)", ('q1', 'a1'))
+        second = tx.insert("INSERT INTO knowledge_base (question, answer) VALUES (?, ?)", ('q2', 'a2'))
+        assert tx.query_one("SELECT COUNT(*) FROM knowledge_base")[0] == 2
+    assert second > first
+    assert db.get_knowledge_entry(first)[1:] == ('q1', 'a1')
+
+
+def test_transaction_rolls_back_on_error(db):
+    db.add_to_knowledge_base('kept', 'a')
+    with pytest.raises(RuntimeError):
+        with db.transaction() as tx:
+            tx.execute("INSERT INTO knowledge_base (question, answer) VALUES (?, ?)", ('lost', 'a'))
+            tx.execute("UPDATE knowledge_base SET answer = ? WHERE question = ?", ('changed', 'kept'))
+            raise RuntimeError("откат")
+    assert db.get_knowledge_base() == [('kept', 'a')]
+
+
+def test_execute_returns_rowcount(db):
+    for user_id in (1, 2, 3):
+        add_request(db, user_id)
+    assert db._execute("UPDATE requests SET status = ? WHERE user_id > ?", ('accepted', 1)) == 2
+    assert db._execute("DELETE FROM requests WHERE user_id = ?", (42,)) == 0
+
+
+def test_placeholder_characters_in_values(db):
+    text = "Сколько стоит бот? 100% предоплата? a_b \\ 'кавычки'"
+    question_id = db.add_question(7, 'user7', text)
+    db.add_question(7, 'user7', 'Другой вопрос')
+    assert db.get_question_by_id(question_id)[3] == text
+    assert [row[0] for row in db.get_open_page('question', pattern='100%')] == [question_id]
+    assert [row[0] for row in db.get_open_page('question', pattern='бот?')] == [question_id]
+    assert [row[0] for row in db.get_open_page('question', pattern='a_b')] == [question_id]
+    assert db.count_open('question', pattern='%') == 1
+    assert db.count_open('question', pattern='_') == 1
+
+
+# ===== ЗАЯВКИ И ВОПРОСЫ =====
+def test_insert_returns_new_ids(db):
+    request_ids = [add_request(db, user_id) for user_id in (1, 2)]
+    question_ids = [db.add_question(user_id, f'user{user_id}', 'вопрос') for user_id in (1, 2)]
+    entry_ids = [db.add_to_knowledge_base(f'q{i}', 'a') for i in range(2)]
+    for ids in (request_ids, question_ids, entry_ids):
+        assert all(isinstance(item_id, int) for item_id in ids)
+        assert ids[0] < ids[1]
+    assert db.get_request_by_id(request_ids[1])[1] == 2
+    assert db.get_question_by_id(question_ids[1])[1] == 2
+    assert db.get_knowledge_entry(entry_ids[1])[1] == 'q1'
+
+
+def test_requests(db):
+    request_id = add_request(db, 1, business_type='кафе', bot_tasks='заказы')
+    other_id = add_request(db, 2)
+    row = db.get_request_by_id(request_id)
+    assert row[:7] == (request_id, 1, 'user1', '@lead', 'кафе', 'заказы', 'new')
+    assert row[7] is not None and row[8] is None
+
+    db.update_request_status(other_id, 'accepted')
+    assert [r[0] for r in db.get_requests()] == [request_id]
+    assert [r[0] for r in db.get_requests('accepted')] == [other_id]
+    assert db.get_request_by_id(999) is None
+
+
+def test_questions(db):
+    open_id = db.add_question(1, 'user1', 'Как заказать?')
+    answered_id = db.add_question(2, 'user2', 'Сроки?')
+    db.answer_question(answered_id, '3 дня')
+    assert [q[0] for q in db.get_questions()] == [open_id]
+    answered = db.get_questions(answered=True)
+    assert [(q[0], q[4], q[5]) for q in answered] == [(answered_id, '3 дня', 'answered')]
+
+
+def test_open_page_and_count(db):
+    ids = [add_request(db, user_id, contact=f'+7900{user_id}') for user_id in range(1, 6)]
+    db.update_request_status(ids[0], 'rejected')
+    db.assign_item('request', ids[1], 100)
+    db.assign_item('request', ids[2], 200)
+
+    first = db.get_open_page('request', limit=2)
+    assert [r[0] for r in first] == [ids[4], ids[3]]
+    second = db.get_open_page('request', before_id=first[-1][0], limit=2)
+    assert [r[0] for r in second] == [ids[2], ids[1]]
+    assert db.count_open('request') == 4
+    assert db.count_open('request', manager_id=100) == 3
+    assert [r[0] for r in db.get_open_page('request', pattern='+79003')] == [ids[2]]
+
+
+def test_bulk_set_request_status_returns_rows(db):
+    ids = [add_request(db, user_id) for user_id in (1, 2, 3)]
+    db.assign_item('request', ids[0], 100)
+    rows = db.bulk_set_request_status('accepted', request_ids=ids[:2])
+    assert sorted(rows) == [(ids[0], 1, 100), (ids[1], 2, None)]
+    assert db.bulk_set_request_status('accepted', request_ids=ids[:2]) == []
+    assert db.bulk_set_request_status('rejected', request_ids=[]) == []
+    assert [r[0] for r in db.get_requests()] == [ids[2]]
+
+
+def test_bulk_answer_questions_returns_rows(db):
+    first = db.add_question(1, 'user1', 'цена?')
+    second = db.add_question(2, 'user2', 'сроки?')
+    rows = db.bulk_answer_questions('Смотрите прайс', pattern='ЦЕНА')
+    assert [tuple(r) for r in rows] == [(first, 1, None)]
+    assert db.get_question_by_id(first)[4] == 'Смотрите прайс'
+    assert db.get_question_by_id(second)[4] is None
+
+
+def test_inactive_leads(db):
+    fresh = add_request(db, 1)
+    stale = add_request(db, 2)
+    age(db, 'requests', stale, 3)
+    assert [r[0] for r in db.get_inactive_leads(days=2)] == [stale]
+    assert fresh not in [r[0] for r in db.get_inactive_leads(days=1)]
+
+
+def test_stats(db):
+    add_request(db, 1)
+    db.update_request_status(add_request(db, 2), 'accepted')
+    db.answer_question(db.add_question(1, 'user1', 'q'), 'a')
+    db.add_question(2, 'user2', 'q2')
+    db.add_manager(100, 'manager')
+    assert db.get_stats() == {
+        'total_requests': 2, 'new_requests': 1, 'accepted_requests': 1,
+        'total_questions': 2, 'unanswered_questions': 1, 'active_managers': 1
+    }
+
+
+# ===== БАЗА ЗНАНИЙ =====
+def test_knowledge_base_entries(db):
+    first = db.add_to_knowledge_base('Сколько стоит?', 'От 10 000')
+    second = db.add_to_knowledge_base('Сроки?', '3 дня')
+    assert db.get_knowledge_entries() == [(second, 'Сроки?', '3 дня'), (first, 'Сколько стоит?', 'От 10 000')]
+    assert db.update_knowledge_entry(first, answer='От 15 000') == 1
+    assert db.get_knowledge_entry(first) == (first, 'Сколько стоит?', 'От 15 000')
+    assert db.update_knowledge_entry(999, question='x') == 0
+
+    db.refresh_knowledge_entry(first, 'От 20 000', alias='Цена?')
+    entries, aliases = db.get_knowledge_index_rows()
+    assert entries[0] == (first, 'Сколько стоит?', 'От 20 000')
+    assert aliases == [(first, 'Цена?')]
+    assert db.get_knowledge_base()[0] == ('Сколько стоит?', 'От 20 000')
+
+
+def test_knowledge_merge_and_search(db):
+    canonical = db.add_to_knowledge_base('Сколько стоит бот?', 'От 10 000')
+    duplicate = db.add_to_knowledge_base('Какая цена бота?', 'От 10 000')
+    other = db.add_to_knowledge_base('Сроки?', '3 дня')
+    db.refresh_knowledge_entry(duplicate, 'От 10 000', alias='Стоимость?')
+
+    db.merge_knowledge_entries([(canonical, [duplicate])])
+    assert db.get_knowledge_entry(duplicate) is None
+    assert sorted(db.get_knowledge_aliases(canonical)) == ['Какая цена бота?', 'Стоимость?']
+    assert db.count_knowledge() == 2
+    # Поиск по псевдониму находит каноническую запись
+    assert [row[0] for row in db.get_knowledge_page(pattern='стоимость')] == [canonical]
+    assert db.count_knowledge('ЦЕНА') == 1
+
+    page = db.get_knowledge_page(limit=1)
+    assert [row[0] for row in page] == [other]
+    assert [row[0] for row in db.get_knowledge_page(before_id=page[-1][0], limit=1)] == [canonical]
+
+    assert db.delete_knowledge_entry(canonical) == 1
+    assert db.get_knowledge_aliases(canonical) == []
+    assert db.delete_knowledge_entry(canonical) == 0
+
+
+# ===== МЕНЕДЖЕРЫ И РАСПРЕДЕЛЕНИЕ =====
+def test_managers(db):
+    assert db.add_manager(100, 'first') is True
+    assert db.add_manager(100, 'again') is False
+    db.add_manager(200, 'second')
+    assert sorted(db.get_active_managers()) == [100, 200]
+    assert db.is_manager(100) and not db.is_manager(300)
+
+    assert db.set_manager_digest_interval(100, 30) is True
+    assert db.set_manager_digest_interval(300, 30) is False
+    assert db.get_manager_digest_interval(100) == 30
+    assert db.get_manager_digest_interval(300) is None
+    assert sorted(db.get_manager_digest_settings()) == [(100, 30), (200, 0)]
+
+    db.remove_manager(200)
+    assert db.get_active_managers() == [100]
+
+
+def test_assignments(db):
+    db.add_manager(100, 'first')
+    request_id = add_request(db, 1)
+    question_id = db.add_question(1, 'user1', 'q')
+    unassigned = db.add_question(2, 'user2', 'q2')
+    db.assign_item('request', request_id, 100)
+    db.assign_item('question', question_id, 200)
+
+    assert db.get_open_assignment_counts() == {100: 1, 200: 1}
+    assert db.get_last_assignee(1) in (100, 200)
+    assert db.get_last_assignee(2) is None
+
+    # 200 - не активный менеджер, unassigned - без менеджера
+    stale = db.get_stale_assignments(3600, 10)
+    assert sorted(stale) == [('question', question_id, 1, 200), ('question', unassigned, 2, None)]
+    age(db, 'requests', request_id, 1, column='assigned_at')
+    assert ('request', request_id, 1, 100) in db.get_stale_assignments(3600, 10)
+
+
+# ===== АРХИВ И ОБСЛУЖИВАНИЕ =====
+def test_archive_batch(db):
+    closed = [add_request(db, user_id) for user_id in (1, 2, 3)]
+    open_id = add_request(db, 4)
+    for request_id in closed:
+        db.update_request_status(request_id, 'accepted')
+        age(db, 'requests', request_id, 40)
+    age(db, 'requests', open_id, 40)
+    answered = db.add_question(1, 'user1', 'q')
+    db.answer_question(answered, 'a')
+    age(db, 'questions', answered, 40)
+
+    assert db.archive_batch('request', 30, 2) == 2
+    assert db.archive_batch('request', 30, 2) == 1
+    assert db.archive_batch('request', 30, 2) == 0
+    assert db.archive_batch('question', 30, 10) == 1
+
+    assert sorted(r[0] for r in db.get_archived('request')) == closed
+    assert [q[0] for q in db.get_archived('question')] == [answered]
+    assert [r[0] for r in db.get_requests()] == [open_id]
+    assert db.get_requests('accepted') == []
+    assert db.get_questions(answered=True) == []
+
+    stats = db.get_stats(include_archive=True)
+    assert (stats['archived_requests'], stats['archived_questions'], stats['total_requests']) == (3, 1, 1)
+
+
+def test_archive_batch_keeps_recent_items(db):
+    request_id = add_request(db, 1)
+    db.update_request_status(request_id, 'rejected')
+    assert db.archive_batch('request', 30, 10) == 0
+    assert db.get_request_by_id(request_id) is not None
+
+
+def test_maintenance(db):
+    size, free = db.get_size()
+    assert isinstance(size, int) and size > 0
+    assert isinstance(free, int) and free >= 0
+    db.ensure_incremental_vacuum()
+    assert db.incremental_vacuum(100) in (True, False)
+    db.analyze()
+
+
+# ===== ВОРОНКА =====
+def test_funnel_events(db):
+    now = 1_700_000_000 - 1_700_000_000 % 86400
+    db.add_funnel_events([(1, 'start', None, now), (2, 'start', None, now + 10), (1, 'request', 2.5, now + 70)])
+    db.add_funnel_events([(3, 'request', 1.5, now + 80)])
+
+    totals = db.get_funnel_totals('day', now, now + 86400)
+    assert totals == {'start': (2, 0.0, 0), 'request': (2, 4.0, 2)}
+    for count, latency_sum, latency_count in totals.values():
+        assert type(count) is int and type(latency_count) is int
+        assert type(latency_sum) is float
+    assert db.get_funnel_series('minute', now, now + 3600, ['start', 'request']) == [
+        (now, 'start', 2), (now + 60, 'request', 2)
+    ]
+    assert db.get_funnel_totals('hour', now + 3600, now + 7200) == {}
+
+
+def test_prune_funnel_events(db):
+    now = int(time.time())
+    db.add_funnel_events([(1, 'start', None, now - 10 * 86400), (1, 'start', None, now)])
+    assert db.prune_funnel_events(7) == 1
+    assert db.prune_funnel_events(7) == 0
+
+
+# ===== ПОЛЬЗОВАТЕЛИ И РАССЫЛКИ =====
+def test_users(db):
+    db.upsert_users([(1, 'a', 'A', 100), (2, 'b', 'B', 100), (3, 'c', 'C', 100)])
+    db._execute("UPDATE users SET blocked = 1 WHERE user_id = ?", (2,))
+    assert db.count_users() == 2
+    assert db.count_users(include_blocked=True) == 3
+    # Написал снова - снова получатель
+    db.upsert_users([(2, 'b2', 'B', 200)])
+    assert db.count_users() == 3
+    assert db.get_broadcast_recipients(0, 2) == [1, 2]
+    assert db.get_broadcast_recipients(2, 10) == [3]
+
+
+def test_broadcast_lifecycle(db):
+    db.upsert_users([(user_id, None, None, 100) for user_id in (1, 2, 3, 4)])
+    broadcast_id = db.create_broadcast('Новости', 100)
+    assert isinstance(broadcast_id, int)
+    assert db.create_broadcast('Ещё', 100) > broadcast_id
+
+    broadcast = db.get_broadcast(broadcast_id)
+    assert broadcast[1:9] == ('Новости', 'running', 100, 4, 0, 0, 0, 0)
+    assert [b[0] for b in db.get_broadcasts('running')][-1] == broadcast_id
+
+    db.set_broadcast_progress_message(broadcast_id, 100, 555)
+    assert db.get_broadcast(broadcast_id)[9:11] == (100, 555)
+
+    assert db.claim_broadcast_delivery(broadcast_id, 1) and db.claim_broadcast_delivery(broadcast_id, 2)
+    db.record_broadcast_batch(broadcast_id, 2, [(1, 'sent'), (2, 'blocked')])
+    assert db.get_broadcast(broadcast_id)[5:9] == (1, 0, 1, 2)
+    assert db.count_users() == 3
+
+    assert db.set_broadcast_status(broadcast_id, 'done') is True
+    assert db.set_broadcast_status(broadcast_id, 'cancelled') is False
+    assert db.get_broadcast(broadcast_id)[2] == 'done'
+    assert db.get_broadcast(broadcast_id)[12] is not None
+    assert broadcast_id not in [b[0] for b in db.get_broadcasts('running')]
+
+
+def test_broadcast_resume_skips_claimed_recipients(db):
+    db.upsert_users([(user_id, None, None, 100) for user_id in (1, 2, 3)])
+    broadcast_id = db.create_broadcast('Новости', 100)
+    assert all(db.claim_broadcast_delivery(broadcast_id, user_id) for user_id in (1, 2, 3))
+    assert db.claim_broadcast_delivery(broadcast_id, 1) is False
+    # Остановка посреди пачки: доставка 1 подтверждена, до 2 очередь не дошла, 3 оборвана аварийно
+    db.record_broadcast_batch(broadcast_id, None, [(1, 'sent')])
+    db.release_broadcast_delivery(broadcast_id, 2)
+    db.release_broadcast_delivery(broadcast_id, 1)  # Подтверждённую отметку снять нельзя
+    assert db.get_broadcast(broadcast_id)[8] == 0
+
+    assert db.settle_interrupted_deliveries(broadcast_id) == 1
+    assert db.settle_interrupted_deliveries(broadcast_id) == 0
+    assert [db.claim_broadcast_delivery(broadcast_id, user_id) for user_id in (1, 2, 3)] == [False, True, False]
+    assert db.get_broadcast(broadcast_id)[5:7] == (1, 1)
+
+
+def test_prune_broadcast_deliveries(db):
+    db.upsert_users([(1, None, None, 100)])
+    finished = db.create_broadcast('old', 100)
+    running = db.create_broadcast('new', 100)
+    for broadcast_id in (finished, running):
+        db.claim_broadcast_delivery(broadcast_id, 1)
+        db.record_broadcast_batch(broadcast_id, 1, [(1, 'sent')])
+    db.set_broadcast_status(finished, 'done')
+    db._execute("UPDATE broadcasts SET finished_at = ? WHERE id = ?", (int(time.time()) - 40 * 86400, finished))
+    assert db.prune_broadcast_deliveries(30) == 1
+    assert db.claim_broadcast_delivery(running, 1) is False
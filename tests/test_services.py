@@ -0,0 +1,304 @@
+"""Логика поверх хранилища: рассылки, переназначение, лимиты, дайджест, воронка, база знаний.
+
+Используется SQLite во временном каталоге (поведение бэкендов проверяет
+test_database.py); Bot API заменён заглушкой, циклы событий - asyncio.run.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.Config, 'DB_NAME', str(tmp_path / 'leads.db'))
+    monkeypatch.setattr(main.Config, 'ARCHIVE_DB_NAME', str(tmp_path / 'leads_archive.db'))
+    database = main.SQLiteDatabase()
+    monkeypatch.setattr(main, 'db', database)
+    yield database
+    database.close()
+
+
+class FakeBot:
+    """Запоминает получателей sendMessage; задержка ответа - чтобы отмена приходилась на середину пачки"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent.append(chat_id)
+
+    async def edit_message_text(self, **kwargs):
+        pass
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+
+
+def add_users(db, count: int):
+    now = int(time.time())
+    db.upsert_users([(user_id, f'user{user_id}', 'Test', now) for user_id in range(1, count + 1)])
+
+
+def delivery_statuses(db, broadcast_id: int):
+    return dict(db._query("SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status",
+                          (broadcast_id,)))
+
+
+# ===== РАССЫЛКИ =====
+@pytest.fixture
+def broadcaster(monkeypatch):
+    monkeypatch.setattr(main.Config, 'BROADCAST_BATCH', 20)
+    monkeypatch.setattr(main.Config, 'BROADCAST_CONCURRENCY', 5)
+    return main.Broadcaster(main.NotificationQueue(rate=10000, burst=100, workers=1))
+
+
+def test_broadcast_delivers_each_user_once(db, broadcaster):
+    add_users(db, 50)
+    broadcast_id = db.create_broadcast("Новость", created_by=1)
+    bot = FakeBot()
+
+    async def run():
+        broadcaster.start(bot, broadcast_id)
+        await broadcaster._tasks[broadcast_id]
+
+    asyncio.run(run())
+    broadcast = db.get_broadcast(broadcast_id)
+    assert sorted(bot.sent) == list(range(1, 51))
+    assert (broadcast[2], broadcast[4], broadcast[5]) == ('done', 50, 50)
+    assert delivery_statuses(db, broadcast_id) == {'sent': 50}
+
+
+def test_broadcast_resume_after_cancel_has_no_duplicates_or_gaps(db, broadcaster):
+    add_users(db, 100)
+    broadcast_id = db.create_broadcast("Новость", created_by=1)
+    bot = FakeBot(latency=0.01)
+
+    async def run():
+        broadcaster.start(bot, broadcast_id)
+        while len(bot.sent) < 30:
+            await asyncio.sleep(0.005)
+        task = broadcaster._tasks[broadcast_id]
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        # Всё, что ушло в Bot API до остановки, записано; незапущенные отправки не отмечены
+        assert db.get_broadcast(broadcast_id)[5] == len(bot.sent)
+        assert delivery_statuses(db, broadcast_id) == {'sent': len(bot.sent)}
+
+        broadcaster.start(bot, broadcast_id)
+        await broadcaster._tasks[broadcast_id]
+
+    asyncio.run(run())
+    broadcast = db.get_broadcast(broadcast_id)
+    assert sorted(bot.sent) == list(range(1, 101))
+    assert (broadcast[2], broadcast[5], broadcast[6]) == ('done', 100, 0)
+
+
+def test_broadcast_does_not_resend_delivery_interrupted_by_crash(db, broadcaster):
+    add_users(db, 10)
+    broadcast_id = db.create_broadcast("Новость", created_by=1)
+    # Процесс упал, когда запрос пользователю 3 уже мог уйти: отметка pending осталась
+    assert db.claim_broadcast_delivery(broadcast_id, 3)
+    bot = FakeBot()
+
+    async def run():
+        broadcaster.start(bot, broadcast_id)
+        await broadcaster._tasks[broadcast_id]
+
+    asyncio.run(run())
+    broadcast = db.get_broadcast(broadcast_id)
+    assert 3 not in bot.sent
+    assert len(bot.sent) == 9
+    assert (broadcast[5], broadcast[6]) == (9, 1)
+    assert delivery_statuses(db, broadcast_id) == {'sent': 9, 'interrupted': 1}
+
+
+# ===== ПЕРЕНАЗНАЧЕНИЕ =====
+@pytest.fixture
+def engine(db, monkeypatch):
+    engine = main.AssignmentEngine('round_robin')
+    monkeypatch.setattr(main, 'assignment_engine', engine)
+    monkeypatch.setattr(main, 'shared_store', main.LocalStore())
+    return engine
+
+
+def add_stale_request(db, user_id: int, manager_id: int = None):
+    request_id = db.add_request({'user_id': user_id, 'username': f'user{user_id}', 'contact': '@lead',
+                                 'business_type': 'Кафе', 'bot_tasks': 'Заказы'})
+    if manager_id is not None:
+        db.assign_item('request', request_id, manager_id)
+        db._execute(f"UPDATE requests SET assigned_at = {db.SQL_NOW_MINUS} WHERE id = ?", ('-2 days', request_id))
+    return request_id
+
+
+def assigned(db, request_id: int):
+    return db._query_one("SELECT assigned_to, assigned_at FROM requests WHERE id = ?", (request_id,))
+
+
+def test_reassign_keeps_item_with_only_manager_without_notifying(db, engine):
+    db.add_manager(10, 'manager10')
+    request_id = add_stale_request(db, 1, manager_id=10)
+    before = assigned(db, request_id)
+    bot = FakeBot()
+
+    for _ in range(3):
+        asyncio.run(main.reassign_stale_items(FakeContext(bot)))
+
+    assert bot.sent == []
+    assert assigned(db, request_id) == before
+
+
+def test_reassign_moves_stale_item_to_other_manager(db, engine):
+    db.add_manager(10, 'manager10')
+    db.add_manager(20, 'manager20')
+    request_id = add_stale_request(db, 1, manager_id=10)
+    bot = FakeBot()
+
+    asyncio.run(main.reassign_stale_items(FakeContext(bot)))
+    assert assigned(db, request_id)[0] == 20
+    assert bot.sent == [20]
+
+    # Новое назначение свежее - следующий проход его не трогает
+    asyncio.run(main.reassign_stale_items(FakeContext(bot)))
+    assert bot.sent == [20]
+
+
+def test_reassign_assigns_unassigned_item_once(db, engine):
+    db.add_manager(10, 'manager10')
+    request_id = add_stale_request(db, 1)
+    bot = FakeBot()
+
+    asyncio.run(main.reassign_stale_items(FakeContext(bot)))
+    asyncio.run(main.reassign_stale_items(FakeContext(bot)))
+    assert assigned(db, request_id)[0] == 10
+    assert bot.sent == [10]
+
+
+# ===== ЛИМИТ СООБЩЕНИЙ =====
+def make_limiter(**overrides):
+    params = dict(capacity=2, refill_rate=0.01, max_users=100, cooldown=10, max_cooldown=40, strike_reset=100)
+    params.update(overrides)
+    return main.RateLimiter(**params)
+
+
+def test_rate_limiter_cooldown_doubles_up_to_max():
+    limiter = make_limiter()
+    assert limiter.check(1, now=0) == (True, 0)
+    assert limiter.check(1, now=0) == (True, 0)
+    assert limiter.check(1, now=0) == (False, 10)
+    # Во время кулдауна предупреждение не повторяется
+    assert limiter.check(1, now=5) == (False, 0)
+    assert limiter.check(1, now=10) == (False, 20)
+    assert limiter.check(1, now=30) == (False, 40)
+    assert limiter.check(1, now=70) == (False, 40)
+    assert limiter.get_stats()['cooldowns'] == 4
+
+
+def test_rate_limiter_forgets_strikes_after_quiet_period():
+    limiter = make_limiter()
+    for _ in range(3):
+        limiter.check(1, now=0)
+    assert limiter.check(1, now=10) == (False, 20)
+    # Кулдаун истёк в 30, ещё strike_reset секунд тишины - нарушения забыты
+    assert limiter.check(1, now=231) == (True, 0)
+    assert limiter.check(1, now=231) == (True, 0)
+    assert limiter.check(1, now=231) == (False, 10)
+
+
+def test_rate_limiter_evicts_least_recent_user():
+    limiter = make_limiter(max_users=2)
+    limiter.check(1, now=0)
+    limiter.check(2, now=0)
+    limiter.check(1, now=1)
+    limiter.check(3, now=2)
+    assert set(limiter._buckets) == {1, 3}
+    assert limiter.get_stats()['evicted'] == 1
+
+
+# ===== ДАЙДЖЕСТ =====
+def test_render_digest_fits_telegram_limit():
+    events = [(f"Событие {i}: " + "x" * 600, i) for i in range(1, 21)]
+    text, question_ids = main.render_digest(events)
+    assert len(text) <= 4096
+    assert text.startswith("📬 *Дайджест: 20 событий*")
+    assert "...и ещё" in text
+    assert question_ids == list(range(1, main.Config.DIGEST_MAX_BUTTONS + 1))
+
+
+def test_render_digest_skips_events_without_question():
+    text, question_ids = main.render_digest([("Новая заявка", None), ("Вопрос", 7)])
+    assert text.endswith("Новая заявка\n\nВопрос")
+    assert question_ids == [7]
+
+
+def test_notification_digest_collects_until_window_expires():
+    digest = main.NotificationDigest(main.LocalStore())
+    digest.add(10, "первое", 1)
+    digest.add(10, "второе")
+    now = time.time()
+    assert digest.pop_due({10: 5}, now=now) == {}
+    assert digest.pop_due({10: 5}, now=now + 301) == {10: [("первое", 1), ("второе", None)]}
+    assert digest.pop_due({10: 5}, now=now + 601) == {}
+
+
+# ===== ВОРОНКА =====
+def test_funnel_report_aligns_window_to_buckets(db):
+    hour = int(time.time()) // 3600 * 3600 - 3600
+    db.add_funnel_events([
+        (1, 'flow_start', None, hour + 60),
+        (2, 'flow_start', None, hour + 120),
+        (1, 'step_business', 4.0, hour + 1800),
+        (1, 'flow_complete', 2.0, hour + 3000)
+    ])
+
+    report = main.build_funnel_report(hour + 1000, hour + 3500, 'minute')
+    assert (report['from'], report['to']) == (hour + 960, hour + 3540)
+    assert [step['count'] for step in report['steps']] == [0, 1, 0, 1]
+
+    report = main.build_funnel_report(hour + 1000, hour + 3500, 'hour')
+    # Корзина часа попадает целиком - и 'from' это показывает
+    assert (report['from'], report['to']) == (hour, hour + 3600)
+    steps = report['steps']
+    assert [step['count'] for step in steps] == [2, 1, 0, 1]
+    assert steps[1]['conversion_from_start'] == 0.5
+    assert steps[1]['avg_latency_sec'] == 4.0
+
+
+# ===== БАЗА ЗНАНИЙ =====
+@pytest.fixture
+def index(db):
+    return main.KnowledgeIndex(main.LocalStore())
+
+
+def test_knowledge_index_merges_duplicate_question(db, index):
+    first = index.add("Сколько стоит разработка бота?", "От 10 000 ₽")
+    second = index.add("Сколько стоит разработка бота", "От 15 000 ₽")
+    other = index.add("Какие сроки запуска?", "Две недели")
+
+    assert second == first
+    assert other != first
+    assert index.size() == (2, 3)
+    assert index.lookup("а сколько стоит бот?") == "От 15 000 ₽"
+
+
+def test_knowledge_index_compact_keeps_newest_entry(db, index):
+    old = db.add_to_knowledge_base("Сколько стоит разработка бота?", "Старый ответ")
+    new = db.add_to_knowledge_base("Сколько стоит разработка бота", "Новый ответ")
+    db.add_to_knowledge_base("Какие сроки запуска?", "Две недели")
+
+    assert index.compact() == [(new, [old])]
+    assert index.size() == (2, 3)
+    assert index.lookup("сколько стоит разработка") == "Новый ответ"
+    assert index.compact() == []